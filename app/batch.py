@@ -0,0 +1,242 @@
+"""
+Recálculo em lote, sem HTTP.
+
+Lê um arquivo JSONL com um corpo de /calculate (InputData) por linha e grava
+outro JSONL com uma linha por registro, na mesma ordem da entrada:
+
+    {"line":1,"status":200,"result":{"direct_results":[...],"aggregated_entities":[...]}}
+    {"line":2,"status":422,"detail":[...]}
+    {"line":3,"status":500,"detail":"..."}
+
+Linhas com `entities_ref` usam os snapshots de SNAPSHOT_DIR (404 se não existir).
+
+O resultado é o mesmo de /calculate. A entrada é mapeada em memória e os
+workers recebem só as posições das linhas; o progresso é gravado em
+`<saída>.checkpoint`, e uma execução interrompida continua de onde parou:
+
+    python -m app.batch entrada.jsonl saida.jsonl --workers 8
+"""
+import argparse
+import mmap
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+from fastapi.exceptions import RequestValidationError
+
+from app.services.codec import decode_input, dumps, loads
+from app.services.executor import run_calculation
+from app.services.partition import partitions
+from app.services.planner import FormulaCycleError
+from app.services.snapshots import snapshots
+
+# (número da linha, início, fim) de um registro no arquivo de entrada
+Span = Tuple[int, int, int]
+
+_input: Optional[mmap.mmap] = None
+
+
+def _open_input(path: str) -> Optional[mmap.mmap]:
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _init_worker(path: str) -> None:
+    global _input
+    _input = _open_input(path)
+    # Cada worker já é um núcleo; não abre outro pool para registros grandes
+    partitions.workers = 1
+
+
+def _spans(data: mmap.mmap, offset: int, line: int) -> Iterator[Tuple[Span, int]]:
+    """Linhas não vazias a partir de `offset`, com a posição logo após cada uma."""
+    size = len(data)
+    while offset < size:
+        end = data.find(b'\n', offset)
+        if end < 0:
+            end = size
+        if data[offset:end].strip():
+            yield (line, offset, end), end + 1
+        offset = end + 1
+        line += 1
+
+
+def calculate_line(line: int, body: bytes) -> bytes:
+    """Uma linha da saída para o corpo de uma requisição."""
+    try:
+        input_data = decode_input(body)
+        entities = input_data.entities
+        if input_data.entities_ref is not None:
+            entities = snapshots.info(input_data.entities_ref)
+            if entities is None:
+                return dumps({'line': line, 'status': 404, 'detail': f"Snapshot '{input_data.entities_ref}' not found"})
+        content, _ = run_calculation(entities, input_data.formulas)
+    except RequestValidationError as e:
+        return dumps({'line': line, 'status': 422, 'detail': e.errors()})
+    except FormulaCycleError as e:
+        return dumps({'line': line, 'status': 422, 'detail': str(e)})
+    except Exception as e:
+        return dumps({'line': line, 'status': 500, 'detail': str(e)})
+    return b''.join((b'{"line":', str(line).encode(), b',"status":200,"result":', content, b'}'))
+
+
+def _calculate_spans(spans: List[Span]) -> bytes:
+    return b''.join(calculate_line(line, _input[start:end]) + b'\n' for line, start, end in spans)
+
+
+class Checkpoint:
+    """
+    Progresso de uma execução: até onde a entrada foi lida e o tamanho da
+    saída correspondente. Só é gravado depois que a saída foi para o disco.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self, input_path: str) -> Dict[str, Any]:
+        if not os.path.exists(self.path):
+            return {'input_offset': 0, 'line': 1, 'output_offset': 0, 'records': 0}
+        with open(self.path, 'rb') as f:
+            state = loads(f.read())
+        if state.get('input') != os.path.abspath(input_path):
+            raise ValueError(f"checkpoint {self.path} belongs to {state.get('input')}")
+        return state
+
+    def save(self, input_path: str, state: Dict[str, Any]) -> None:
+        temp = self.path + '.tmp'
+        with open(temp, 'wb') as f:
+            f.write(dumps({**state, 'input': os.path.abspath(input_path)}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.path)
+
+    def remove(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _chunks(spans: Iterator[Tuple[Span, int]], size: int) -> Iterator[Tuple[List[Span], int, int]]:
+    """Lotes de até `size` registros, com a posição e a linha seguintes ao lote."""
+    chunk: List[Span] = []
+    after = 0
+    for span, after in spans:
+        chunk.append(span)
+        if len(chunk) >= size:
+            yield chunk, after, span[0] + 1
+            chunk = []
+    if chunk:
+        yield chunk, after, chunk[-1][0] + 1
+
+
+def run_batch(
+    input_path: str,
+    output_path: str,
+    workers: int = 1,
+    chunk_size: int = 16,
+    checkpoint_every: int = 1000,
+    restart: bool = False,
+    log=sys.stderr
+) -> int:
+    """Processa `input_path` inteiro e devolve o número de registros calculados nesta execução."""
+    checkpoint = Checkpoint(output_path + '.checkpoint')
+    if restart:
+        checkpoint.remove()
+    state = checkpoint.load(input_path)
+    data = _open_input(input_path)
+    if state['records']:
+        print(f"resuming at line {state['line']} ({state['records']} records done)", file=log)
+
+    mode = 'r+b' if state['output_offset'] and os.path.exists(output_path) else 'wb'
+    out = open(output_path, mode)
+    if out.seek(0, os.SEEK_END) < state['output_offset']:
+        out.close()
+        raise ValueError(f"{output_path} is shorter than its checkpoint")
+    # Descarta o que foi escrito depois do último checkpoint
+    out.truncate(state['output_offset'])
+    out.seek(state['output_offset'])
+
+    pool = None
+    if workers > 1 and data is not None:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(input_path,))
+    else:
+        global _input
+        _input = data
+
+    started = time.perf_counter()
+    done = 0
+    since_checkpoint = 0
+
+    def commit(chunk: List[Span], lines: bytes, after: int, next_line: int) -> None:
+        nonlocal done, since_checkpoint
+        out.write(lines)
+        done += len(chunk)
+        since_checkpoint += len(chunk)
+        state.update(input_offset=after, line=next_line, records=state['records'] + len(chunk))
+        if since_checkpoint >= checkpoint_every:
+            out.flush()
+            os.fsync(out.fileno())
+            state['output_offset'] = out.tell()
+            checkpoint.save(input_path, state)
+            since_checkpoint = 0
+            elapsed = time.perf_counter() - started
+            print(f"{state['records']} records, {done / elapsed:.1f}/s", file=log)
+
+    try:
+        chunks = _chunks(_spans(data, state['input_offset'], state['line']), chunk_size) if data is not None else ()
+        if pool is None:
+            for chunk, after, next_line in chunks:
+                commit(chunk, _calculate_spans(chunk), after, next_line)
+        else:
+            # Mantém alguns lotes na fila de cada worker e grava na ordem da entrada
+            pending: Deque[Tuple[List[Span], int, int, Future]] = deque()
+            for chunk, after, next_line in chunks:
+                pending.append((chunk, after, next_line, pool.submit(_calculate_spans, chunk)))
+                if len(pending) >= workers * 4:
+                    chunk, after, next_line, future = pending.popleft()
+                    commit(chunk, future.result(), after, next_line)
+            while pending:
+                chunk, after, next_line, future = pending.popleft()
+                commit(chunk, future.result(), after, next_line)
+        out.flush()
+        os.fsync(out.fileno())
+        state['output_offset'] = out.tell()
+        checkpoint.save(input_path, state)
+    finally:
+        out.close()
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        if data is not None:
+            data.close()
+
+    elapsed = time.perf_counter() - started
+    rate = done / elapsed if elapsed else 0.0
+    print(f"{done} records in {elapsed:.2f}s ({rate:.1f}/s), {state['records']} total", file=log)
+    return done
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Recálculo em lote de um JSONL de requisições de /calculate")
+    parser.add_argument('input', help="JSONL com um InputData por linha")
+    parser.add_argument('output', help="JSONL de saída; o checkpoint fica em <output>.checkpoint")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="processos de cálculo")
+    parser.add_argument('--chunk-size', type=int, default=16, help="registros enviados a um worker por vez")
+    parser.add_argument('--checkpoint-every', type=int, default=1000,
+                        help="registros entre um checkpoint e outro")
+    parser.add_argument('--restart', action='store_true', help="ignora o checkpoint e começa do início")
+    args = parser.parse_args(argv)
+    try:
+        run_batch(args.input, args.output, max(args.workers, 1), max(args.chunk_size, 1),
+                  max(args.checkpoint_every, 1), args.restart)
+    except ValueError as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+import os
+
+# Onde o cálculo roda: "inline" (no event loop), "thread" ou "process"
+EXECUTION_BACKEND = os.getenv('EXECUTION_BACKEND', 'thread')
+EXECUTION_WORKERS = int(os.getenv('EXECUTION_WORKERS', str(os.cpu_count() or 1)))
+# Tempo máximo (s) de espera por um cálculo fora do event loop
+EXECUTION_TIMEOUT = float(os.getenv('EXECUTION_TIMEOUT', '30'))
+# Cálculos simultâneos fora do event loop antes de recusar novas requisições
+EXECUTION_MAX_PENDING = int(os.getenv('EXECUTION_MAX_PENDING', '64'))
+# Payloads até este tamanho (atributos x fórmulas) são calculados inline
+EXECUTION_INLINE_MAX_SIZE = int(os.getenv('EXECUTION_INLINE_MAX_SIZE', '20000'))
+
+# Corpos de requisição acima deste tamanho (bytes) são validados numa thread,
+# fora do event loop
+DECODE_INLINE_MAX_BYTES = int(os.getenv('DECODE_INLINE_MAX_BYTES', '65536'))
+
+# Cache de resultados; sem REDIS_URL usa apenas o LRU em memória
+CACHE_ENABLED = os.getenv('CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+REDIS_URL = os.getenv('REDIS_URL', '')
+CACHE_TTL = float(os.getenv('CACHE_TTL', '3600'))
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '1024'))
+# Soma dos tamanhos das respostas no cache em memória; respostas maiores que
+# um quarto disto não são guardadas
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', '268435456'))
+# Tempo máximo, em segundos, de cada operação no Redis antes de usar o cache local
+REDIS_TIMEOUT = float(os.getenv('REDIS_TIMEOUT', '1'))
+
+# Sessões de recálculo incremental, mantidas na memória de cada processo
+SESSION_MAX = int(os.getenv('SESSION_MAX', '64'))
+SESSION_TTL = float(os.getenv('SESSION_TTL', '3600'))
+
+# Threads para fórmulas independentes de um mesmo nível; 1 calcula em sequência
+FORMULA_WORKERS = int(os.getenv('FORMULA_WORKERS', '1'))
+# Grupos de agregação a partir deste número de valores são guardados em colunas
+# e reduzidos juntos em numpy, usando mais memória; 0 reduz tudo em fluxo
+AGGREGATION_COLUMNAR_MIN_ROWS = int(os.getenv('AGGREGATION_COLUMNAR_MIN_ROWS', '0'))
+
+# Requisições grandes são divididas por entidade raiz (cada Contract com seus
+# Servico e Medicao) e calculadas em paralelo num pool de processos; 1 desliga
+PARTITION_WORKERS = int(os.getenv('PARTITION_WORKERS', str(os.cpu_count() or 1)))
+PARTITION_ROOT_TYPE = os.getenv('PARTITION_ROOT_TYPE', 'Contract')
+PARTITION_MIN_ENTITIES = int(os.getenv('PARTITION_MIN_ENTITIES', '20000'))
+
+# Snapshots de entidades (POST /api/v1/snapshots), gravados em SNAPSHOT_DIR;
+# os mais usados ficam decodificados em memória em cada processo
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', 'snapshots')
+SNAPSHOT_CACHE_ENTRIES = int(os.getenv('SNAPSHOT_CACHE_ENTRIES', '8'))
+# Soma máxima dos arquivos em SNAPSHOT_DIR; os usados há mais tempo são apagados
+SNAPSHOT_MAX_BYTES = int(os.getenv('SNAPSHOT_MAX_BYTES', '1073741824'))
+
+# Respostas de /calculate a partir deste tamanho (bytes) vão com gzip se o
+# cliente aceitar (Accept-Encoding); 0 desliga
+GZIP_MIN_SIZE = int(os.getenv('GZIP_MIN_SIZE', '1024'))
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', '1'))
+
+# Métricas em /metrics e cabeçalho Server-Timing
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Cálculos acima deste tempo (s) têm as pilhas amostradas gravadas em PROFILE_DIR; 0 desliga
+PROFILE_SLOW_SECONDS = float(os.getenv('PROFILE_SLOW_SECONDS', '0'))
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.005'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
@@ -1,9 +1,24 @@
 from fastapi import FastAPI
 from app.routes.api import router
+from app.routes.metrics import router as metrics_router
+from app.services.executor import executor
+from app.services.partition import partitions
 
 app = FastAPI()
 app.include_router(router, prefix="/api/v1")
+app.include_router(metrics_router)
+
+
+@app.on_event("startup")
+def start_executor():
+    executor.start()
+
+
+@app.on_event("shutdown")
+def stop_executor():
+    executor.shutdown()
+    partitions.shutdown()
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8000)
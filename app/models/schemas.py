@@ -37,4 +37,51 @@ class InputData(BaseModel):
 
 class OutputData(BaseModel):
     direct_results: List[FormulaResult]
-    aggregated_entities: List[EntityOutput]
\ No newline at end of file
+    aggregated_entities: List[EntityOutput]
+
+# Respostas de /calculate com `fields` ou failed_only: só os campos pedidos
+class ProjectedFormulaResult(BaseModel):
+    entity_id: Optional[str] = None
+    formula: Optional[str] = None
+    resolved_formula: Optional[str] = None
+    result: Optional[Union[float, int, str]] = None
+    result_type: Optional[str] = None
+    error: Optional[str] = None
+    success: Optional[bool] = None
+
+class ProjectedOutputData(BaseModel):
+    direct_results: List[ProjectedFormulaResult]
+    aggregated_entities: List[EntityOutput]
+
+# Respostas de /calculate com format=columnar: uma lista por campo pedido
+# (entity_id, result e success por padrão), alinhadas entre si
+class ColumnarFormulaResults(BaseModel):
+    entity_id: Optional[List[str]] = None
+    resolved_formula: Optional[List[str]] = None
+    result: Optional[List[Optional[Union[float, int, str]]]] = None
+    result_type: Optional[List[Optional[str]]] = None
+    error: Optional[List[Optional[str]]] = None
+    success: Optional[List[bool]] = None
+
+class ColumnarOutputData(BaseModel):
+    formulas: List[str]
+    direct_results: List[ColumnarFormulaResults]
+    aggregated_entities: List[EntityOutput]
+
+class AttributeChange(BaseModel):
+    entity_id: str
+    key: str
+    value: Union[str, int, float]
+    type: Optional[str] = None
+
+class SessionPatch(BaseModel):
+    changes: List[AttributeChange]
+
+class SessionOutput(OutputData):
+    session_id: str
+
+class SnapshotOutput(BaseModel):
+    entities_ref: str
+    entity_count: int
+    attribute_count: int
+    size: int
@@ -1,20 +1,362 @@
-from fastapi import APIRouter
-from app.models.schemas import InputData, OutputData
+import asyncio
+import time
+from typing import Any, Callable, Iterator, List, Optional, Tuple, TypeVar, Union
+
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import Response, StreamingResponse
+from app import config
+from app.models.schemas import (
+    ColumnarOutputData, InputData, OutputData, ProjectedOutputData, SessionOutput, SessionPatch, SnapshotOutput
+)
+from app.services.cache import cache_key, result_cache
 from app.services.calculator import FormulaProcessor
+from app.services.codec import (
+    COLUMNAR_FIELDS, RESULT_FIELDS, CalculationInput, OutputOptions, accepts_gzip, decode_entities, decode_input, dumps,
+    encode_result, gzip_encode
+)
+from app.services.entity_store import EntityRecord
+from app.services.executor import ExecutorBusy, executor
+from app.services.metrics import CalculationStats, metrics
+from app.services.planner import FormulaCycleError, plan_formulas
+from app.services.session import CalculationSession, sessions
+from app.services.snapshots import SnapshotInfo, SnapshotNotFound, SnapshotTooLarge, snapshots
 
 router = APIRouter()
 
+T = TypeVar('T')
+
+# O corpo é lido e validado por app.services.codec, sem passar pelos modelos
+# pydantic; o contrato no OpenAPI continua sendo InputData, ou entities_ref
+# (hash de um snapshot enviado a /snapshots) no lugar de entities
+VALIDATION_ERROR = {
+    "422": {
+        "description": "Validation Error",
+        "content": {"application/json": {"schema": {"$ref": "#/components/schemas/HTTPValidationError"}}}
+    }
+}
+INPUT_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": {"anyOf": [
+            {"$ref": "#/components/schemas/InputData"},
+            {
+                "type": "object",
+                "required": ["entities_ref", "formulas"],
+                "properties": {
+                    "entities_ref": {"type": "string"},
+                    "formulas": {"type": "array", "items": {"type": "string"}}
+                }
+            }
+        ]}}}
+    },
+    "responses": VALIDATION_ERROR
+}
+SNAPSHOT_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": {
+            "type": "object",
+            "required": ["entities"],
+            "properties": {"entities": {"type": "array", "items": {"$ref": "#/components/schemas/EntityInput"}}}
+        }}}
+    },
+    "responses": VALIDATION_ERROR
+}
+
+
 @router.post(
     "/calculate",
-    response_model=OutputData,
+    response_model=Union[OutputData, ProjectedOutputData, ColumnarOutputData],
+    response_model_exclude_none=True,
+    response_description="OutputData; ProjectedOutputData com fields, failed_only ou skip_resolved; "
+                         "ColumnarOutputData com format=columnar",
+    openapi_extra=INPUT_BODY
+)
+async def calculate(
+    request: Request,
+    fields: Optional[str] = Query(None, description="Campos de cada resultado, separados por vírgula"),
+    failed_only: bool = Query(False, description="Só os resultados com success=false"),
+    skip_resolved: bool = Query(False, description="Omite resolved_formula"),
+    output_format: str = Query(
+        'rows', alias='format', pattern='^(rows|columnar)$', description="columnar: listas paralelas por fórmula"
+    )
+):
+    """
+    Calcula as fórmulas. Por padrão a resposta é OutputData; os parâmetros
+    limitam os campos e os resultados devolvidos. Com format=columnar,
+    `formulas` lista cada fórmula uma vez e `direct_results[i]` traz, para
+    a fórmula i, uma lista por campo (entity_id, result e success, se
+    `fields` não for informado), todas na mesma ordem.
+    """
+    started = time.perf_counter()
+    try:
+        options = _output_options(fields, failed_only, skip_resolved, output_format)
+    except HTTPException:
+        _record('calculate', 422, started)
+        raise
+    try:
+        input_data, key = await _off_loop(_decode_calculation, await request.body(), options)
+    except RequestValidationError:
+        _record('calculate', 422, started)
+        raise
+    try:
+        entities = _entities(input_data)
+    except HTTPException:
+        _record('calculate', 404, started)
+        raise
+    parsed = time.perf_counter() - started
+    stats: Optional[CalculationStats] = None
+
+    async def compute() -> bytes:
+        nonlocal stats
+        # calcula e serializa fora do event loop quando o payload é grande
+        content, stats = await executor.run(entities, input_data.formulas, options)
+        return content
+
+    try:
+        content = await result_cache.get_or_compute(key, compute)
+    except ExecutorBusy:
+        _record('calculate', 503, started)
+        raise HTTPException(status_code=503, detail="Calculation queue is full", headers={"Retry-After": "1"})
+    except asyncio.TimeoutError:
+        _record('calculate', 504, started)
+        raise HTTPException(status_code=504, detail="Calculation timed out")
+    except SnapshotNotFound as e:
+        # Removido entre a validação e o cálculo
+        _record('calculate', 404, started)
+        raise HTTPException(status_code=404, detail=f"Snapshot '{e.args[0]}' not found")
+    except FormulaCycleError as e:
+        _record('calculate', 422, started)
+        raise HTTPException(status_code=422, detail=str(e))
+    except Exception:
+        _record('calculate', 500, started)
+        raise
+
+    # Sem stats o resultado veio do cache (ou de um cálculo idêntico em andamento)
+    cache = 'hit' if stats is None else 'miss'
+    if stats is None:
+        stats = CalculationStats()
+    else:
+        metrics.record_calculation(stats)
+    stats.add_time('parse', parsed)
+    headers = {"Vary": "Accept-Encoding"}
+    if 0 < config.GZIP_MIN_SIZE <= len(content) and accepts_gzip(request.headers.get('accept-encoding')):
+        compress_started = time.perf_counter()
+        content = await asyncio.to_thread(gzip_encode, content, config.GZIP_LEVEL)
+        stats.add_time('compress', time.perf_counter() - compress_started)
+        headers["Content-Encoding"] = "gzip"
+    total = _record('calculate', 200, started, cache)
+    if metrics.enabled:
+        headers["Server-Timing"] = stats.server_timing(total, cache)
+    return Response(content=content, media_type="application/json", headers=headers)
+
+
+async def _off_loop(fn: Callable[..., T], body: bytes, *args: Any) -> T:
+    """
+    `fn(body, *args)` numa thread quando o corpo é grande, para que a
+    validação e o hash de um payload enorme não segurem o event loop.
+    """
+    if len(body) <= config.DECODE_INLINE_MAX_BYTES:
+        return fn(body, *args)
+    return await asyncio.to_thread(fn, body, *args)
+
+
+def _decode_calculation(body: bytes, options: OutputOptions) -> Tuple[CalculationInput, str]:
+    """Corpo de /calculate decodificado e a chave de cache do resultado pedido."""
+    input_data = decode_input(body)
+    if not result_cache.enabled:
+        return input_data, ''
+    payload = input_data.payload if options.is_default else {**input_data.payload, 'output': options.key()}
+    return input_data, cache_key(payload)
+
+
+def _output_options(fields: Optional[str], failed_only: bool, skip_resolved: bool, output_format: str) -> OutputOptions:
+    columnar = output_format == 'columnar'
+    selected = [field.strip() for field in fields.split(',') if field.strip()] if fields else None
+    if skip_resolved:
+        default = COLUMNAR_FIELDS if columnar else RESULT_FIELDS
+        selected = [field for field in selected or default if field != 'resolved_formula']
+    try:
+        return OutputOptions(selected, failed_only, columnar)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+def _entities(input_data: CalculationInput) -> Union[List[EntityRecord], SnapshotInfo]:
+    """Entidades da requisição, ou o snapshot de entities_ref (404 se não existir)."""
+    if input_data.entities_ref is None:
+        return input_data.entities
+    info = snapshots.info(input_data.entities_ref)
+    if info is None:
+        raise HTTPException(status_code=404, detail=f"Snapshot '{input_data.entities_ref}' not found")
+    return info
+
+
+def _record(endpoint: str, status: int, started: float, cache: Optional[str] = None) -> float:
+    elapsed = time.perf_counter() - started
+    metrics.record_request(endpoint, status, elapsed, cache)
+    return elapsed
+
+
+def _ndjson_lines(input_data: CalculationInput, started: float) -> Iterator[bytes]:
+    entities = input_data.entities
+    if input_data.entities_ref is not None:
+        entities = snapshots.load(input_data.entities_ref)
+        if entities is None:
+            _record('calculate_stream', 200, started)
+            yield dumps({"error": f"Snapshot '{input_data.entities_ref}' not found"}) + b"\n"
+            return
+    processor = FormulaProcessor(entities)
+    try:
+        for result in processor.iter_results(input_data.formulas):
+            yield dumps(encode_result(result)) + b"\n"
+    except Exception as e:
+        yield dumps({"error": str(e)}) + b"\n"
+        return
+    finally:
+        metrics.record_calculation(processor.stats)
+        _record('calculate_stream', 200, started)
+    yield dumps({"aggregated_entities": processor.aggregated_entities()}) + b"\n"
+
+
+@router.post(
+    "/calculate/stream",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"application/x-ndjson": {}}}},
+    openapi_extra=INPUT_BODY
+)
+async def calculate_stream(request: Request):
+    """
+    Mesmo cálculo de /calculate, em NDJSON: uma linha por FormulaResult,
+    enviada assim que a fórmula é calculada, e uma última linha com
+    `aggregated_entities` (ou `error`, se o cálculo falhar no meio).
+    """
+    started = time.perf_counter()
+    try:
+        input_data = await _off_loop(decode_input, await request.body())
+    except RequestValidationError:
+        _record('calculate_stream', 422, started)
+        raise
+    try:
+        # Um ciclo entre as fórmulas é recusado antes de abrir o stream
+        plan_formulas(input_data.formulas)
+    except FormulaCycleError as e:
+        _record('calculate_stream', 422, started)
+        raise HTTPException(status_code=422, detail=str(e))
+    try:
+        _entities(input_data)
+    except HTTPException:
+        _record('calculate_stream', 404, started)
+        raise
+    return StreamingResponse(_ndjson_lines(input_data, started), media_type="application/x-ndjson")
+
+
+def _get_session(session_id: str) -> CalculationSession:
+    session = sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Session '{session_id}' not found")
+    return session
+
+
+@router.post(
+    "/sessions",
+    response_model=SessionOutput,
+    response_model_exclude_none=True,
+    status_code=201
+)
+def create_session(input_data: InputData):
+    """Carrega entidades e fórmulas para recálculo incremental e devolve o cálculo completo."""
+    try:
+        session_id, session = sessions.create(input_data.entities, input_data.formulas)
+    except FormulaCycleError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    with session.lock:
+        direct_results, aggregated_entities = session.results()
+    return SessionOutput(
+        session_id=session_id,
+        direct_results=direct_results,
+        aggregated_entities=aggregated_entities
+    )
+
+
+@router.get(
+    "/sessions/{session_id}",
+    response_model=SessionOutput,
+    response_model_exclude_none=True
+)
+def get_session(session_id: str):
+    session = _get_session(session_id)
+    with session.lock:
+        direct_results, aggregated_entities = session.results()
+    return SessionOutput(
+        session_id=session_id,
+        direct_results=direct_results,
+        aggregated_entities=aggregated_entities
+    )
+
+
+@router.patch(
+    "/sessions/{session_id}",
+    response_model=SessionOutput,
     response_model_exclude_none=True
 )
-async def calculate(input_data: InputData):
-    processor = FormulaProcessor(input_data.entities)
-    # gera direct_results e aggregated_outputs internamente
-    processor.process(input_data.formulas)
-    # formata para o shape enxuto que você quer
-    return OutputData(
-        direct_results=processor.summarize(),
-        aggregated_entities=processor.get_aggregated_output()
+def patch_session(session_id: str, patch: SessionPatch):
+    """Altera atributos e devolve só os resultados e entidades afetados pelas alterações."""
+    session = _get_session(session_id)
+    with session.lock:
+        try:
+            direct_results, aggregated_entities = session.apply(patch.changes)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+    return SessionOutput(
+        session_id=session_id,
+        direct_results=direct_results,
+        aggregated_entities=aggregated_entities
     )
+
+
+@router.delete("/sessions/{session_id}", status_code=204)
+def delete_session(session_id: str):
+    if not sessions.delete(session_id):
+        raise HTTPException(status_code=404, detail=f"Session '{session_id}' not found")
+
+
+def _get_snapshot(entities_ref: str) -> SnapshotInfo:
+    info = snapshots.info(entities_ref)
+    if info is None:
+        raise HTTPException(status_code=404, detail=f"Snapshot '{entities_ref}' not found")
+    return info
+
+
+@router.post(
+    "/snapshots",
+    response_model=SnapshotOutput,
+    status_code=201,
+    openapi_extra=SNAPSHOT_BODY
+)
+async def create_snapshot(request: Request):
+    """
+    Grava um conjunto de entidades e devolve `entities_ref`, o hash do
+    conteúdo, que pode ser usado no lugar de `entities` em /calculate e
+    /calculate/stream. Enviar as mesmas entidades de novo devolve o mesmo hash.
+    Snapshots usados há mais tempo podem ser apagados para respeitar
+    SNAPSHOT_MAX_BYTES.
+    """
+    input_data = await _off_loop(decode_entities, await request.body())
+    try:
+        info = await asyncio.to_thread(snapshots.put, input_data.entities, input_data.payload['entities'])
+    except SnapshotTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    return info.to_dict()
+
+
+@router.get("/snapshots/{entities_ref}", response_model=SnapshotOutput)
+def get_snapshot(entities_ref: str):
+    return _get_snapshot(entities_ref).to_dict()
+
+
+@router.delete("/snapshots/{entities_ref}", status_code=204)
+def delete_snapshot(entities_ref: str):
+    if not snapshots.delete(entities_ref):
+        raise HTTPException(status_code=404, detail=f"Snapshot '{entities_ref}' not found")
@@ -0,0 +1,14 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from app.services.executor import executor
+from app.services.metrics import metrics
+
+router = APIRouter()
+
+
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def get_metrics():
+    """Métricas no formato texto do Prometheus."""
+    gauges = [('executor_pending', executor.pending, "Calculations running outside the event loop")]
+    return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
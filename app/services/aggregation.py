@@ -0,0 +1,238 @@
+import math
+from collections import deque
+from functools import reduce
+from itertools import count
+from operator import add, itemgetter
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+# Todo float finito é múltiplo inteiro de 2**-1074: somas escaladas por 2**1074
+# são exatas em int
+_SCALE_BITS = 1074
+
+
+def _sum(values: Iterable[float]) -> float:
+    return reduce(add, values, 0.0)
+
+
+def _count(values: Iterable[float]) -> float:
+    counter = count()
+    deque(zip(values, counter), maxlen=0)
+    return float(next(counter))
+
+
+def _average(values: Iterable[float]) -> float:
+    counter = count()
+    total = reduce(add, map(itemgetter(0), zip(values, counter)), 0.0)
+    n = next(counter)
+    return total / n if n else 0.0
+
+
+def _max(values: Iterable[float]) -> float:
+    best = max(values, default=None)
+    return 0.0 if best is None else float(best)
+
+
+def _min(values: Iterable[float]) -> float:
+    best = min(values, default=None)
+    return 0.0 if best is None else float(best)
+
+
+# Redução de um grupo inteiro numa passada, consumindo o iterador em C: o
+# mesmo resultado de sum/len/max/min sobre a lista dos valores, sem montá-la.
+# SUM soma da esquerda para a direita, como sum() até o Python 3.11; grupos
+# vazios resultam em 0.0
+REDUCERS: Dict[str, Callable[[Iterable[float]], float]] = {
+    'SUM': _sum, 'AVG': _average, 'COUNT': _count, 'MAX': _max, 'MIN': _min,
+}
+
+
+def reduce_group(fn: str, values: Iterable[float]) -> float:
+    """Agregação de um único grupo, consumindo `values` uma vez."""
+    reducer = REDUCERS.get(fn)
+    return reducer(values) if reducer is not None else 0.0
+
+
+class GroupReduction:
+    """
+    Resultados de uma agregação, um por grupo, na ordem em que os grupos são
+    adicionados. Grupos com menos de `columnar_min_rows` valores (ou todos,
+    com 0) são reduzidos em fluxo por REDUCERS; os maiores vão para
+    AggregationColumns e são reduzidos juntos por segment_reduce em
+    results(), guardando os valores na memória. Os dois caminhos dão o
+    mesmo resultado.
+    """
+    __slots__ = ('fn', 'reducer', 'columnar_min_rows', 'values', 'columnar', 'columns')
+
+    def __init__(self, fn: str, columnar_min_rows: int = 0):
+        self.fn = fn
+        self.reducer = REDUCERS.get(fn)
+        self.columnar_min_rows = columnar_min_rows
+        self.values: List[float] = []
+        # Posição em `values` de cada grupo guardado nas colunas
+        self.columnar: List[int] = []
+        self.columns = AggregationColumns(0)
+
+    def add(self, values: Iterable[float], size: int) -> None:
+        """Reduz um grupo de `size` valores (só o limite depende de `size`)."""
+        if self.columnar_min_rows and size >= self.columnar_min_rows:
+            self.columns.extend(len(self.columnar), list(values))
+            self.columnar.append(len(self.values))
+            self.values.append(0.0)
+        else:
+            self.values.append(self.reducer(values) if self.reducer is not None else 0.0)
+
+    def results(self) -> List[float]:
+        if self.columnar:
+            self.columns.n_segments = len(self.columnar)
+            for position, value in zip(self.columnar, self.columns.reduce(self.fn)):
+                self.values[position] = value
+            self.columnar = []
+        return self.values
+
+
+class AggregationColumns:
+    """
+    Colunas de uma agregação agrupada: `segments[i]` é o índice do grupo
+    (pai) ao qual o valor `values[i]` pertence, na ordem em que os valores
+    foram encontrados.
+    """
+    __slots__ = ('segments', 'values', 'n_segments')
+
+    def __init__(self, n_segments: int):
+        self.segments: List[int] = []
+        self.values: List[float] = []
+        self.n_segments = n_segments
+
+    def add(self, segment: int, value: float) -> None:
+        self.segments.append(segment)
+        self.values.append(value)
+
+    def extend(self, segment: int, values: Sequence[float]) -> None:
+        self.segments.extend([segment] * len(values))
+        self.values.extend(values)
+
+    def reduce(self, fn: str) -> List[float]:
+        return segment_reduce(
+            fn,
+            np.asarray(self.segments, dtype=np.intp),
+            np.asarray(self.values, dtype=np.float64),
+            self.n_segments
+        ).tolist()
+
+
+def segment_reduce(fn: str, segments: np.ndarray, values: np.ndarray, n_segments: int) -> np.ndarray:
+    """
+    Aplica `fn` a cada grupo de uma vez.
+
+    `segments` deve estar em ordem não decrescente. Grupos vazios resultam em
+    0.0, e os resultados são idênticos aos de REDUCERS sobre os valores de
+    cada grupo.
+    """
+    counts = np.bincount(segments, minlength=n_segments)
+    if fn == 'COUNT':
+        return counts.astype(np.float64)
+    if fn in ('SUM', 'AVG'):
+        # bincount acumula na ordem de entrada, como a soma da esquerda para a direita
+        sums = np.bincount(segments, weights=values, minlength=n_segments)
+        if fn == 'SUM':
+            return sums
+        out = np.zeros(n_segments, dtype=np.float64)
+        np.divide(sums, counts, out=out, where=counts > 0)
+        return out
+    if fn in ('MAX', 'MIN'):
+        out = np.zeros(n_segments, dtype=np.float64)
+        filled = np.flatnonzero(counts)
+        if not len(filled):
+            return out
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[filled]
+        ufunc = np.maximum if fn == 'MAX' else np.minimum
+        out[filled] = ufunc.reduceat(values, starts)
+        # NaN e -0.0 dependem da ordem em max()/min(); esses grupos são refeitos em Python
+        odd = np.isnan(values) | ((values == 0) & np.signbit(values))
+        if odd.any():
+            builtin = max if fn == 'MAX' else min
+            for seg in np.unique(segments[odd]):
+                out[seg] = builtin(values[segments == seg].tolist())
+        return out
+    return np.zeros(n_segments, dtype=np.float64)
+
+
+
+class Accumulator:
+    """
+    Estado parcial de uma agregação (SUM, AVG, COUNT, MAX, MIN) que pode ser
+    alimentado em pedaços e juntado a outros estados.
+
+    merge() é exato: um grupo dividido em pedaços, cada um consumido num
+    estado à parte e juntados na ordem, dá o mesmo resultado que o grupo
+    inteiro num só estado. Para isso SUM e AVG guardam a soma exata (inteiro
+    escalado) e arredondam uma vez em result(), como math.fsum; o resultado
+    pode diferir no último dígito da soma da esquerda para a direita de
+    REDUCERS. MAX e MIN seguem max()/min() sobre a lista, inclusive com NaN.
+    """
+    __slots__ = ('fn', 'count', 'exact', 'special', 'best', 'first_nan')
+
+    def __init__(self, fn: str):
+        self.fn = fn
+        self.count = 0
+        self.exact = 0
+        # Soma dos valores infinitos ou NaN, que ficam fora da soma exata
+        self.special = 0.0
+        self.best: Optional[float] = None
+        # max()/min() devolvem NaN só quando ele é o primeiro valor; depois
+        # disso NaN nunca vence uma comparação
+        self.first_nan = False
+
+    def add(self, value: float) -> None:
+        if self.fn in ('SUM', 'AVG'):
+            if math.isfinite(value):
+                numerator, denominator = float(value).as_integer_ratio()
+                self.exact += numerator << (_SCALE_BITS + 1 - denominator.bit_length())
+            else:
+                self.special += value
+        elif self.fn in ('MAX', 'MIN'):
+            if value != value:
+                self.first_nan = self.first_nan or not self.count
+            elif self.best is None or (value > self.best if self.fn == 'MAX' else value < self.best):
+                self.best = value
+        self.count += 1
+
+    def consume(self, values: Iterable[float]) -> 'Accumulator':
+        for value in values:
+            self.add(value)
+        return self
+
+    def merge(self, other: 'Accumulator') -> 'Accumulator':
+        """Junta `other`, com os valores que vêm depois dos deste estado."""
+        if not self.count:
+            self.first_nan = other.first_nan
+        self.count += other.count
+        self.exact += other.exact
+        self.special += other.special
+        if other.best is not None and (
+            self.best is None or (other.best > self.best if self.fn == 'MAX' else other.best < self.best)
+        ):
+            self.best = other.best
+        return self
+
+    def result(self) -> float:
+        """Valor da agregação; grupos vazios resultam em 0.0."""
+        if self.fn == 'COUNT':
+            return float(self.count)
+        if self.fn not in REDUCERS or not self.count:
+            return 0.0
+        if self.fn in ('MAX', 'MIN'):
+            return math.nan if self.first_nan else float(self.best)
+        total = self._total()
+        return total if self.fn == 'SUM' else total / self.count
+
+    def _total(self) -> float:
+        if self.special:
+            return self.special
+        try:
+            # Divisão de inteiros com arredondamento correto
+            return self.exact / (1 << _SCALE_BITS)
+        except OverflowError:
+            return math.inf if self.exact > 0 else -math.inf
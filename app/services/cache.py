@@ -0,0 +1,191 @@
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from app import config
+from app.services.codec import dumps
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "calc:v2:"
+
+
+def cache_key(payload: Dict[str, Any]) -> str:
+    """Hash do conteúdo canônico da requisição normalizada (ordem das listas preservada)."""
+    return KEY_PREFIX + hashlib.sha256(dumps(payload, sort_keys=True)).hexdigest()
+
+
+class LocalCache:
+    """
+    LRU em memória com TTL, limitado a `max_entries` itens e a `max_bytes`
+    somando os valores. Um valor maior que um quarto de `max_bytes` não é
+    guardado, para que uma única resposta enorme não esvazie o cache.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600.0, max_bytes: int = 256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items: 'OrderedDict[str, Tuple[float, bytes]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def accepts(self, value: bytes) -> bool:
+        return len(value) <= self.max_bytes // 4
+
+    async def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._items[key]
+                self.size -= len(value)
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    async def set(self, key: str, value: bytes) -> None:
+        if not self.accepts(value):
+            return
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[1])
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self.size += len(value)
+            while len(self._items) > self.max_entries or self.size > self.max_bytes:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class RedisCache:
+    """
+    Redis como backend principal; se ele estiver indisponível, usa o
+    `fallback` local sem falhar a requisição. Depois de uma falha o Redis só
+    é tentado de novo após `retry_after` segundos, dobrando a cada nova falha
+    até `max_retry_after`. A remoção por tamanho fica a cargo do
+    maxmemory-policy do próprio Redis; valores que o `fallback` recusaria por
+    tamanho também não são enviados.
+    """
+
+    def __init__(self, client: Any, fallback: LocalCache, ttl: float = 3600.0, retry_after: float = 1.0,
+                 max_retry_after: float = 60.0):
+        self.client = client
+        self.fallback = fallback
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self.max_retry_after = max_retry_after
+        self._backoff = 0.0
+        self._down_until = 0.0
+
+    def _available(self) -> bool:
+        return not self._backoff or time.monotonic() >= self._down_until
+
+    def _failed(self, error: Exception) -> None:
+        if not self._backoff:
+            logger.warning("Redis unavailable, using in-process cache: %s", error)
+        self._backoff = min(self._backoff * 2, self.max_retry_after) if self._backoff else self.retry_after
+        self._down_until = time.monotonic() + self._backoff
+
+    def _recovered(self) -> None:
+        if self._backoff:
+            logger.info("Redis available again")
+            self._backoff = 0.0
+
+    async def get(self, key: str) -> Optional[bytes]:
+        if self._available():
+            try:
+                value = await self.client.get(key)
+            except Exception as e:
+                self._failed(e)
+            else:
+                self._recovered()
+                return value
+        return await self.fallback.get(key)
+
+    async def set(self, key: str, value: bytes) -> None:
+        if not self.fallback.accepts(value):
+            return
+        if self._available():
+            try:
+                await self.client.set(key, value, ex=int(self.ttl))
+            except Exception as e:
+                self._failed(e)
+            else:
+                self._recovered()
+                return
+        await self.fallback.set(key, value)
+
+
+class ResultCache:
+    """
+    Cache de resultados de /calculate endereçado pelo conteúdo da requisição.
+    Os valores são as respostas já serializadas.
+
+    Requisições idênticas simultâneas são agrupadas: só a primeira calcula,
+    as demais aguardam o mesmo resultado.
+    """
+
+    def __init__(self, backend: Any, enabled: bool = True):
+        self.backend = backend
+        self.enabled = enabled
+        self._inflight: Dict[str, 'asyncio.Future[bytes]'] = {}
+
+    @classmethod
+    def from_config(cls) -> 'ResultCache':
+        local = LocalCache(max_entries=config.CACHE_MAX_ENTRIES, ttl=config.CACHE_TTL, max_bytes=config.CACHE_MAX_BYTES)
+        backend: Any = local
+        if config.REDIS_URL:
+            try:
+                import redis.asyncio as redis
+                client = redis.Redis.from_url(
+                    config.REDIS_URL, socket_timeout=config.REDIS_TIMEOUT, socket_connect_timeout=config.REDIS_TIMEOUT
+                )
+                backend = RedisCache(client, local, ttl=config.CACHE_TTL)
+            except ImportError:
+                logger.warning("redis package not installed, using in-process cache")
+        return cls(backend, enabled=config.CACHE_ENABLED)
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[bytes]]) -> bytes:
+        """Valor em cache para `key` ou o resultado de `compute()`."""
+        if not self.enabled:
+            return await compute()
+        while True:
+            waiting = self._inflight.get(key)
+            if waiting is None:
+                break
+            try:
+                return await asyncio.shield(waiting)
+            except asyncio.CancelledError:
+                # Se quem foi cancelado é a requisição que calculava, e não
+                # esta, o cálculo é retomado aqui (ou por outra que chegou antes)
+                if not waiting.cancelled() or asyncio.current_task().cancelling():
+                    raise
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await self.backend.get(key)
+            if value is None:
+                value = await compute()
+                await self.backend.set(key, value)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Evita "exception was never retrieved" quando ninguém mais aguardava
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+
+result_cache = ResultCache.from_config()
@@ -1,251 +1,433 @@
-from typing import List, Dict, Any
-from asteval import Interpreter
-import re
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Callable, Iterator, Optional, Tuple, Union
+
+from app import config
+from app.models.schemas import EntityInput, EntityOutput
+from app.services.aggregation import GroupReduction, reduce_group
+from app.services.entity_store import EntityRecord, EntityStore
+from app.services.expression import REFERENCE_PATTERN, CompiledFormula, ResolvedFormula, compile_formula
+from app.services.metrics import CalculationStats
+from app.services.results import ComputedRef, ResultRow, ResultStore, ResultView
+from app.services.planner import (
+    AGG_PATTERN, AGG_REF_PATTERN, Aggregation, FormulaNode, Source, plan_formulas, traversal_groups
+)
+from app.services.vectorized import VECTORIZE_MIN_ROWS, evaluate_batch
+
+
+# Fase de CalculationStats em que cada tipo de fórmula é contabilizado
+PHASE_OF_KIND = {
+    'direct': 'direct',
+    'aggregation': 'aggregation',
+    'ref_aggregation': 'aggregation',
+    'derived': 'derived',
+}
+
+
+class FormulaOutput:
+    """Resultados de uma fórmula, publicados no processador só quando ela termina."""
+    __slots__ = ('rows', 'computed', 'errors', 'seconds')
+
+    def __init__(self):
+        self.rows: List[ResultRow] = []
+        # Linhas que também são atributos calculados: (posição em rows, saída nomeada)
+        self.computed: List[Tuple[int, Optional[str]]] = []
+        self.errors = 0
+        self.seconds = 0.0
+
+
+# Saída de uma fórmula de um grupo, ou o erro que interrompeu o cálculo dela
+GroupResult = Union[FormulaOutput, Exception]
 
-from app.models.schemas import EntityInput, EntityOutput, ComputedAttribute
-from app.utils.helpers import get_attribute_value
 
 class FormulaProcessor:
     """
     Processa fórmulas diretas e agregações (SUM, AVG, COUNT, MAX, MIN) em entidades.
     """
-    AGG_PATTERN = re.compile(
-            r"^(?P<fn>SUM|AVG|COUNT|MAX|MIN)\("
-            r"(?P<prefix>[A-Za-z0-9_]+\.[A-Za-z0-9_]+)\.(?P<left>\w+)\s*\*\s*"
-            r"(?P=prefix)\.(?P<right_path>[A-Za-z0-9_]+(?:\.[A-Za-z0-9_]+)*)"
-            r"\)$"
-        )
-    AGG_REF_PATTERN = re.compile(
-        r"^(?P<fn>SUM|AVG|COUNT|MAX|MIN)\("
-        r"(?P<prefix>[A-Za-z0-9_]+\.[A-Za-z0-9_]+)\.(?P<left>\w+)\s*\*\s*"
-        r"@?(?P<ref_attr>\w+)\.(?P<right_attr>\w+)"
-        r"\)$"
-    )
-    DIRECT_PATTERN = re.compile(r"\b([A-Za-z]+)\.([A-Za-z_][A-Za-z0-9_]*)\b")
-
-    def __init__(self, entities: List[EntityInput]):
-        self.entities = {e.id: e for e in entities}
-        self.aeval = Interpreter()
-        for fn in ('len', 'sum', 'max', 'min'):
-            self.aeval.symtable[fn] = __builtins__[fn]
-        self.direct_results: List[Dict[str, Any]] = []
-        self.aggregated_outputs: Dict[str, EntityOutput] = {
-            e.id: EntityOutput(id=e.id, entity_type=e.entity_type, computed=[])
-            for e in entities
-        }
-
-    def _get_related_by_value(self, src_id: str, tgt_type: str) -> List[EntityInput]:
-        related = []
-        for ent in self.entities.values():
-            if tgt_type not in ent.entity_type:
-                continue
-            for attr in ent.attributes:
-                if attr.value == src_id:
-                    related.append(ent)
-                    break
-        return related
+    AGG_PATTERN = AGG_PATTERN
+    AGG_REF_PATTERN = AGG_REF_PATTERN
+    DIRECT_PATTERN = REFERENCE_PATTERN
+
+    def __init__(self, entities: Union[List[EntityInput], EntityStore], workers: Optional[int] = None):
+        self.stats = CalculationStats()
+        started = time.perf_counter()
+        # Um EntityStore pronto (snapshot) é compartilhado: o cálculo só o lê
+        self.store = entities if isinstance(entities, EntityStore) else EntityStore(entities)
+        self.entities = self.store.records
+        self.index = self.store.index
+        self.results = ResultStore()
+        # Trecho de results gravado por cada fórmula: (fórmula, início, fim)
+        self.spans: List[Tuple[str, int, int]] = []
+        # Atributos calculados por entidade, como referências às linhas de results
+        self.aggregated: Dict[str, List[ComputedRef]] = {entity_id: [] for entity_id in self.entities}
+        # Primeiro valor de cada saída por entidade: (entity_id, saída) -> valor
+        self.outputs: Dict[Tuple[str, str], Any] = {}
+        self.workers = config.FORMULA_WORKERS if workers is None else workers
+        # Em iter_results, linhas calculadas ainda não descartadas
+        self._streamed: Optional[List[int]] = None
+        self.stats.entities = len(self.entities)
+        self.stats.add_time('ingest', time.perf_counter() - started)
+
+    def _get_related_by_value(self, src_id: str, tgt_type: str) -> List[EntityRecord]:
+        # Sem lock: com FORMULA_WORKERS > 1 a contagem é aproximada
+        self.stats.lookups += 1
+        return self.index.referencing(src_id, tgt_type)
 
     def process(self, formulas: List[str]) -> None:
-        tributo_formulas = [f for f in formulas if 'TotalDosServicos' in f]
-        for formula in formulas:
-            if self.AGG_PATTERN.match(formula):
-                self._process_aggregation(formula)
-            elif self.AGG_REF_PATTERN.match(formula):
-                self._process_ref_aggregation(formula)
-            else:
-                self._process_direct(formula)
-        for formula in tributo_formulas:
-            self._process_tributo(formula)
-
-    def _process_aggregation(self, formula: str) -> None:
-        match = self.AGG_PATTERN.match(formula)
-        if not match:
+        for _ in self._run(formulas):
+            pass
+
+    def iter_results(self, formulas: List[str]) -> Iterator[Dict[str, Any]]:
+        """
+        Versão em streaming de process() + summarize(): cada resultado é
+        devolvido assim que sua fórmula termina. As linhas enviadas são
+        descartadas; ficam só as chaves de duplicados e os atributos
+        calculados, disponíveis em get_aggregated_output() ao final.
+        """
+        start = 0
+        self._streamed = []
+        # Vezes que cada fórmula ainda vai ser publicada
+        pending = Counter(formulas)
+        for node in self._run(formulas):
+            stop = len(self.results)
+            yield from ResultView(self.results, start, stop)
+            pending[node.formula] -= 1
+            if not pending[node.formula]:
+                del pending[node.formula]
+            self.results.release(stop, self._streamed, pending)
+            self._streamed.clear()
+            start = stop
+
+    def _run(self, formulas: List[str]) -> Iterator[FormulaNode]:
+        started = time.perf_counter()
+        plan = plan_formulas(formulas)
+        self.stats.formulas = len(formulas)
+        self.stats.add_time('plan', time.perf_counter() - started)
+        # Um nível só começa depois que as saídas do anterior foram publicadas
+        for level in plan:
+            for node, out in zip(level, self._run_level(level)):
+                self._publish(node, out)
+                yield node
+
+    def _run_level(self, level: List[FormulaNode]) -> Iterator[FormulaOutput]:
+        groups = traversal_groups(level)
+        if self.workers <= 1 or len(groups) == 1:
+            yield from self._in_order(level, groups, map(self._process_group, groups))
             return
-        fn = match.group('fn')
-        prefix = match.group('prefix')
-        left_attr = match.group('left')
-        right_path = match.group('right_path')
-        parent_type, child_type = prefix.split('.')
-    # Extrai os tipos de entidade da hierarquia
-        grand_type, right_attr = right_path.split('.', 1)  # Ex: ("Contract_Item_Work_Role", "Valor_por_hora")
-            
-        for parent in self.entities.values():
-            if parent_type not in parent.entity_type:
-                continue
-            aggregated_values = []
-            children = self._get_related_by_value(parent.id, child_type)
-            for child in children:
-                ref_entity = None
-                grandchildren = self._get_related_by_value(child.id, grand_type)
-                v1 = float(get_attribute_value(child, left_attr) or 0)
-                values = [v1 * float(get_attribute_value(gc, right_attr) or 0) for gc in grandchildren]
-                res = self._apply_aggregation(fn, values)
-                desc = f"{fn}({left_attr} * {right_attr})"
-                self._record_result(child.id, formula, desc, res)
-                for attr in child.attributes:
-                    candidate_entity = self.entities.get(attr.value)
-                    if candidate_entity and grand_type in candidate_entity.entity_type:
-                        ref_entity = candidate_entity
-                        break
-                if not ref_entity:
-                    continue  # Se não encontrar, pula para a próxima child
-                # Passo 2: Coleta os valores
-                try:
-                    left_val = float(get_attribute_value(child, left_attr) or 0)
-                    right_val = float(get_attribute_value(ref_entity, right_attr) or 0)
-                    aggregated_values.append(left_val * right_val)
-                except (TypeError, ValueError):
-                    continue
-                    # Passo 3: Aplica a função de agregação nos valores acumulados
-        result = self._apply_aggregation(fn, aggregated_values)
-        
-        # Passo 4: Registra o resultado no pai (Contract_Measurement)
-        desc = f"{fn}({child_type}.{left_attr} * {grand_type}.{right_attr})"
-        self._record_result(parent.id, formula, desc, result)
-        
-            
-
-    def _process_ref_aggregation(self, formula: str) -> None:
-        match = self.AGG_REF_PATTERN.match(formula)
-        if not match:
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(groups)), thread_name_prefix='formula') as pool:
+            # map devolve na ordem da requisição, independente de qual termina antes
+            yield from self._in_order(level, groups, pool.map(self._process_group, groups))
+
+    def _in_order(
+        self, level: List[FormulaNode], groups: List[List[FormulaNode]], results: Iterator[List[GroupResult]]
+    ) -> Iterator[FormulaOutput]:
+        """
+        Saídas na ordem das fórmulas do nível. O erro de uma fórmula de um
+        grupo só é levantado na vez dela, como se cada uma rodasse sozinha.
+        """
+        pending = zip(groups, results)
+        outputs: Dict[int, GroupResult] = {}
+        for node in level:
+            while node.position not in outputs:
+                group, result = next(pending)
+                outputs.update(zip((n.position for n in group), result))
+            out = outputs.pop(node.position)
+            if isinstance(out, Exception):
+                raise out
+            yield out
+
+    def _process_group(self, nodes: List[FormulaNode]) -> List[GroupResult]:
+        started = time.perf_counter()
+        outs = [FormulaOutput() for _ in nodes]
+        errors: List[Optional[Exception]] = [None] * len(nodes)
+        node = nodes[0]
+        if node.kind == 'aggregation':
+            errors = self._process_aggregations(nodes, outs)
+        elif node.kind == 'ref_aggregation':
+            errors = self._process_ref_aggregations(nodes, outs)
+        elif node.kind == 'derived':
+            self._process_derived(node, outs[0])
+        else:
+            self._process_direct(node.formula, outs[0])
+        # O tempo do grupo é dividido entre as fórmulas
+        seconds = (time.perf_counter() - started) / len(nodes)
+        for out in outs:
+            out.seconds = seconds
+        return [out if error is None else error for out, error in zip(outs, errors)]
+
+    def _publish(self, node: FormulaNode, out: FormulaOutput) -> None:
+        self.stats.add_time(PHASE_OF_KIND[node.kind], out.seconds)
+        self.stats.evaluations += len(out.rows)
+        self.stats.errors += out.errors
+        stored = self._store_rows(node, out.rows)
+        for local, output in out.computed:
+            entity_id, _, desc, value, _, _ = out.rows[local]
+            i, added = stored[local]
+            if added and self._streamed is not None:
+                self._streamed.append(i)
+            self.aggregated[entity_id].append(i if added else self.results.computed_ref(i, desc, value))
+            if output is not None:
+                self.outputs.setdefault((entity_id, output), value)
+
+    def _store_rows(self, node: FormulaNode, rows: List[ResultRow]) -> List[Tuple[int, bool]]:
+        """Grava as linhas de `node` em results; devolve o índice de cada uma e se ela é nova."""
+        start = len(self.results)
+        stored = list(map(self.results.add, rows))
+        self.spans.append((node.formula, start, len(self.results)))
+        return stored
+
+    def _process_aggregations(self, nodes: List[FormulaNode], outs: List[FormulaOutput]) -> List[Optional[Exception]]:
+        """
+        Fórmulas AGG_PATTERN com o mesmo caminho Pai.Filho.Neto numa única
+        passada: filhos e netos são buscados uma vez e os produtos de cada
+        filho vão direto para o acumulador de cada fórmula, sem formar
+        listas. Uma fórmula que falha para de ser calculada e o erro é
+        devolvido na posição dela.
+        """
+        specs = [node.aggregation for node in nodes]
+        path = specs[0]
+        errors: List[Optional[Exception]] = [None] * len(nodes)
+
+        # Um grupo por filho visitado, reduzido assim que os netos são lidos
+        child_ids: List[str] = []
+        reductions = [GroupReduction(spec.fn, config.AGGREGATION_COLUMNAR_MIN_ROWS) for spec in specs]
+        for parent in self.index.of_type(path.parent_type):
+            for child in self._get_related_by_value(parent.id, path.child_type):
+                grandchildren = self._get_related_by_value(child.id, path.grand_type)
+                for i, spec in enumerate(specs):
+                    if errors[i] is not None:
+                        continue
+                    try:
+                        products = self._iter_products(child, grandchildren, spec.left, spec.right)
+                        reductions[i].add(products, len(grandchildren))
+                    except Exception as e:
+                        errors[i] = e
+                child_ids.append(child.id)
+
+        done = [i for i, error in enumerate(errors) if error is None]
+        for i in done:
+            spec = specs[i]
+            desc = f"{spec.fn}({spec.left} * {spec.right})"
+            for child_id, res in zip(child_ids, reductions[i].results()):
+                self._record_result(outs[i], child_id, nodes[i].formula, desc, res, spec.fn)
+        self._record_last_parent([nodes[i] for i in done], [outs[i] for i in done])
+        return errors
+
+    def _record_last_parent(self, nodes: List[FormulaNode], outs: List[FormulaOutput]) -> None:
+        # Mantém o comportamento anterior: só o resultado do último pai é
+        # registrado, e na última entidade da requisição
+        if not nodes:
             return
-        fn = match.group('fn')
-        prefix = match.group('prefix')
-        left_attr = match.group('left')
-        ref_attr = match.group('ref_attr')
-        right_attr = match.group('right_attr')
-        parent_type, child_type = prefix.split('.')
-        
-        for parent in self.entities.values():
-            if parent_type not in parent.entity_type:
-                continue
-            children = self._get_related_by_value(parent.id, child_type)
-            values = []
-            for child in children:
-                left_val = get_attribute_value(child, left_attr)
-                if left_val is None:
-                    continue
-                ref_id = get_attribute_value(child, ref_attr)
-                if not ref_id:
-                    continue
-                ref_entity = self.entities.get(ref_id)
-                if not ref_entity:
-                    continue
-                right_val = get_attribute_value(ref_entity, right_attr)
-                if right_val is None:
+        results = self._last_parent_results([node.aggregation for node in nodes])
+        if results is None:
+            return
+        last_entity = next(reversed(self.entities.values()))
+        for node, out, (desc, value) in zip(nodes, outs, results):
+            self._record_result(out, last_entity.id, node.formula, desc, value, node.aggregation.fn)
+
+    def _last_parent_results(self, specs: List[Aggregation]) -> Optional[List[Tuple[str, float]]]:
+        """
+        (descrição, valor) de cada agregação AGG_PATTERN, todas com o mesmo
+        caminho, sobre o último pai, usando a entidade que cada filho
+        referencia; None sem pais.
+        """
+        path = specs[0]
+        parents = self.index.of_type(path.parent_type)
+        if not parents:
+            return None
+        pairs = [
+            (child, self._find_ref_entity(child, path.grand_type))
+            for child in self._get_related_by_value(parents[-1].id, path.child_type)
+        ]
+        results = []
+        for spec in specs:
+            products = (self._pair_product(child, ref_entity, spec.left, spec.right) for child, ref_entity in pairs)
+            desc = f"{spec.fn}({spec.child_type}.{spec.left} * {spec.grand_type}.{spec.right})"
+            results.append((desc, reduce_group(spec.fn, (p for p in products if p is not None))))
+        return results
+
+    def _process_ref_aggregations(
+        self, nodes: List[FormulaNode], outs: List[FormulaOutput]
+    ) -> List[Optional[Exception]]:
+        """
+        Fórmulas AGG_REF_PATTERN com o mesmo Pai.Filho, com os filhos de cada
+        pai buscados uma vez e os produtos consumidos em fluxo por pai. Como
+        em _process_aggregations, uma fórmula que falha para de ser calculada
+        e o erro é devolvido na posição dela.
+        """
+        specs = [node.aggregation for node in nodes]
+        path = specs[0]
+        errors: List[Optional[Exception]] = [None] * len(nodes)
+        parents = self.index.of_type(path.parent_type)
+        reductions = [GroupReduction(spec.fn, config.AGGREGATION_COLUMNAR_MIN_ROWS) for spec in specs]
+        for parent in parents:
+            children = self._get_related_by_value(parent.id, path.child_type)
+            for i, spec in enumerate(specs):
+                if errors[i] is not None:
                     continue
                 try:
-                    product = float(left_val) * float(right_val)
-                    values.append(product)
-                except (ValueError, TypeError):
-                    continue
-            res = self._apply_aggregation(fn, values)
-            desc = f"{fn}({child_type}.{left_attr} * @{ref_attr}.{right_attr})"
-            self._record_result(parent.id, formula, desc, res)
-
-    def _apply_aggregation(self, fn: str, values: List[float]) -> float:
-        if not values:
-            return 0.0
-        if fn == 'SUM':
-            return sum(values)
-        elif fn == 'AVG':
-            return sum(values) / len(values)
-        elif fn == 'COUNT':
-            return len(values)
-        elif fn == 'MAX':
-            return max(values)
-        elif fn == 'MIN':
-            return min(values)
-        else:
-            return 0.0
-
-    def _record_result(self, entity_id: str, formula: str, desc: str, result: float) -> None:
-        self.direct_results.append({
-            'entity_id': entity_id,
-            'formula': formula,
-            'resolved_formula': desc,
-            'result': float(result),
-            'result_type': 'float',
-            'success': True,
-            'error': None
-        })
-        self.aggregated_outputs[entity_id].computed.append(
-            ComputedAttribute(key=desc, value=result, description=desc)
-        )
-
-    def _process_tributo(self, formula: str) -> None:
-        for contract in self.entities.values():
-            if 'Contract' not in contract.entity_type:
+                    products = self._products_by_ref(children, spec.left, spec.ref_attr, spec.right)
+                    reductions[i].add(products, len(children))
+                except Exception as e:
+                    errors[i] = e
+        for i in (i for i, error in enumerate(errors) if error is None):
+            spec = specs[i]
+            desc = f"{spec.fn}({spec.child_type}.{spec.left} * @{spec.ref_attr}.{spec.right})"
+            for parent, res in zip(parents, reductions[i].results()):
+                self._record_result(outs[i], parent.id, nodes[i].formula, desc, res, spec.fn)
+        return errors
+
+    def _iter_products(
+        self, child: EntityRecord, grandchildren: List[EntityRecord], left_attr: str, right_attr: str
+    ) -> Iterator[float]:
+        # O atributo do filho é lido já aqui, para falhar mesmo sem netos
+        v1 = float(child.get(left_attr) or 0)
+        return (v1 * float(gc.get(right_attr) or 0) for gc in grandchildren)
+
+    def _find_ref_entity(self, child: EntityRecord, grand_type: str) -> Optional[EntityRecord]:
+        for value in child.refs:
+            candidate_entity = self.entities.get(value)
+            if candidate_entity and grand_type in candidate_entity.entity_type:
+                return candidate_entity
+        return None
+
+    def _pair_product(
+        self, child: EntityRecord, ref_entity: Optional[EntityRecord], left_attr: str, right_attr: str
+    ) -> Optional[float]:
+        if not ref_entity:
+            return None  # Se não encontrar, pula para a próxima child
+        try:
+            left_val = float(child.get(left_attr) or 0)
+            right_val = float(ref_entity.get(right_attr) or 0)
+            return left_val * right_val
+        except (TypeError, ValueError):
+            return None
+
+    def _products_by_ref(
+        self, children: List[EntityRecord], left_attr: str, ref_attr: str, right_attr: str
+    ) -> Iterator[float]:
+        for child in children:
+            left_val = child.get(left_attr)
+            if left_val is None:
+                continue
+            ref_id = child.get(ref_attr)
+            if not ref_id:
+                continue
+            ref_entity = self.entities.get(ref_id)
+            if not ref_entity:
+                continue
+            right_val = ref_entity.get(right_attr)
+            if right_val is None:
                 continue
-            services = self._get_related_by_value(contract.id, 'Servico')
-            total = sum(
-                next((c.value for c in self.aggregated_outputs[s.id].computed if c.key.startswith('SUM')), 0.0)
-                for s in services
-            )
-            iss = float(get_attribute_value(contract, 'ISS') or 0)
-            trib = iss * total
-            desc = f"ISS ({iss}) * TotalDosServicos ({total})"
-            self._record_result(contract.id, formula, desc, trib)
-
-    # _process_direct, summarize, get_aggregated_output mantidos sem alterações
-
-    def _process_direct(self, formula: str) -> None:
+            try:
+                product = float(left_val) * float(right_val)
+            except (ValueError, TypeError):
+                continue
+            yield product
+
+    def _record_result(
+        self, out: FormulaOutput, entity_id: str, formula: str, desc: str, result: float, output: Optional[str] = None
+    ) -> None:
+        out.computed.append((len(out.rows), output))
+        out.rows.append((entity_id, formula, desc, float(result), 'float', None))
+
+    def _process_derived(self, node: FormulaNode, out: FormulaOutput) -> None:
+        for entity_type in node.scope:
+            plan = compile_formula(node.expression, entity_type, tuple(node.symbols))
+            for entity in self.index.of_type(entity_type):
+                desc, result, result_type, error = self._derive(node, plan, entity, self._output)
+                if error is None:
+                    out.computed.append((len(out.rows), node.name))
+                else:
+                    out.errors += 1
+                out.rows.append((entity.id, node.formula, desc, result, result_type, error))
+
+    def _derive(
+        self, node: FormulaNode, plan: CompiledFormula, entity: EntityRecord, output: Callable[[str, str], Any]
+    ) -> Tuple[str, Any, Optional[str], Optional[str]]:
+        """
+        Avalia uma fórmula derivada em `entity`: (descrição, resultado, tipo,
+        erro). Cada nome recebe a saída de outra fórmula via `output`. As que
+        leem um total de TOTALS seguem o cálculo do tributo (atributos lidos
+        como números, resultado float, descrição "ISS (0.05) *
+        TotalDosServicos (120.0)"); as demais são avaliadas e renderizadas
+        como uma fórmula direta.
+        """
+        if node.uses_totals:
+            values = tuple(float(entity.get(attr) or 0) for attr in plan.attrs)
+        else:
+            values = tuple(entity.get(attr) for attr in plan.attrs)
+        values += tuple(self._symbol_value(entity, node.symbols[name], output) for name in plan.names)
+        desc = plan.describe(values) if node.uses_totals else plan.render(values)
+        try:
+            result = plan.evaluate(values)
+            if node.uses_totals:
+                result = float(result)
+        except Exception as e:
+            return desc, None, None, str(e)
+        return desc, float(result) if isinstance(result, (int, float)) else result, type(result).__name__, None
+
+    def _output(self, entity_id: str, name: str) -> Any:
+        return self.outputs.get((entity_id, name), 0.0)
+
+    def _symbol_value(self, entity: EntityRecord, source: Source, output: Callable[[str, str], Any]) -> Any:
+        member_type, name = source
+        if member_type is None:
+            return output(entity.id, name)
+        return sum(output(member.id, name) for member in self._get_related_by_value(entity.id, member_type))
+
+    def _process_direct(self, formula: str, out: FormulaOutput) -> None:
         refs = self.DIRECT_PATTERN.findall(formula)
-        for entity_type, _ in set(refs):
-            for entity in self.entities.values():
-                if entity_type not in entity.entity_type:
+        for entity_type in dict.fromkeys(etype for etype, _ in refs):
+            # Fórmula compilada uma vez por tipo; os valores são ligados por entidade
+            plan = compile_formula(formula, entity_type)
+            entities = self.index.of_type(entity_type)
+            rows = [tuple(entity.get(attr) for attr in plan.attrs) for entity in entities]
+            batch = evaluate_batch(plan, rows) if len(rows) >= VECTORIZE_MIN_ROWS else None
+            if batch is not None:
+                results = batch.values.tolist()
+                is_int = batch.is_int.tolist()
+                ok = batch.ok.tolist()
+            for i, (entity, values) in enumerate(zip(entities, rows)):
+                resolved = ResolvedFormula(plan, values)
+                if batch is not None and ok[i]:
+                    self._record_direct(out, entity.id, formula, resolved, results[i], 'int' if is_int[i] else 'float')
                     continue
-                resolved = formula
-                for etype, attr in refs:
-                    if etype != entity_type:
-                        continue
-                    val = get_attribute_value(entity, attr)
-                    token = f'"{val}"' if isinstance(val, str) else str(val)
-                    resolved = resolved.replace(f"{etype}.{attr}", token)
                 try:
-                    res = eval(resolved)
-                    self.direct_results.append({
-                        'entity_id': entity.id,
-                        'formula': formula,
-                        'resolved_formula': resolved,
-                        'result': float(res) if isinstance(res, (int, float)) else res,
-                        'result_type': type(res).__name__,
-                        'success': True,
-                        'error': None
-                    })
+                    res = plan.evaluate(values)
                 except Exception as e:
-                    self.direct_results.append({
-                        'entity_id': entity.id,
-                        'formula': formula,
-                        'resolved_formula': resolved,
-                        'result': None,
-                        'result_type': None,
-                        'success': False,
-                        'error': str(e)
-                    })
-
-    def summarize(self) -> List[Dict[str, Any]]:
-        seen = set()
-        summary = []
-        for res in self.direct_results:
-            key = (res['entity_id'], res['formula'], res['resolved_formula'])
-            if key in seen:
-                continue
-            seen.add(key)
-            val = res['result']
-            if isinstance(val, (int, float)):
-                val = float(val)
-            summary.append({
-                'entity_id': res['entity_id'],
-                'formula': res['formula'],
-                'resolved_formula': res['resolved_formula'],
-                'result': val,
-                'result_type': res.get('result_type'),
-                'error': res.get('error'),
-                'success': res.get('success', False)
-            })
-        return summary
+                    out.errors += 1
+                    out.rows.append((entity.id, formula, resolved, None, None, str(e)))
+                    continue
+                self._record_direct(
+                    out, entity.id, formula, resolved,
+                    float(res) if isinstance(res, (int, float)) else res,
+                    type(res).__name__
+                )
+
+    def _record_direct(
+        self, out: FormulaOutput, entity_id: str, formula: str, resolved: Any, result: Any, result_type: str
+    ) -> None:
+        out.rows.append((entity_id, formula, resolved, result, result_type, None))
+
+    def summarize(self) -> ResultView:
+        """Resultados sem duplicados, como dicts montados à medida que são lidos."""
+        return ResultView(self.results)
 
     def get_aggregated_output(self) -> List[EntityOutput]:
-        return [o for o in self.aggregated_outputs.values() if o.computed]
+        return [EntityOutput(**entity) for entity in self.aggregated_entities()]
+
+    def aggregated_entities(self) -> List[Dict[str, Any]]:
+        """Mesmo conteúdo de get_aggregated_output(), como dicts prontos para serializar."""
+        return [
+            {
+                'id': entity_id,
+                'entity_type': self.entities[entity_id].entity_type,
+                'computed': [
+                    {'key': desc, 'value': value, 'description': desc} for desc, value in map(self.results.computed, refs)
+                ]
+            }
+            for entity_id, refs in self.aggregated.items() if refs
+        ]
 
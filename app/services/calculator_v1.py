@@ -2,11 +2,13 @@ from asteval import Interpreter
 import re
 from typing import List, Dict, Union, Optional
 from app.models.schemas import EntityInput, EntityOutput, ComputedAttribute
+from app.services.entity_index import EntityIndex
 from app.utils.helpers import get_attribute_value, find_related_entities
 
 class FormulaProcessor:
     def __init__(self, entities: List[EntityInput]):
         self.entities = {e.id: e for e in entities}
+        self.index = EntityIndex(self.entities.values())
         self.direct_results = []
         self.aggregated_results = {}
         self.computed_values = {}
@@ -120,7 +122,8 @@ class FormulaProcessor:
                     target_type=child_type,
                     reference_attr='id',
                     all_entities=self.entities.values(),
-                    target_reference_attr='contractId'
+                    target_reference_attr='contractId',
+                    index=self.index
                 )
                 
                 for service in services:
@@ -129,7 +132,8 @@ class FormulaProcessor:
                         target_type="Medicao",
                         reference_attr='id',
                         all_entities=self.entities.values(),
-                        target_reference_attr='serviceId'
+                        target_reference_attr='serviceId',
+                        index=self.index
                     )
                     
                     service_total = sum(
@@ -154,7 +158,8 @@ class FormulaProcessor:
                         target_type="Servico",
                         reference_attr='id',
                         all_entities=self.entities.values(),
-                        target_reference_attr='contractId'
+                        target_reference_attr='contractId',
+                        index=self.index
                     )
                     
                     total_servicos = sum(
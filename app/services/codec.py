@@ -0,0 +1,437 @@
+import gzip
+import json
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from fastapi.exceptions import RequestValidationError
+
+from app.services.entity_store import EntityRecord, decode_value
+from app.services.results import ResultStore
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson é opcional
+    orjson = None
+
+_VALUE_TYPES = (str, int, float)
+
+# Campos de FormulaResult, na ordem em que saem na resposta
+RESULT_FIELDS = ('entity_id', 'formula', 'resolved_formula', 'result', 'result_type', 'error', 'success')
+# Listas do formato colunar quando os campos não são escolhidos
+COLUMNAR_FIELDS = ('entity_id', 'result', 'success')
+
+
+class _Malformed(Exception):
+    """O caminho rápido encontrou algo fora do formato esperado."""
+
+
+def dumps(obj: Any, sort_keys: bool = False) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(obj, sort_keys=sort_keys, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class CalculationInput:
+    """
+    Corpo de /calculate decodificado direto para os registros do motor.
+
+    `payload` é a forma normalizada da requisição (a mesma de InputData,
+    sem campos extras), usada como conteúdo da chave de cache. Com
+    `entities_ref` as entidades vêm de um snapshot e `entities` fica vazio.
+    """
+    __slots__ = ('entities', 'formulas', 'payload', 'entities_ref')
+
+    def __init__(
+        self, entities: List[EntityRecord], formulas: List[str], payload: Dict[str, Any],
+        entities_ref: Optional[str] = None
+    ):
+        self.entities = entities
+        self.formulas = formulas
+        self.payload = payload
+        self.entities_ref = entities_ref
+
+
+class _Errors:
+    """Erros no formato de validação do FastAPI (422), acumulados como o pydantic faz."""
+
+    def __init__(self):
+        self.items: List[Dict[str, Any]] = []
+
+    def add(self, loc: Tuple[Any, ...], type_: str, msg: str, value: Any = None) -> None:
+        self.items.append({'type': type_, 'loc': ('body',) + loc, 'msg': msg, 'input': value})
+
+    def string(self, obj: Dict[str, Any], field: str, loc: Tuple[Any, ...]) -> Any:
+        if field not in obj:
+            self.add(loc + (field,), 'missing', 'Field required', obj)
+        elif not isinstance(obj[field], str):
+            self.add(loc + (field,), 'string_type', 'Input should be a valid string', obj[field])
+        else:
+            return obj[field]
+        return None
+
+    def sequence(self, obj: Dict[str, Any], field: str, loc: Tuple[Any, ...]) -> List[Any]:
+        if field not in obj:
+            self.add(loc + (field,), 'missing', 'Field required', obj)
+        elif not isinstance(obj[field], list):
+            self.add(loc + (field,), 'list_type', 'Input should be a valid list', obj[field])
+        else:
+            return obj[field]
+        return []
+
+    def mapping(self, obj: Any, loc: Tuple[Any, ...]) -> bool:
+        if isinstance(obj, dict):
+            return True
+        self.add(loc, 'model_attributes_type', 'Input should be a valid dictionary or object to extract fields from', obj)
+        return False
+
+
+def _attribute(raw: Any, loc: Tuple[Any, ...], errors: _Errors) -> Tuple[Tuple[str, Any, str], Dict[str, Any]]:
+    if not errors.mapping(raw, loc):
+        return None, None
+    key = errors.string(raw, 'key', loc)
+    value = raw.get('value')
+    if 'value' not in raw:
+        errors.add(loc + ('value',), 'missing', 'Field required', raw)
+    elif value.__class__ is bool:
+        value = int(value)  # como Union[str, int, float] no pydantic
+    elif not isinstance(value, _VALUE_TYPES):
+        errors.add(loc + ('value',), 'union_type', 'Input should be a valid string, integer or number', value)
+    type_ = errors.string(raw, 'type', loc)
+    # Reaproveita o dict recebido quando ele já está na forma normalizada
+    same = len(raw) == 3 and value is raw.get('value')
+    return (key, value, type_), raw if same else {'key': key, 'value': value, 'type': type_}
+
+
+def _entity(raw: Any, loc: Tuple[Any, ...], errors: _Errors) -> Tuple[Optional[EntityRecord], Dict[str, Any]]:
+    if not errors.mapping(raw, loc):
+        return None, None
+    entity_id = errors.string(raw, 'id', loc)
+    entity_type = errors.sequence(raw, 'entity_type', loc)
+    for i, etype in enumerate(entity_type):
+        if not isinstance(etype, str):
+            errors.add(loc + ('entity_type', i), 'string_type', 'Input should be a valid string', etype)
+    attributes = errors.sequence(raw, 'attributes', loc)
+    decoded = [_attribute(attr, loc + ('attributes', i), errors) for i, attr in enumerate(attributes)]
+    if errors.items:
+        return None, None
+    normalized = [attr for _, attr in decoded]
+    if len(raw) != 3 or any(a is not b for a, b in zip(normalized, attributes)):
+        raw = {'id': entity_id, 'entity_type': entity_type, 'attributes': normalized}
+    return EntityRecord.from_triples(entity_id, entity_type, (triple for triple, _ in decoded)), raw
+
+
+def _decode_fast(data: Dict[str, Any]) -> CalculationInput:
+    """
+    Caminho rápido para corpos já no formato exato de InputData: os dicts
+    recebidos são usados como estão e os registros são montados num único
+    laço. Qualquer desvio levanta _Malformed.
+    """
+    entities = data['entities']
+    formulas = data['formulas']
+    if len(data) != 2 or entities.__class__ is not list or formulas.__class__ is not list:
+        raise _Malformed
+    records: List[EntityRecord] = []
+    for raw in entities:
+        entity_id = raw['id']
+        entity_type = raw['entity_type']
+        attributes = raw['attributes']
+        if (len(raw) != 3 or entity_id.__class__ is not str or entity_type.__class__ is not list
+                or attributes.__class__ is not list or any(t.__class__ is not str for t in entity_type)):
+            raise _Malformed
+        values: Dict[str, Any] = {}
+        refs = []
+        for attr in attributes:
+            key = attr['key']
+            value = attr['value']
+            type_ = attr['type']
+            if len(attr) != 3 or key.__class__ is not str or type_.__class__ is not str or value.__class__ not in _VALUE_TYPES:
+                raise _Malformed
+            if key not in values:
+                values[key] = decode_value(value, type_)
+            refs.append(value)
+        records.append(EntityRecord(entity_id, entity_type, values, tuple(refs)))
+    if any(f.__class__ is not str for f in formulas):
+        raise _Malformed
+    return CalculationInput(records, formulas, data)
+
+
+def decode_input(body: bytes) -> CalculationInput:
+    """
+    Valida o corpo JSON de uma requisição no formato de InputData sem
+    construir os modelos pydantic. Erros resultam em RequestValidationError,
+    respondida com 422 como na validação do FastAPI.
+
+    No lugar de `entities` o corpo pode trazer `entities_ref`, o hash de um
+    snapshot enviado antes (app.services.snapshots).
+    """
+    data = _parse(body)
+    if isinstance(data, dict) and 'entities_ref' in data:
+        return _decode_ref(data)
+    return _decode(data)
+
+
+def decode_entities(body: bytes) -> CalculationInput:
+    """Corpo do envio de um snapshot: só `entities`, validadas como em decode_input."""
+    data = _parse(body)
+    if isinstance(data, dict):
+        data = {k: v for k, v in data.items() if k != 'formulas'}
+        data['formulas'] = []
+    return _decode(data)
+
+
+def _parse(body: bytes) -> Any:
+    try:
+        return loads(body)
+    except ValueError as e:
+        raise RequestValidationError([{
+            'type': 'json_invalid', 'loc': ('body', getattr(e, 'pos', 0)), 'msg': 'JSON decode error', 'input': {},
+            'ctx': {'error': str(e)}
+        }])
+
+
+def _decode_ref(data: Dict[str, Any]) -> CalculationInput:
+    errors = _Errors()
+    entities_ref = errors.string(data, 'entities_ref', ())
+    if 'entities' in data:
+        errors.add(('entities',), 'value_error', 'Value error, use either entities or entities_ref', data['entities'])
+    formulas = errors.sequence(data, 'formulas', ())
+    for i, formula in enumerate(formulas):
+        if not isinstance(formula, str):
+            errors.add(('formulas', i), 'string_type', 'Input should be a valid string', formula)
+    if errors.items:
+        raise RequestValidationError(errors.items)
+    return CalculationInput([], formulas, {'entities_ref': entities_ref, 'formulas': formulas}, entities_ref)
+
+
+def _decode(data: Any) -> CalculationInput:
+    try:
+        return _decode_fast(data)
+    except (_Malformed, KeyError, TypeError):
+        pass
+
+    # Caminho completo: normaliza campos extras e reporta todos os erros
+    errors = _Errors()
+    if not errors.mapping(data, ()):
+        raise RequestValidationError(errors.items)
+    records: List[EntityRecord] = []
+    entities: List[Dict[str, Any]] = []
+    for i, raw in enumerate(errors.sequence(data, 'entities', ())):
+        record, normalized = _entity(raw, ('entities', i), errors)
+        records.append(record)
+        entities.append(normalized)
+    formulas = errors.sequence(data, 'formulas', ())
+    for i, formula in enumerate(formulas):
+        if not isinstance(formula, str):
+            errors.add(('formulas', i), 'string_type', 'Input should be a valid string', formula)
+    if errors.items:
+        raise RequestValidationError(errors.items)
+    return CalculationInput(records, formulas, {'entities': entities, 'formulas': formulas})
+
+
+def _result_value(value: Any) -> Any:
+    # FormulaResult.result aceita float, int ou str
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return str(value)
+
+
+def encode_result(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Linha de summarize() no formato de FormulaResult com exclude_none."""
+    encoded = {k: v for k, v in row.items() if v is not None}
+    if 'result' in encoded:
+        encoded['result'] = _result_value(encoded['result'])
+    return encoded
+
+
+def encode_output(direct_results: Iterable[Dict[str, Any]], aggregated_entities: List[Dict[str, Any]]) -> bytes:
+    """Resposta de /calculate (OutputData com exclude_none) serializada direto em JSON."""
+    return dumps({
+        'direct_results': [encode_result(row) for row in direct_results],
+        'aggregated_entities': aggregated_entities
+    })
+
+
+def join_output(direct_results: Iterable[bytes], aggregated_entities: Iterable[bytes]) -> bytes:
+    """
+    Mesma saída de encode_output a partir de trechos já serializados: cada
+    item é um ou mais resultados (ou entidades) separados por vírgula.
+    """
+    return b''.join((
+        b'{"direct_results":[', b','.join(direct_results),
+        b'],"aggregated_entities":[', b','.join(aggregated_entities), b']}'
+    ))
+
+
+class OutputOptions:
+    """
+    Forma da resposta de /calculate. `fields` escolhe os campos de cada
+    resultado, `failed_only` mantém só os que falharam e `columnar` agrupa
+    os resultados por fórmula: a fórmula aparece uma vez, seguida de uma
+    lista por campo, todas na mesma ordem.
+    """
+    __slots__ = ('fields', 'failed_only', 'columnar')
+
+    def __init__(self, fields: Optional[Sequence[str]] = None, failed_only: bool = False, columnar: bool = False):
+        if fields is None:
+            fields = COLUMNAR_FIELDS if columnar else RESULT_FIELDS
+        unknown = [field for field in fields if field not in RESULT_FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown result fields: {', '.join(unknown)}; expected {', '.join(RESULT_FIELDS)}")
+        # No formato colunar a fórmula já identifica o grupo
+        self.fields = tuple(f for f in RESULT_FIELDS if f in fields and not (columnar and f == 'formula'))
+        if not self.fields:
+            raise ValueError("No result fields selected")
+        self.failed_only = failed_only
+        self.columnar = columnar
+
+    @property
+    def is_default(self) -> bool:
+        return self.fields == RESULT_FIELDS and not self.failed_only and not self.columnar
+
+    def key(self) -> Dict[str, Any]:
+        """Conteúdo que entra na chave de cache junto com a requisição."""
+        return {'fields': self.fields, 'failed_only': self.failed_only, 'columnar': self.columnar}
+
+
+DEFAULT_OUTPUT = OutputOptions()
+
+
+def _output_value(value: Any) -> Any:
+    # Mesma conversão de summarize() seguida de encode_result()
+    if value is None or value.__class__ is float:
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    return _result_value(value)
+
+
+def _pick(column: List[Any], start: int, stop: int, keep: Optional[List[int]]) -> List[Any]:
+    if keep is None:
+        return column[start:stop]
+    return [column[i] for i in keep]
+
+
+def result_columns(store: ResultStore, start: int, stop: int, options: OutputOptions) -> List[List[Any]]:
+    """Uma lista por campo de `options` com as linhas `start`..`stop` de `store`, sem montar dicts."""
+    errors = store.errors
+    keep = [i for i in range(start, stop) if errors[i] is not None] if options.failed_only else None
+    columns = []
+    for field in options.fields:
+        if field == 'entity_id':
+            values = _pick(store.entity_ids, start, stop, keep)
+        elif field == 'formula':
+            values = _pick(store.formulas, start, stop, keep)
+        elif field == 'resolved_formula':
+            values = list(map(str, _pick(store.resolved, start, stop, keep)))
+        elif field == 'result':
+            values = list(map(_output_value, _pick(store.results, start, stop, keep)))
+        elif field == 'result_type':
+            values = _pick(store.result_types, start, stop, keep)
+        elif field == 'error':
+            values = _pick(errors, start, stop, keep)
+        else:
+            values = [error is None for error in _pick(errors, start, stop, keep)]
+        columns.append(values)
+    return columns
+
+
+def _rows(fields: Tuple[str, ...], columns: List[List[Any]]) -> List[Dict[str, Any]]:
+    # Como FormulaResult com exclude_none
+    return [{k: v for k, v in zip(fields, values) if v is not None} for values in zip(*columns)]
+
+
+def encode_rows(store: ResultStore, start: int, stop: int, options: OutputOptions = DEFAULT_OUTPUT) -> bytes:
+    """Linhas de `store` como trecho de lista JSON (sem colchetes), para join_output."""
+    return dumps(_rows(options.fields, result_columns(store, start, stop, options)))[1:-1]
+
+
+def encode_columns(store: ResultStore, start: int, stop: int, options: OutputOptions) -> Tuple[bytes, ...]:
+    """Um trecho de lista JSON (sem colchetes) por campo, para join_columnar."""
+    return tuple(dumps(values)[1:-1] for values in result_columns(store, start, stop, options))
+
+
+def formula_groups(spans: Iterable[Tuple[str, int, int]]) -> Dict[str, List[Tuple[int, int]]]:
+    """Trechos do ResultStore de cada fórmula, na ordem em que as fórmulas foram calculadas."""
+    groups: Dict[str, List[Tuple[int, int]]] = {}
+    for formula, start, stop in spans:
+        groups.setdefault(formula, []).append((start, stop))
+    return groups
+
+
+def encode_store_output(
+    store: ResultStore,
+    spans: Iterable[Tuple[str, int, int]],
+    aggregated_entities: List[Dict[str, Any]],
+    options: OutputOptions = DEFAULT_OUTPUT
+) -> bytes:
+    """
+    Resposta de /calculate direto das colunas do ResultStore. `spans` são
+    os trechos (fórmula, início, fim) gravados por cada fórmula.
+    """
+    if not options.columnar:
+        columns = result_columns(store, 0, len(store), options)
+        return dumps({'direct_results': _rows(options.fields, columns), 'aggregated_entities': aggregated_entities})
+    groups = formula_groups(spans)
+    direct_results = []
+    for ranges in groups.values():
+        merged = [[] for _ in options.fields]
+        for start, stop in ranges:
+            for values, part in zip(merged, result_columns(store, start, stop, options)):
+                values.extend(part)
+        direct_results.append(dict(zip(options.fields, merged)))
+    return dumps({
+        'formulas': list(groups),
+        'direct_results': direct_results,
+        'aggregated_entities': aggregated_entities
+    })
+
+
+def join_columnar(
+    fields: Sequence[str], groups: Iterable[Tuple[str, Iterable[Tuple[bytes, ...]]]], aggregated_entities: Iterable[bytes]
+) -> bytes:
+    """Mesma saída colunar de encode_store_output a partir de trechos de encode_columns por fórmula."""
+    formulas = []
+    direct_results = []
+    for formula, fragments in groups:
+        formulas.append(formula)
+        columns = [[] for _ in fields]
+        for fragment in fragments:
+            for parts, part in zip(columns, fragment):
+                if part:
+                    parts.append(part)
+        direct_results.append(b'{' + b','.join(
+            b'"' + field.encode() + b'":[' + b','.join(parts) + b']' for field, parts in zip(fields, columns)
+        ) + b'}')
+    return b''.join((
+        b'{"formulas":', dumps(formulas), b',"direct_results":[', b','.join(direct_results),
+        b'],"aggregated_entities":[', b','.join(aggregated_entities), b']}'
+    ))
+
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    """Se o cabeçalho Accept-Encoding aceita gzip (diretamente ou via `*`), respeitando q=0."""
+    if not accept_encoding:
+        return False
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name.strip().lower()] = q
+    return accepted.get('gzip', accepted.get('x-gzip', accepted.get('*', 0.0))) > 0
+
+
+def gzip_encode(content: bytes, level: int = 6) -> bytes:
+    # mtime=0 deixa a saída determinística para o mesmo conteúdo
+    return gzip.compress(content, compresslevel=level, mtime=0)
@@ -0,0 +1,62 @@
+import bisect
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from app.models.schemas import EntityInput
+
+
+def _attribute_values(entity: EntityInput) -> Iterable[Any]:
+    return (attr.value for attr in entity.attributes)
+
+
+class EntityIndex:
+    """
+    Índice reverso das entidades de uma requisição.
+
+    Construído uma única vez, mapeia (valor referenciado, tipo) para as
+    entidades que o referenciam e tipo para as entidades daquele tipo,
+    preservando a ordem original de entrada.
+    """
+
+    def __init__(
+        self,
+        entities: Iterable[EntityInput],
+        values: Optional[Callable[[Any], Iterable[Any]]] = None
+    ):
+        if values is None:
+            values = _attribute_values
+        self.position: Dict[str, int] = {}
+        self.by_type: Dict[str, List[EntityInput]] = {}
+        self.by_reference: Dict[Tuple[Any, str], List[EntityInput]] = {}
+        for pos, entity in enumerate(entities):
+            self.position.setdefault(entity.id, pos)
+            entity_types = list(dict.fromkeys(entity.entity_type))
+            for etype in entity_types:
+                self.by_type.setdefault(etype, []).append(entity)
+            seen = set()
+            for value in values(entity):
+                if value in seen:
+                    continue
+                seen.add(value)
+                for etype in entity_types:
+                    self.by_reference.setdefault((value, etype), []).append(entity)
+
+    def of_type(self, entity_type: str) -> List[EntityInput]:
+        return self.by_type.get(entity_type, [])
+
+    def referencing(self, value: Any, entity_type: str) -> List[EntityInput]:
+        """Entidades de `entity_type` com algum atributo igual a `value`."""
+        return self.by_reference.get((value, entity_type), [])
+
+    def update_references(self, entity: Any, old_values: Iterable[Any], new_values: Iterable[Any]) -> None:
+        """Atualiza as referências de `entity` após a troca de valores de atributos."""
+        old_values, new_values = set(old_values), set(new_values)
+        entity_types = list(dict.fromkeys(entity.entity_type))
+        for value in old_values - new_values:
+            for etype in entity_types:
+                related = self.by_reference.get((value, etype))
+                if related is not None:
+                    related[:] = [e for e in related if e is not entity]
+        for value in new_values - old_values:
+            for etype in entity_types:
+                related = self.by_reference.setdefault((value, etype), [])
+                bisect.insort(related, entity, key=lambda e: self.position[e.id])
@@ -0,0 +1,86 @@
+from typing import Any, Dict, Iterable, Iterator, List, Tuple, Union
+
+from app.models.schemas import Attribute, EntityInput
+from app.services.entity_index import EntityIndex
+
+
+class InvalidNumber:
+    """Valor `number` que não pôde ser convertido; o erro só é levantado ao ser lido."""
+    __slots__ = ('raw', 'message')
+
+    def __init__(self, raw: Any, message: str):
+        self.raw = raw
+        self.message = message
+
+
+def decode_value(value: Any, type_: str) -> Any:
+    if type_ != 'number' or isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value) if '.' in value else int(value)
+    except (TypeError, ValueError) as e:
+        return InvalidNumber(value, str(e))
+
+
+class EntityRecord:
+    """
+    Representação compacta de uma entidade: atributos já decodificados
+    (uma única vez, na ingestão) e acessíveis por chave.
+    """
+    __slots__ = ('id', 'entity_type', 'values', 'refs')
+
+    def __init__(self, id: str, entity_type: List[str], values: Dict[str, Any], refs: Tuple[Any, ...]):
+        self.id = id
+        self.entity_type = entity_type
+        self.values = values
+        self.refs = refs
+
+    @classmethod
+    def from_entity(cls, entity: EntityInput) -> 'EntityRecord':
+        return cls.from_attributes(entity.id, entity.entity_type, entity.attributes)
+
+    @classmethod
+    def from_attributes(cls, id: str, entity_type: List[str], attributes: Iterable[Attribute]) -> 'EntityRecord':
+        return cls.from_triples(id, entity_type, ((attr.key, attr.value, attr.type) for attr in attributes))
+
+    @classmethod
+    def from_triples(cls, id: str, entity_type: List[str], attributes: Iterable[Tuple[str, Any, str]]) -> 'EntityRecord':
+        """Registro a partir de tuplas (key, value, type), sem passar pelos modelos pydantic."""
+        values: Dict[str, Any] = {}
+        refs = []
+        for key, value, type_ in attributes:
+            # Mantém a primeira ocorrência, como get_attribute_value
+            if key not in values:
+                values[key] = decode_value(value, type_)
+            refs.append(value)
+        return cls(id, entity_type, values, tuple(refs))
+
+    def get(self, key: str) -> Any:
+        try:
+            value = self.values[key]
+        except KeyError:
+            raise ValueError(f"Attribute '{key}' not found in entity {self.id}") from None
+        if value.__class__ is InvalidNumber:
+            raise ValueError(value.message)
+        return value
+
+
+class EntityStore:
+    """
+    Entidades de uma requisição já decodificadas, com o índice reverso de
+    relacionamentos construído sobre os registros.
+    """
+
+    def __init__(self, entities: Iterable[Union[EntityInput, EntityRecord]]):
+        self.records: Dict[str, EntityRecord] = {}
+        for entity in entities:
+            # Registros já decodificados (app.services.codec) são usados como estão
+            record = entity if isinstance(entity, EntityRecord) else EntityRecord.from_entity(entity)
+            self.records[entity.id] = record
+        self.index = EntityIndex(self.records.values(), values=lambda r: r.refs)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __iter__(self) -> Iterator[EntityRecord]:
+        return iter(self.records.values())
@@ -0,0 +1,159 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, List, Optional, Sequence, Tuple, Union
+
+from app import config
+from app.models.schemas import EntityInput
+from app.services.calculator import FormulaProcessor
+from app.services.codec import DEFAULT_OUTPUT, OutputOptions, encode_store_output
+from app.services.entity_store import EntityRecord
+from app.services.metrics import CalculationStats
+from app.services.partition import partitions
+from app.services.profiler import profiler
+from app.services.snapshots import SnapshotInfo, SnapshotNotFound, snapshots
+
+BACKENDS = ('inline', 'thread', 'process')
+
+
+class ExecutorBusy(Exception):
+    """Todos os slots de execução estão ocupados."""
+
+
+# Entidades da requisição, ou o snapshot de onde carregá-las no worker
+Entities = Union[Sequence[Union[EntityInput, EntityRecord]], SnapshotInfo]
+
+
+def run_calculation(
+    entities: Entities, formulas: List[str], options: OutputOptions = DEFAULT_OUTPUT
+) -> Tuple[bytes, CalculationStats]:
+    """
+    Calcula e devolve a resposta de /calculate já serializada, na forma
+    pedida em `options`, junto com os tempos e contadores do cálculo.
+    """
+    started = time.perf_counter()
+    if isinstance(entities, SnapshotInfo):
+        ref = entities.ref
+        entities = snapshots.load(ref)
+        if entities is None:
+            raise SnapshotNotFound(ref)
+    # Leitura do snapshot (ou nada, com entidades inline) conta como ingestão
+    loaded = time.perf_counter() - started
+    with profiler.profile('calculate'):
+        partitioned = partitions.run(entities, formulas, options) if partitions.accepts(entities) else None
+        if partitioned is not None:
+            partitioned[1].add_time('ingest', loaded)
+            return partitioned
+        processor = FormulaProcessor(entities)
+        processor.process(formulas)
+        stats = processor.stats
+        stats.add_time('ingest', loaded)
+        started = time.perf_counter()
+        aggregated = processor.aggregated_entities()
+        stats.add_time('summarize', time.perf_counter() - started)
+        started = time.perf_counter()
+        content = encode_store_output(processor.results, processor.spans, aggregated, options)
+        stats.add_time('encode', time.perf_counter() - started)
+    return content, stats
+
+
+def payload_size(entities: Entities, formulas: List[str]) -> int:
+    if isinstance(entities, SnapshotInfo):
+        return entities.attributes * max(len(formulas), 1)
+    attributes = sum(len(e.refs) if isinstance(e, EntityRecord) else len(e.attributes) for e in entities)
+    return attributes * max(len(formulas), 1)
+
+
+def _warm_worker() -> None:
+    # Workers do backend process calculam em sequência, sem abrir outro pool
+    partitions.workers = 1
+    # Carrega numpy e o motor no processo antes da primeira requisição
+    run_calculation([], [])
+
+
+class CalculationExecutor:
+    """
+    Executa FormulaProcessor fora do event loop.
+
+    Payloads pequenos continuam inline; os demais vão para um pool de threads
+    ou de processos (pré-aquecidos, que mantêm o cache de fórmulas compiladas
+    entre requisições). Quando há `max_pending` cálculos em andamento, novas
+    requisições são recusadas com ExecutorBusy; a espera por cada uma é
+    limitada por `timeout` (asyncio.TimeoutError).
+    """
+
+    def __init__(
+        self,
+        backend: str = 'thread',
+        workers: int = 1,
+        timeout: float = 30.0,
+        max_pending: int = 64,
+        inline_max_size: int = 0
+    ):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown execution backend '{backend}', expected one of {BACKENDS}")
+        self.backend = backend
+        self.workers = max(workers, 1)
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.inline_max_size = inline_max_size
+        self._pool: Optional[Executor] = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls) -> 'CalculationExecutor':
+        return cls(
+            backend=config.EXECUTION_BACKEND,
+            workers=config.EXECUTION_WORKERS,
+            timeout=config.EXECUTION_TIMEOUT,
+            max_pending=config.EXECUTION_MAX_PENDING,
+            inline_max_size=config.EXECUTION_INLINE_MAX_SIZE
+        )
+
+    def start(self) -> None:
+        if self._pool is not None or self.backend == 'inline':
+            return
+        if self.backend == 'thread':
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='calculate')
+            return
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_warm_worker)
+        # Força a criação de todos os workers agora, e não na primeira requisição grande
+        for future in [self._pool.submit(_warm_worker) for _ in range(self.workers)]:
+            future.result()
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def _release(self, _future: Any = None) -> None:
+        with self._lock:
+            self._pending -= 1
+
+    async def run(
+        self, entities: Entities, formulas: List[str], options: OutputOptions = DEFAULT_OUTPUT
+    ) -> Tuple[bytes, CalculationStats]:
+        if self.backend == 'inline' or payload_size(entities, formulas) <= self.inline_max_size:
+            return run_calculation(entities, formulas, options)
+        self.start()
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise ExecutorBusy(f"{self._pending} calculations already running")
+            self._pending += 1
+        try:
+            future = self._pool.submit(run_calculation, entities, formulas, options)
+        except BaseException:
+            self._release()
+            raise
+        # O slot só é liberado quando o worker termina de fato, mesmo após timeout
+        future.add_done_callback(self._release)
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.timeout)
+
+
+executor = CalculationExecutor.from_config()
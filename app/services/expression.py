@@ -0,0 +1,251 @@
+import ast
+import copy
+import re
+from functools import lru_cache
+from typing import Any, Callable, Optional, Tuple
+
+REFERENCE_PATTERN = re.compile(r"\b([A-Za-z]+)\.([A-Za-z_][A-Za-z0-9_]*)\b")
+# `Tipo.atributo` ou um nome solto
+_TOKEN_PATTERN = re.compile(r"\b([A-Za-z]+)\.([A-Za-z_][A-Za-z0-9_]*)\b|(?<![\w.])([A-Za-z_][A-Za-z0-9_]*)\b")
+
+# Expoente máximo de `**`, que precisa ser uma constante
+MAX_EXPONENT = 64
+# Tamanho máximo dos inteiros produzidos por *, ** e <<, e das strings e listas
+# repetidas por *: acima disso a fórmula falha em vez de travar o processo
+MAX_INT_BITS = 65536
+MAX_REPEAT_LENGTH = 1_000_000
+
+
+def _check_repeat(length: int, times: int) -> None:
+    if length * times > MAX_REPEAT_LENGTH:
+        raise ValueError("Sequence result too large")
+
+
+def _mul(left: Any, right: Any) -> Any:
+    # Com um float o resultado é float (ou TypeError): sem verificação
+    if type(left) is float or type(right) is float:
+        return left * right
+    if isinstance(left, int) and isinstance(right, int):
+        if left.bit_length() + right.bit_length() > MAX_INT_BITS:
+            raise ValueError("Integer result too large")
+    elif isinstance(left, (str, list, tuple)) and isinstance(right, int):
+        _check_repeat(len(left), right)
+    elif isinstance(right, (str, list, tuple)) and isinstance(left, int):
+        _check_repeat(len(right), left)
+    return left * right
+
+
+def _pow(base: Any, exp: Any, mod: Any = None) -> Any:
+    if mod is None and isinstance(base, int) and isinstance(exp, int) and abs(base) > 1 and exp > 0:
+        if (base.bit_length() - 1) * exp > MAX_INT_BITS:
+            raise ValueError("Integer result too large")
+    return pow(base, exp, mod)
+
+
+def _lshift(left: Any, right: Any) -> Any:
+    if isinstance(left, int) and isinstance(right, int) and left and right > 0:
+        if left.bit_length() + right > MAX_INT_BITS:
+            raise ValueError("Integer result too large")
+    return left << right
+
+
+# Operadores que podem gerar resultados enormes, avaliados por funções com limite
+_GUARDED_OPERATORS = {ast.Mult: '_mul', ast.Pow: '_pow', ast.LShift: '_lshift'}
+_GUARDS = {'_mul': _mul, '_pow': _pow, '_lshift': _lshift}
+
+# Funções disponíveis dentro das fórmulas; nada mais do builtins é exposto
+SAFE_FUNCTIONS = {
+    'abs': abs,
+    'bool': bool,
+    'float': float,
+    'int': int,
+    'len': len,
+    'max': max,
+    'min': min,
+    'pow': _pow,
+    'round': round,
+    'str': str,
+    'sum': sum,
+}
+
+ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp,
+    ast.Call, ast.keyword, ast.Constant, ast.Name, ast.Attribute, ast.Load,
+    ast.Tuple, ast.List, ast.Subscript, ast.Slice,
+    ast.operator, ast.unaryop, ast.boolop, ast.cmpop,
+)
+
+PLAN_CACHE_SIZE = 4096
+
+
+class _BindReferences(ast.NodeTransformer):
+    """Troca `Tipo.atributo` pelo parâmetro correspondente do plano."""
+
+    def __init__(self, entity_type: str, slots: dict):
+        self.entity_type = entity_type
+        self.slots = slots
+
+    def visit_Attribute(self, node: ast.Attribute) -> ast.AST:
+        if isinstance(node.value, ast.Name) and node.value.id == self.entity_type and node.attr in self.slots:
+            return ast.copy_location(ast.Name(id=self.slots[node.attr], ctx=ast.Load()), node)
+        return self.generic_visit(node)
+
+
+class _GuardOperators(ast.NodeTransformer):
+    """Troca `a * b`, `a ** b` e `a << b` pelas funções com limite de tamanho."""
+
+    def visit_BinOp(self, node: ast.BinOp) -> ast.AST:
+        self.generic_visit(node)
+        guard = _GUARDED_OPERATORS.get(type(node.op))
+        if guard is None:
+            return node
+        call = ast.Call(func=ast.Name(id=guard, ctx=ast.Load()), args=[node.left, node.right], keywords=[])
+        return ast.copy_location(call, node)
+
+
+def _small_exponent(node: ast.AST) -> bool:
+    try:
+        value = ast.literal_eval(node)
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return False
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and abs(value) <= MAX_EXPONENT
+
+
+def _validate(tree: ast.AST) -> None:
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise ValueError(f"Unsupported expression: {type(node).__name__}")
+        if isinstance(node, ast.Name) and node.id.startswith('_'):
+            raise ValueError(f"Unsupported name: {node.id}")
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow) and not _small_exponent(node.right):
+            raise ValueError(f"Unsupported expression: exponent must be a constant up to {MAX_EXPONENT}")
+        if isinstance(node, ast.Attribute):
+            if node.attr.startswith('_') or not isinstance(node.value, ast.Name) or node.value.id in SAFE_FUNCTIONS:
+                raise ValueError(f"Unsupported attribute access: {node.attr}")
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in SAFE_FUNCTIONS:
+                raise ValueError("Only calls to built-in formula functions are allowed")
+            if any(kw.arg is None for kw in node.keywords):
+                raise ValueError("Unsupported expression: **kwargs")
+
+
+def _literal(value: Any) -> str:
+    return f'"{value}"' if isinstance(value, str) else str(value)
+
+
+class CompiledFormula:
+    """
+    Plano de avaliação de uma fórmula direta para um tipo de entidade.
+
+    A fórmula é analisada e compilada uma única vez; `attrs` lista, em ordem,
+    os atributos da entidade que devem ser passados para `evaluate`, seguidos
+    dos valores dos nomes soltos em `names` (saídas de outras fórmulas).
+    """
+    __slots__ = ('source', 'entity_type', 'attrs', 'names', 'tree', 'fn', 'error')
+
+    def __init__(self, source: str, entity_type: str, names: Tuple[str, ...] = ()):
+        self.source = source
+        self.entity_type = entity_type
+        self.names = names
+        self.attrs: Tuple[str, ...] = tuple(dict.fromkeys(
+            attr for etype, attr in REFERENCE_PATTERN.findall(source) if etype == entity_type
+        ))
+        self.tree: Optional[ast.Expression] = None
+        self.fn: Optional[Callable[..., Any]] = None
+        # Tipo e argumentos do erro de compilação: o plano fica no cache do
+        # processo, então cada avaliação levanta uma exceção nova, sem
+        # acumular tracebacks (e os frames que eles seguram) no objeto guardado
+        self.error: Optional[Tuple[type, Tuple[Any, ...]]] = None
+        try:
+            self._compile()
+        except Exception as e:
+            self.error = (type(e), e.args)
+
+    def _compile(self) -> None:
+        slots = {attr: f"_v{i}" for i, attr in enumerate(self.attrs)}
+        tree = ast.parse(self.source.strip(), filename='<string>', mode='eval')
+        _validate(tree)
+        tree = _BindReferences(self.entity_type, slots).visit(tree)
+        args = ast.arguments(
+            posonlyargs=[], args=[ast.arg(arg=name) for name in (*slots.values(), *self.names)],
+            kwonlyargs=[], kw_defaults=[], defaults=[]
+        )
+        body = _GuardOperators().visit(copy.deepcopy(tree.body))
+        lam = ast.Expression(body=ast.Lambda(args=args, body=body))
+        ast.fix_missing_locations(lam)
+        self.tree = tree
+        self.fn = eval(compile(lam, '<string>', 'eval'), {'__builtins__': {}, **SAFE_FUNCTIONS, **_GUARDS})
+
+    def evaluate(self, values: Tuple[Any, ...]) -> Any:
+        if self.error is not None:
+            error_type, args = self.error
+            raise error_type(*args)
+        return self.fn(*values)
+
+    def render(self, values: Tuple[Any, ...]) -> str:
+        """Fórmula com cada referência (e cada nome de `names`) trocada pelo seu valor."""
+        if self.names:
+            return self._render_names(values)
+        resolved = self.source
+        for attr, val in zip(self.attrs, values):
+            resolved = resolved.replace(f"{self.entity_type}.{attr}", _literal(val))
+        return resolved
+
+    def _render_names(self, values: Tuple[Any, ...]) -> str:
+        attr_values = dict(zip(self.attrs, values))
+        name_values = dict(zip(self.names, values[len(self.attrs):]))
+
+        def replace(match: 're.Match[str]') -> str:
+            etype, attr, name = match.groups()
+            if name is not None:
+                return _literal(name_values[name]) if name in name_values else name
+            if etype == self.entity_type and attr in attr_values:
+                return _literal(attr_values[attr])
+            return match.group(0)
+
+        return _TOKEN_PATTERN.sub(replace, self.source)
+
+    def describe(self, values: Tuple[Any, ...]) -> str:
+        """Fórmula com cada referência seguida do seu valor, como em "ISS (0.05) * TotalDosServicos (120.0)"."""
+        attr_values = dict(zip(self.attrs, values))
+        name_values = dict(zip(self.names, values[len(self.attrs):]))
+
+        def replace(match: 're.Match[str]') -> str:
+            etype, attr, name = match.groups()
+            if name is not None:
+                return f"{name} ({name_values[name]})" if name in name_values else name
+            if etype == self.entity_type and attr in attr_values:
+                return f"{attr} ({attr_values[attr]})"
+            return match.group(0)
+
+        return _TOKEN_PATTERN.sub(replace, self.source)
+
+
+class ResolvedFormula:
+    """Fórmula com os valores substituídos, renderizada só quando convertida para str."""
+    __slots__ = ('plan', 'values')
+
+    def __init__(self, plan: CompiledFormula, values: Tuple[Any, ...]):
+        self.plan = plan
+        self.values = values
+
+    def __str__(self) -> str:
+        return self.plan.render(self.values)
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, ResolvedFormula):
+            return NotImplemented
+        return (
+            self.plan.source == other.plan.source
+            and self.plan.entity_type == other.plan.entity_type
+            and self.values == other.values
+        )
+
+    def __hash__(self) -> int:
+        return hash((self.plan.source, self.plan.entity_type, self.values))
+
+
+@lru_cache(maxsize=PLAN_CACHE_SIZE)
+def compile_formula(formula: str, entity_type: str, names: Tuple[str, ...] = ()) -> CompiledFormula:
+    """Plano compilado para `formula` avaliada sobre entidades de `entity_type`, com cache LRU."""
+    return CompiledFormula(formula, entity_type, names)
@@ -0,0 +1,152 @@
+import bisect
+import math
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app import config
+
+# Fases de um cálculo, na ordem em que aparecem no Server-Timing
+PHASES = ('parse', 'ingest', 'plan', 'partition', 'direct', 'aggregation', 'derived', 'summarize', 'encode', 'compress')
+COUNTERS = ('entities', 'formulas', 'lookups', 'evaluations', 'errors')
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+COUNTER_HELP = {
+    'entities': "Entities loaded into the engine",
+    'formulas': "Formulas planned",
+    'lookups': "Relationship lookups (entities referencing another entity)",
+    'evaluations': "Formula results produced",
+    'errors': "Formula results with success=false",
+}
+
+
+class CalculationStats:
+    """
+    Tempos por fase e contadores de um cálculo. É preenchido pelo
+    FormulaProcessor (e por quem o chama) e viaja junto com o resultado, de
+    modo que funciona também quando o cálculo roda em outro processo.
+    """
+    __slots__ = ('phases', 'entities', 'formulas', 'lookups', 'evaluations', 'errors')
+
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+        self.entities = 0
+        self.formulas = 0
+        self.lookups = 0
+        self.evaluations = 0
+        self.errors = 0
+
+    def add_time(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def counters(self) -> Dict[str, int]:
+        return {name: getattr(self, name) for name in COUNTERS}
+
+    def server_timing(self, total: Optional[float] = None, cache: Optional[str] = None) -> str:
+        """Valor do cabeçalho Server-Timing, com as durações em milissegundos."""
+        parts = [f"{phase};dur={self.phases[phase] * 1000:.2f}" for phase in PHASES if phase in self.phases]
+        if cache is not None:
+            parts.append(f'cache;desc="{cache}"')
+        if total is not None:
+            parts.append(f"total;dur={total * 1000:.2f}")
+        return ', '.join(parts)
+
+
+def _labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+def _sample(value: float) -> str:
+    """Valor de uma amostra sem perder dígitos: inteiros por extenso, floats com repr()."""
+    if isinstance(value, int):
+        return str(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class MetricsRegistry:
+    """Contadores e histogramas em memória, exportados no formato texto do Prometheus."""
+
+    def __init__(self, enabled: bool = True, prefix: str = 'formula_engine'):
+        self.enabled = enabled
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], List[float]] = {}
+
+    def inc(self, name: str, value: float = 1, help: str = '', **labels: str) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._help.setdefault(name, ('counter', help))
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, help: str = '', **labels: str) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._help.setdefault(name, ('histogram', help))
+            # contagem por bucket, seguida de soma e contagem total
+            state = self._histograms.setdefault(key, [0.0] * (len(DURATION_BUCKETS) + 2))
+            bucket = bisect.bisect_left(DURATION_BUCKETS, seconds)
+            if bucket < len(DURATION_BUCKETS):
+                state[bucket] += 1
+            state[-2] += seconds
+            state[-1] += 1
+
+    def record_calculation(self, stats: CalculationStats) -> None:
+        for phase, seconds in stats.phases.items():
+            self.inc('phase_seconds_total', seconds, "Time spent per calculation phase", phase=phase)
+        for name, value in stats.counters().items():
+            self.inc(f'{name}_total', value, COUNTER_HELP[name])
+
+    def record_request(self, endpoint: str, status: int, seconds: float, cache: Optional[str] = None) -> None:
+        self.inc('requests_total', 1, "Requests by endpoint and status", endpoint=endpoint, status=str(status))
+        self.observe('request_duration_seconds', seconds, "Request duration", endpoint=endpoint)
+        if cache is not None:
+            self.inc('cache_requests_total', 1, "Result cache lookups", result=cache)
+
+    def render(self, gauges: Iterable[Tuple[str, float, str]] = ()) -> str:
+        lines: List[str] = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+            help_ = dict(self._help)
+        described = set()
+
+        def describe(name: str) -> None:
+            if name not in described:
+                described.add(name)
+                kind, text = help_[name]
+                lines.append(f"# HELP {self.prefix}_{name} {text}")
+                lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+
+        for (name, labels), value in counters:
+            describe(name)
+            lines.append(f"{self.prefix}_{name}{_labels(labels)} {_sample(value)}")
+        for (name, labels), state in histograms:
+            describe(name)
+            cumulative = 0.0
+            for bound, count in zip(DURATION_BUCKETS, state):
+                cumulative += count
+                lines.append(f"{self.prefix}_{name}_bucket{_labels(labels + (('le', _sample(bound)),))} {_sample(cumulative)}")
+            lines.append(f"{self.prefix}_{name}_bucket{_labels(labels + (('le', '+Inf'),))} {_sample(state[-1])}")
+            lines.append(f"{self.prefix}_{name}_sum{_labels(labels)} {_sample(state[-2])}")
+            lines.append(f"{self.prefix}_{name}_count{_labels(labels)} {_sample(state[-1])}")
+        for name, value, text in gauges:
+            lines.append(f"# HELP {self.prefix}_{name} {text}")
+            lines.append(f"# TYPE {self.prefix}_{name} gauge")
+            lines.append(f"{self.prefix}_{name} {_sample(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry(enabled=config.METRICS_ENABLED)
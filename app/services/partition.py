@@ -0,0 +1,328 @@
+import heapq
+import sys
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from itertools import islice
+from operator import itemgetter
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple, Union
+
+from app import config
+from app.models.schemas import EntityInput
+from app.services.calculator import FormulaProcessor
+from app.services.codec import (
+    DEFAULT_OUTPUT, OutputOptions, dumps, encode_columns, encode_rows, join_columnar, join_output
+)
+from app.services.entity_index import EntityIndex
+from app.services.entity_store import EntityRecord
+from app.services.expression import REFERENCE_PATTERN
+from app.services.metrics import CalculationStats
+from app.services.planner import FormulaNode, plan_formulas
+from app.services.results import ResultRow
+
+# Campos de um EntityRecord; tuplas vão para os workers bem mais rápido que os registros
+RecordFields = Tuple[str, List[str], Dict[str, Any], Tuple[Any, ...]]
+# Resultados de uma fórmula puxados por uma entidade, já serializados:
+# (índice do tipo na fórmula, posição da entidade na requisição, trechos de
+# JSON: um só com as linhas, ou um por campo no formato colunar)
+Block = Tuple[int, int, Tuple[bytes, ...]]
+# Índice de tipo do registro do último pai em SUM(Pai.Filho.x * Pai.Filho.Neto.y), que vem depois de todos
+LAST_PARENT = sys.maxsize
+
+_block_order = itemgetter(0, 1)
+
+
+def _drivers(node: FormulaNode, index: EntityIndex) -> Iterator[Tuple[int, EntityRecord, int]]:
+    """
+    Entidades que puxam os resultados de `node`, na ordem em que
+    FormulaProcessor os registra, com quantos resultados cada uma gera.
+    """
+    if node.kind == 'aggregation':
+        spec = node.aggregation
+        for parent in index.of_type(spec.parent_type):
+            yield 0, parent, len(index.referencing(parent.id, spec.child_type))
+        return
+    if node.kind == 'ref_aggregation':
+        types: Tuple[str, ...] = (node.aggregation.parent_type,)
+    elif node.kind == 'derived':
+        types = node.scope
+    else:
+        types = tuple(dict.fromkeys(etype for etype, _ in REFERENCE_PATTERN.findall(node.formula)))
+    for ti, etype in enumerate(types):
+        for entity in index.of_type(etype):
+            yield ti, entity, 1
+
+
+def _traversal_types(nodes: List[FormulaNode]) -> Set[str]:
+    """Tipos cujas entidades leem as entidades que as referenciam (pais de agregações e de totais)."""
+    types: Set[str] = set()
+    for node in nodes:
+        if node.aggregation is not None:
+            types.add(node.aggregation.parent_type)
+        elif any(member_type is not None for member_type, _ in node.symbols.values()):
+            types.update(node.scope)
+    return types
+
+
+def find_components(records: Dict[str, EntityRecord], roots: List[EntityRecord]) -> Dict[str, int]:
+    """
+    Componente de cada entidade alcançável a partir de `roots` seguindo quem
+    a referencia (Contract <- Servico <- Medicao). Raízes que alcançam uma
+    mesma entidade ficam no mesmo componente; entidades que nenhuma raiz
+    alcança (um catálogo de Item, por exemplo) ficam de fora.
+    """
+    referenced_by: Dict[Any, List[str]] = {}
+    for record in records.values():
+        for value in dict.fromkeys(record.refs):
+            if value != record.id and value in records:
+                referenced_by.setdefault(value, []).append(record.id)
+
+    group = list(range(len(roots)))
+
+    def find(i: int) -> int:
+        while group[i] != i:
+            group[i] = group[group[i]]
+            i = group[i]
+        return i
+
+    label: Dict[str, int] = {}
+    for i, root in enumerate(roots):
+        if root.id in label:
+            group[find(i)] = find(label[root.id])
+            continue
+        label[root.id] = i
+        stack = [root.id]
+        while stack:
+            for entity_id in referenced_by.get(stack.pop(), ()):
+                other = label.get(entity_id)
+                if other is None:
+                    label[entity_id] = i
+                    stack.append(entity_id)
+                elif find(other) != find(i):
+                    group[find(other)] = find(i)
+    return {entity_id: find(i) for entity_id, i in label.items()}
+
+
+class PartitionProcessor(FormulaProcessor):
+    """
+    FormulaProcessor de um grupo de componentes. As entidades compartilhadas
+    entram em todos os grupos só para consulta e puxam cálculos apenas no
+    grupo que as possui. O registro do último pai das fórmulas AGG_PATTERN
+    fica com o grupo que tem a última entidade da requisição, que também
+    recebe os componentes desses pais.
+
+    `blocks` guarda, por fórmula, o trecho de results gravado por cada
+    entidade que puxou resultados: (índice do tipo, posição, início, fim).
+    """
+
+    def __init__(self, records: List[EntityRecord], position: Dict[str, int], owned: Set[str], holds_last: bool):
+        super().__init__(records, workers=1)
+        for members in self.index.by_type.values():
+            members[:] = [entity for entity in members if entity.id in owned]
+        self.position = position
+        self.holds_last = holds_last
+        self.blocks: Dict[int, List[Tuple[int, int, int, int]]] = {}
+
+    def _record_last_parent(self, nodes: List[FormulaNode], outs: List[Any]) -> None:
+        if self.holds_last:
+            super()._record_last_parent(nodes, outs)
+
+    def _store_rows(self, node: FormulaNode, rows: List[ResultRow]) -> List[Tuple[int, bool]]:
+        stored = super()._store_rows(node, rows)
+        blocks = self.blocks[node.position] = []
+        pending = iter(stored)
+        drivers = ((ti, self.position[entity.id], count) for ti, entity, count in _drivers(node, self.index))
+        for ti, pos, count in (*drivers, (LAST_PARENT, 0, len(stored))):
+            # Linhas novas recebem índices seguidos; as repetidas ficam de fora
+            added = [i for i, new in islice(pending, count) if new]
+            if added:
+                blocks.append((ti, pos, added[0], added[-1] + 1))
+        return stored
+
+
+def _calculate_chunk(
+    records: List[RecordFields], positions: List[int], owned: Set[str], holds_last: bool, formulas: List[str],
+    options: OutputOptions = DEFAULT_OUTPUT
+) -> Tuple[Dict[int, List[Block]], Dict[str, bytes], CalculationStats]:
+    """
+    Calcula um grupo no worker. Os resultados voltam resumidos e serializados
+    por fórmula e entidade que os puxou, e as entidades agregadas por id.
+    Todos os resultados de uma entidade saem do mesmo grupo, então os
+    duplicados removidos aqui são os mesmos da requisição inteira.
+    """
+    position = {fields[0]: pos for fields, pos in zip(records, positions)}
+    processor = PartitionProcessor([EntityRecord(*fields) for fields in records], position, owned, holds_last)
+    processor.process(formulas)
+    store = processor.results
+    blocks: Dict[int, List[Block]] = {}
+    for node_position, node_blocks in processor.blocks.items():
+        encoded = blocks[node_position] = []
+        for ti, pos, start, stop in node_blocks:
+            if options.columnar:
+                fragments = encode_columns(store, start, stop, options)
+            else:
+                fragments = (encode_rows(store, start, stop, options),)
+            # Com failed_only um trecho pode ficar vazio
+            if any(fragments):
+                encoded.append((ti, pos, fragments))
+    aggregated = {entity['id']: dumps(entity) for entity in processor.aggregated_entities()}
+    return blocks, aggregated, processor.stats
+
+
+class PartitionRunner:
+    """
+    Divide uma requisição em componentes independentes (cada entidade raiz,
+    por padrão Contract, com tudo que a referencia direta ou indiretamente),
+    calcula grupos de componentes em paralelo num pool de processos e junta
+    os resultados na mesma ordem do cálculo sequencial.
+
+    Entidades fora de qualquer componente são copiadas para todos os grupos.
+    Quando alguma delas é pai de uma agregação ou de um total, os grupos não
+    são independentes e run() devolve None para o cálculo seguir em sequência.
+    """
+
+    def __init__(self, workers: int = 1, root_type: str = 'Contract', min_entities: int = 20000):
+        self.workers = workers
+        self.root_type = root_type
+        self.min_entities = min_entities
+        self._pool: Optional[Executor] = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls) -> 'PartitionRunner':
+        return cls(
+            workers=config.PARTITION_WORKERS,
+            root_type=config.PARTITION_ROOT_TYPE,
+            min_entities=config.PARTITION_MIN_ENTITIES
+        )
+
+    def accepts(self, entities: Sequence[Any]) -> bool:
+        return self.workers > 1 and len(entities) >= self.min_entities
+
+    def _executor(self) -> Executor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+    def run(
+        self, entities: Sequence[Union[EntityInput, EntityRecord]], formulas: List[str],
+        options: OutputOptions = DEFAULT_OUTPUT
+    ) -> Optional[Tuple[bytes, CalculationStats]]:
+        """
+        Calcula a requisição em paralelo e devolve a resposta de /calculate
+        serializada, com os tempos e contadores, ou None se ela não puder ser
+        dividida.
+        """
+        stats = CalculationStats()
+        started = time.perf_counter()
+        records: Dict[str, EntityRecord] = {}
+        for entity in entities:
+            records[entity.id] = entity if isinstance(entity, EntityRecord) else EntityRecord.from_entity(entity)
+        stats.entities = len(records)
+        stats.add_time('ingest', time.perf_counter() - started)
+
+        started = time.perf_counter()
+        nodes = [node for level in plan_formulas(formulas) for node in level]
+        stats.formulas = len(formulas)
+        roots = [record for record in records.values() if self.root_type in record.entity_type]
+        component = find_components(records, roots)
+        traversed = _traversal_types(nodes)
+        if any(etype in traversed for r in records.values() if r.id not in component for etype in r.entity_type):
+            return None
+
+        # A última entidade e o último pai de cada AGG_PATTERN ficam no mesmo grupo
+        last_entity_id = next(reversed(records))
+        anchors = {component.get(last_entity_id)}
+        for parent_type in {node.aggregation.parent_type for node in nodes if node.kind == 'aggregation'}:
+            last_parent = next((r for r in reversed(records.values()) if parent_type in r.entity_type), None)
+            if last_parent is not None:
+                anchors.add(component[last_parent.id])
+        anchors.discard(None)
+        anchor = min(anchors) if anchors else None
+
+        sizes: Dict[int, int] = {}
+        for label in component.values():
+            label = anchor if label in anchors else label
+            sizes[label] = sizes.get(label, 0) + 1
+        if len(sizes) < 2:
+            return None
+
+        # Grupos equilibrados pelo número de entidades, maiores componentes primeiro
+        n_chunks = min(len(sizes), self.workers * 2)
+        loads = [(0, c) for c in range(n_chunks)]
+        chunk_of: Dict[int, int] = {}
+        for label, size in sorted(sizes.items(), key=lambda item: (-item[1], item[0])):
+            load, c = heapq.heappop(loads)
+            chunk_of[label] = c
+            heapq.heappush(loads, (load + size, c))
+        # As compartilhadas são calculadas no grupo da âncora, ou no menos carregado
+        shared_chunk = chunk_of[anchor] if anchor is not None else loads[0][1]
+
+        members: List[List[RecordFields]] = [[] for _ in range(n_chunks)]
+        positions: List[List[int]] = [[] for _ in range(n_chunks)]
+        owned: List[Set[str]] = [set() for _ in range(n_chunks)]
+        for pos, record in enumerate(records.values()):
+            fields = (record.id, record.entity_type, record.values, record.refs)
+            label = component.get(record.id)
+            if label is None:
+                for c in range(n_chunks):
+                    members[c].append(fields)
+                    positions[c].append(pos)
+                owned[shared_chunk].add(record.id)
+                continue
+            c = chunk_of[anchor if label in anchors else label]
+            members[c].append(fields)
+            positions[c].append(pos)
+            owned[c].add(record.id)
+        stats.add_time('partition', time.perf_counter() - started)
+
+        pool = self._executor()
+        futures = [
+            pool.submit(
+                _calculate_chunk, members[c], positions[c], owned[c], last_entity_id in owned[c], formulas, options
+            )
+            for c in range(n_chunks)
+        ]
+        blocks: Dict[int, List[Block]] = {node.position: [] for node in nodes}
+        aggregated: Dict[str, bytes] = {}
+        for future in futures:
+            chunk_blocks, chunk_aggregated, chunk_stats = future.result()
+            for position, node_blocks in chunk_blocks.items():
+                blocks[position].extend(node_blocks)
+            aggregated.update(chunk_aggregated)
+            # Tempos das fórmulas somados entre os workers
+            for phase in ('direct', 'aggregation', 'derived'):
+                if phase in chunk_stats.phases:
+                    stats.add_time(phase, chunk_stats.phases[phase])
+            stats.lookups += chunk_stats.lookups
+            stats.evaluations += chunk_stats.evaluations
+            stats.errors += chunk_stats.errors
+
+        started = time.perf_counter()
+        # Linhas na ordem das fórmulas; no formato colunar, agrupadas por fórmula
+        groups: Dict[str, List[Tuple[bytes, ...]]] = {}
+        parts: List[bytes] = []
+        for node in nodes:
+            node_blocks = blocks[node.position]
+            node_blocks.sort(key=_block_order)
+            if options.columnar:
+                groups.setdefault(node.formula, []).extend(fragments for _, _, fragments in node_blocks)
+            else:
+                parts.extend(fragments[0] for _, _, fragments in node_blocks)
+        aggregated_parts = (aggregated[entity_id] for entity_id in records if entity_id in aggregated)
+        if options.columnar:
+            content = join_columnar(options.fields, groups.items(), aggregated_parts)
+        else:
+            content = join_output(parts, aggregated_parts)
+        stats.add_time('encode', time.perf_counter() - started)
+        return content, stats
+
+
+partitions = PartitionRunner.from_config()
@@ -0,0 +1,192 @@
+import ast
+import re
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from app.services.expression import REFERENCE_PATTERN, SAFE_FUNCTIONS
+
+AGG_PATTERN = re.compile(
+    r"^(?P<fn>SUM|AVG|COUNT|MAX|MIN)\("
+    r"(?P<prefix>[A-Za-z0-9_]+\.[A-Za-z0-9_]+)\.(?P<left>\w+)\s*\*\s*"
+    r"(?P=prefix)\.(?P<right_path>[A-Za-z0-9_]+(?:\.[A-Za-z0-9_]+)*)"
+    r"\)$"
+)
+AGG_REF_PATTERN = re.compile(
+    r"^(?P<fn>SUM|AVG|COUNT|MAX|MIN)\("
+    r"(?P<prefix>[A-Za-z0-9_]+\.[A-Za-z0-9_]+)\.(?P<left>\w+)\s*\*\s*"
+    r"@?(?P<ref_attr>\w+)\.(?P<right_attr>\w+)"
+    r"\)$"
+)
+# "Nome = expressão": o resultado fica disponível para outras fórmulas como `Nome`
+NAMED_PATTERN = re.compile(r"^\s*(?P<name>[A-Za-z][A-Za-z0-9_]*)\s*=(?!=)\s*(?P<expression>.+)$", re.S)
+
+# Totais pré-definidos: nome -> (tipo das entidades que referenciam a entidade
+# calculada, saída somada em cada uma delas)
+TOTALS: Dict[str, Tuple[str, str]] = {
+    'TotalDosServicos': ('Servico', 'SUM'),
+}
+
+# Origem do valor de um nome: (tipo somado, saída); sem tipo, a saída é lida
+# na própria entidade
+Source = Tuple[Optional[str], str]
+
+
+class FormulaCycleError(ValueError):
+    """Fórmulas que dependem umas das outras em ciclo."""
+
+
+class Aggregation:
+    """
+    Partes de uma fórmula SUM/AVG/COUNT/MAX/MIN, lidas uma vez no
+    planejamento. Em AGG_PATTERN o produto é Filho.left * Neto.right; em
+    AGG_REF_PATTERN, Filho.left * (entidade em Filho.ref_attr).right.
+    """
+    __slots__ = ('fn', 'parent_type', 'child_type', 'left', 'grand_type', 'ref_attr', 'right')
+
+    def __init__(self, match: Any):
+        self.fn = match.group('fn')
+        self.parent_type, self.child_type = match.group('prefix').split('.')
+        self.left = match.group('left')
+        self.grand_type: Optional[str] = None
+        self.ref_attr: Optional[str] = None
+        if match.re is AGG_PATTERN:
+            self.grand_type, self.right = match.group('right_path').split('.', 1)
+        else:
+            self.ref_attr = match.group('ref_attr')
+            self.right = match.group('right_attr')
+
+    @property
+    def path(self) -> Tuple[Optional[str], ...]:
+        """Entidades percorridas: Pai -> Filho -> Neto, ou Pai -> Filho nas de referência."""
+        return self.parent_type, self.child_type, self.grand_type
+
+
+class FormulaNode:
+    """
+    Uma fórmula da requisição já classificada.
+
+    `provides` são as saídas que ela registra nas entidades (a função de
+    agregação, ou o nome de uma fórmula "Nome = ..."), e `symbols` os nomes
+    que ela lê de outras fórmulas, com a origem de cada um. Agregações
+    trazem suas partes em `aggregation`.
+    """
+    __slots__ = (
+        'position', 'formula', 'kind', 'expression', 'name', 'provides', 'symbols', 'scope', 'level', 'aggregation'
+    )
+
+    def __init__(self, position: int, formula: str):
+        self.position = position
+        self.formula = formula
+        self.kind = 'direct'
+        self.expression = formula
+        self.name: Optional[str] = None
+        self.provides: Set[str] = set()
+        self.symbols: Dict[str, Source] = {}
+        self.scope: Tuple[str, ...] = ()
+        self.level = 0
+        self.aggregation: Optional[Aggregation] = None
+
+    @property
+    def requires(self) -> Set[str]:
+        return {output for _, output in self.symbols.values()}
+
+    @property
+    def uses_totals(self) -> bool:
+        """Se a fórmula lê um total de TOTALS (somado nas entidades que a referenciam)."""
+        return any(member_type is not None for member_type, _ in self.symbols.values())
+
+
+def _free_names(expression: str) -> List[str]:
+    """Nomes soltos da expressão (nem `Tipo.atributo` nem chamadas de função)."""
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError:
+        return []
+    bound = set(SAFE_FUNCTIONS)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+            bound.add(node.value.id)
+    names = (node.id for node in ast.walk(tree) if isinstance(node, ast.Name))
+    return [name for name in dict.fromkeys(names) if name not in bound]
+
+
+def _classify(nodes: List[FormulaNode]) -> None:
+    for node in nodes:
+        match = AGG_PATTERN.match(node.formula) or AGG_REF_PATTERN.match(node.formula)
+        if match:
+            node.kind = 'aggregation' if match.re is AGG_PATTERN else 'ref_aggregation'
+            node.provides = {match.group('fn')}
+            node.aggregation = Aggregation(match)
+            continue
+        named = NAMED_PATTERN.match(node.formula)
+        if named:
+            node.kind = 'derived'
+            node.name = named.group('name')
+            node.expression = named.group('expression')
+            node.provides = {node.name}
+
+    names = {node.name for node in nodes if node.name}
+    for node in nodes:
+        if node.kind in ('aggregation', 'ref_aggregation'):
+            continue
+        for name in _free_names(node.expression):
+            if name in names:
+                node.symbols[name] = (None, name)
+            elif name in TOTALS:
+                node.symbols[name] = TOTALS[name]
+        if node.symbols:
+            node.kind = 'derived'
+        node.scope = tuple(dict.fromkeys(etype for etype, _ in REFERENCE_PATTERN.findall(node.expression)))
+
+
+def plan_formulas(formulas: List[str]) -> List[List[FormulaNode]]:
+    """
+    Ordena as fórmulas em níveis: cada fórmula só depende de saídas de níveis
+    anteriores, e as de um mesmo nível são independentes entre si. Dentro de
+    cada nível a ordem da requisição é mantida.
+    """
+    nodes = [FormulaNode(i, formula) for i, formula in enumerate(formulas)]
+    _classify(nodes)
+
+    providers: Dict[str, List[FormulaNode]] = {}
+    for node in nodes:
+        for output in node.provides:
+            providers.setdefault(output, []).append(node)
+    depends = {
+        node.position: {p.position for output in node.requires for p in providers.get(output, ())}
+        for node in nodes
+    }
+
+    levels: List[List[FormulaNode]] = []
+    done: Set[int] = set()
+    remaining = nodes
+    while remaining:
+        ready = [node for node in remaining if depends[node.position] <= done]
+        if not ready:
+            cycle = ', '.join(repr(node.formula) for node in remaining)
+            raise FormulaCycleError(f"Circular dependency between formulas: {cycle}")
+        for node in ready:
+            node.level = len(levels)
+            # Sem `Tipo.atributo`, a fórmula é calculada nas entidades das saídas que lê
+            if not node.scope:
+                node.scope = tuple(dict.fromkeys(
+                    etype for name, (member_type, output) in node.symbols.items() if member_type is None
+                    for p in providers.get(output, ()) for etype in p.scope
+                ))
+        levels.append(ready)
+        done.update(node.position for node in ready)
+        remaining = [node for node in remaining if node.position not in done]
+    return levels
+
+
+def traversal_groups(level: List[FormulaNode]) -> List[List[FormulaNode]]:
+    """
+    Divide um nível em grupos calculados juntos: agregações do mesmo tipo
+    que percorrem o mesmo caminho ficam num grupo só, para que a hierarquia
+    seja visitada uma vez por caminho e não por fórmula; as demais fórmulas
+    ficam sozinhas. Os grupos seguem a ordem da primeira fórmula de cada um.
+    """
+    groups: Dict[Any, List[FormulaNode]] = {}
+    for node in level:
+        key = (node.kind, node.aggregation.path) if node.aggregation is not None else node.position
+        groups.setdefault(key, []).append(node)
+    return list(groups.values())
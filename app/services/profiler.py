@@ -0,0 +1,84 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterator
+
+from app import config
+
+
+def _stack(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SlowCallProfiler:
+    """
+    Profiler por amostragem, opcional. Enquanto um cálculo roda, uma thread
+    lê a pilha da thread do cálculo a cada `interval` segundos; se ele levar
+    mais que `threshold`, as pilhas são gravadas em `directory` no formato
+    "collapsed" (uma linha `a;b;c contagem`), aceito por flamegraph.pl e
+    speedscope. Com `threshold` <= 0 não faz nada.
+    """
+
+    def __init__(self, threshold: float = 0.0, interval: float = 0.005, directory: str = 'profiles'):
+        self.threshold = threshold
+        self.interval = interval
+        self.directory = directory
+
+    @classmethod
+    def from_config(cls) -> 'SlowCallProfiler':
+        return cls(
+            threshold=config.PROFILE_SLOW_SECONDS,
+            interval=config.PROFILE_INTERVAL,
+            directory=config.PROFILE_DIR
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    @contextmanager
+    def profile(self, label: str) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        target = threading.get_ident()
+        samples: Counter = Counter()
+        done = threading.Event()
+
+        def sample() -> None:
+            while not done.wait(self.interval):
+                frame = sys._current_frames().get(target)
+                if frame is not None:
+                    samples[_stack(frame)] += 1
+
+        sampler = threading.Thread(target=sample, name='profiler', daemon=True)
+        started = time.perf_counter()
+        sampler.start()
+        try:
+            yield
+        finally:
+            done.set()
+            sampler.join()
+            elapsed = time.perf_counter() - started
+            if elapsed >= self.threshold and samples:
+                self._write(label, elapsed, samples)
+
+    def _write(self, label: str, elapsed: float, samples: Counter) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{label}-{elapsed * 1000:.0f}ms.folded"
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+
+profiler = SlowCallProfiler.from_config()
@@ -0,0 +1,142 @@
+from typing import Any, Container, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+# Um resultado como as fórmulas o produzem:
+# (entity_id, formula, resolved_formula, result, result_type, error)
+ResultRow = Tuple[str, str, Any, Any, Optional[str], Optional[str]]
+# Atributo calculado de uma entidade: índice da linha no ResultStore, ou
+# (descrição, valor) quando a linha com a mesma chave tem outro valor
+ComputedRef = Union[int, Tuple[str, Any]]
+
+
+class ResultStore:
+    """
+    Resultados de um cálculo em colunas, na ordem em que foram publicados.
+
+    Uma linha só é gravada se a chave (entity_id, formula, resolved_formula)
+    ainda não apareceu, de modo que summarize() não precisa remover
+    duplicados. Fórmulas, descrições e ids são guardados por referência
+    (os mesmos objetos das fórmulas e entidades), e resolved_formula só
+    vira texto quando a linha é lida.
+
+    Em streaming, release() descarta as linhas já enviadas: as colunas
+    passam a começar em `base`; continuam guardadas só a descrição e o
+    valor das linhas que são atributos calculados e as chaves das fórmulas
+    que ainda vão ser calculadas de novo.
+    """
+    __slots__ = (
+        'entity_ids', 'formulas', 'resolved', 'results', 'result_types', 'errors', 'base', '_keys', '_released', '_held'
+    )
+
+    def __init__(self):
+        self.entity_ids: List[str] = []
+        self.formulas: List[str] = []
+        self.resolved: List[Any] = []
+        self.results: List[Any] = []
+        self.result_types: List[Optional[str]] = []
+        self.errors: List[Optional[str]] = []
+        # Índice da primeira linha ainda nas colunas
+        self.base = 0
+        self._keys: Dict[Tuple[str, str, Any], int] = {}
+        # (descrição, valor) das linhas descartadas que são atributos calculados
+        self._released: Dict[int, Tuple[Any, Any]] = {}
+        # Chaves de linhas descartadas cuja fórmula ainda vai ser calculada de novo
+        self._held: Dict[str, List[Tuple[str, str, Any]]] = {}
+
+    def __len__(self) -> int:
+        return self.base + len(self.entity_ids)
+
+    def add(self, row: ResultRow) -> Tuple[int, bool]:
+        """Índice da linha com a chave de `row` e se ela foi gravada agora."""
+        entity_id, formula, resolved, result, result_type, error = row
+        n = len(self)
+        i = self._keys.setdefault((entity_id, formula, resolved), n)
+        if i != n:
+            return i, False
+        self.entity_ids.append(entity_id)
+        self.formulas.append(formula)
+        self.resolved.append(resolved)
+        self.results.append(result)
+        self.result_types.append(result_type)
+        self.errors.append(error)
+        return i, True
+
+    def computed_ref(self, i: int, desc: str, value: Any) -> ComputedRef:
+        # Uma fórmula repetida chega à mesma linha; o valor só é guardado à parte se mudou
+        if i < self.base and i not in self._released:
+            return desc, value  # linha descartada que não era atributo calculado (ex.: erro)
+        return i if self.computed(i)[1] == value else (desc, value)
+
+    def computed(self, ref: ComputedRef) -> Tuple[str, Any]:
+        if isinstance(ref, tuple):
+            return ref
+        if ref < self.base:
+            return self._released[ref]
+        return self.resolved[ref - self.base], self.results[ref - self.base]
+
+    def release(self, stop: int, computed: Iterable[int], pending: Container[str]) -> None:
+        """
+        Descarta as linhas até `stop`. Descrição e valor das linhas
+        `computed`, referenciadas por atributos calculados, são guardados; as
+        chaves só ficam para as fórmulas em `pending`, as únicas que ainda
+        podem gerar duplicados.
+        """
+        for i in computed:
+            if self.base <= i < stop:
+                self._released[i] = self.computed(i)
+        count = stop - self.base
+        for key in zip(self.entity_ids[:count], self.formulas[:count], self.resolved[:count]):
+            if key[1] in pending:
+                self._held.setdefault(key[1], []).append(key)
+            else:
+                del self._keys[key]
+        for formula in [formula for formula in self._held if formula not in pending]:
+            for key in self._held.pop(formula):
+                del self._keys[key]
+        for column in (self.entity_ids, self.formulas, self.resolved, self.results, self.result_types, self.errors):
+            del column[:count]
+        self.base = stop
+
+    def row(self, i: int) -> Dict[str, Any]:
+        """Linha `i` no formato de summarize()."""
+        i -= self.base
+        result = self.results[i]
+        if isinstance(result, (int, float)):
+            result = float(result)
+        error = self.errors[i]
+        return {
+            'entity_id': self.entity_ids[i],
+            'formula': self.formulas[i],
+            'resolved_formula': str(self.resolved[i]),
+            'result': result,
+            'result_type': self.result_types[i],
+            'error': error,
+            'success': error is None
+        }
+
+
+class ResultView(Sequence):
+    """Linhas `start`..`stop` de um ResultStore, montadas só quando lidas."""
+    __slots__ = ('store', 'start', 'stop')
+
+    def __init__(self, store: ResultStore, start: int = 0, stop: Optional[int] = None):
+        self.store = store
+        self.start = start
+        self.stop = len(store) if stop is None else stop
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+    def __getitem__(self, item: Union[int, slice]) -> Any:
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return ResultView(self.store, self.start + start, self.start + max(start, stop))
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError(item)
+        return self.store.row(self.start + item)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return map(self.store.row, range(self.start, self.stop))
@@ -0,0 +1,408 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from app import config
+from app.models.schemas import Attribute, AttributeChange, ComputedAttribute, EntityInput, EntityOutput
+from app.services.aggregation import reduce_group
+from app.services.calculator import FormulaProcessor
+from app.services.entity_store import EntityRecord
+from app.services.expression import compile_formula
+from app.services.planner import plan_formulas
+
+# Chaves de dependência:
+#   ('attr', entity_id, key)  valor de um atributo
+#   ('refs', entity_id)       qualquer atributo da entidade
+#   ('ref', value, type)      entidades de `type` que referenciam `value`
+#   ('computed', entity_id)   atributos calculados (agregações e fórmulas derivadas) da entidade
+Dep = Tuple[Any, ...]
+
+# Chaves de unidade (um resultado, ou o conjunto de filhos de um pai):
+#   ('direct', fi, entity_type, entity_id)
+#   ('members', fi, parent_id)   filhos de um pai em SUM(Pai.Filho.x * Pai.Filho.Neto.y)
+#   ('child', fi, child_id)
+#   ('last', fi)                 registro do último pai dessa mesma fórmula
+#   ('ref', fi, parent_id)       SUM(Pai.Filho.x * @ref.y)
+#   ('derived', fi, entity_type, entity_id)   fórmula que lê saídas de outras
+UnitKey = Tuple[Any, ...]
+
+_KIND_ORDER = {'direct': 0, 'members': 1, 'child': 1, 'last': 2, 'ref': 1, 'derived': 0}
+
+
+def _same_rows(a: List[Dict[str, Any]], b: List[Dict[str, Any]]) -> bool:
+    # 0.0 == -0.0, mas o sinal aparece na resposta
+    return a == b and all(repr(x['result']) == repr(y['result']) for x, y in zip(a, b))
+
+
+class _Unit:
+    __slots__ = ('key', 'rows', 'deps', 'records_on', 'children')
+
+    def __init__(self, key: UnitKey):
+        self.key = key
+        self.rows: List[Dict[str, Any]] = []
+        self.deps: Set[Dep] = set()
+        self.records_on: Optional[str] = None
+        self.children: List[str] = []
+
+
+class CalculationSession:
+    """
+    Conjunto de entidades e fórmulas carregado uma vez e recalculado
+    incrementalmente.
+
+    Cada resultado é uma unidade com as dependências (atributos, relacionamentos
+    e agregações) lidas ao calculá-la. Ao alterar atributos, só as unidades que
+    dependem deles são recalculadas, nível a nível do plano de fórmulas, até
+    as fórmulas derivadas (como TotalDosServicos). Os resultados têm a mesma forma de
+    summarize(): duplicados aparecem uma única vez.
+    """
+
+    def __init__(self, entities: List[EntityInput], formulas: List[str]):
+        self.lock = threading.Lock()
+        self.attributes: Dict[str, List[Attribute]] = {e.id: list(e.attributes) for e in entities}
+        self.processor = FormulaProcessor(entities)
+        self.entities = self.processor.entities
+        self.index = self.processor.index
+        self.formulas = list(dict.fromkeys(formulas))
+        self.units: Dict[UnitKey, _Unit] = {}
+        self.dependents: Dict[Dep, Set[UnitKey]] = {}
+        self.recorded: Dict[str, Set[UnitKey]] = {}
+        self.child_parents: Dict[Tuple[int, str], Set[str]] = {}
+        self.last_used = time.monotonic()
+
+        self.plan = plan_formulas(self.formulas)
+        self.nodes = {node.position: node for level in self.plan for node in level}
+        for level in self.plan:
+            pending: List[UnitKey] = []
+            for node in level:
+                fi = node.position
+                if node.kind == 'aggregation':
+                    parent_type = node.aggregation.parent_type
+                    pending.extend(('members', fi, p.id) for p in self.index.of_type(parent_type))
+                    pending.append(('last', fi))
+                elif node.kind == 'ref_aggregation':
+                    parent_type = node.aggregation.parent_type
+                    pending.extend(('ref', fi, p.id) for p in self.index.of_type(parent_type))
+                else:
+                    for etype in node.scope:
+                        pending.extend((node.kind, fi, etype, e.id) for e in self.index.of_type(etype))
+            self._run(pending)
+
+    # ---- API pública -------------------------------------------------
+
+    def results(self) -> Tuple[List[Dict[str, Any]], List[EntityOutput]]:
+        units = sorted(self.units.values(), key=self._sort_key)
+        rows = [row for unit in units for row in unit.rows]
+        return rows, self._entity_outputs(self.recorded.keys())
+
+    def apply(self, changes: Iterable[AttributeChange]) -> Tuple[List[Dict[str, Any]], List[EntityOutput]]:
+        """Aplica as alterações e devolve só os resultados e entidades afetados."""
+        changes = list(changes)
+        for change in changes:
+            self._validate(change)
+        triggered: Set[Dep] = set()
+        for change in changes:
+            triggered |= self._apply_change(change)
+        changed = self._propagate(triggered)
+        units = sorted((self.units[k] for k in changed if k in self.units), key=self._sort_key)
+        rows = [row for unit in units for row in unit.rows]
+        touched = {self._records_on(k) for k in changed} - {None}
+        return rows, self._entity_outputs(touched)
+
+    # ---- Alterações ----------------------------------------------------
+
+    def _validate(self, change: AttributeChange) -> None:
+        if change.entity_id not in self.entities:
+            raise ValueError(f"Entity '{change.entity_id}' not found in session")
+        if change.type is None and all(attr.key != change.key for attr in self.attributes[change.entity_id]):
+            raise ValueError(f"Attribute '{change.key}' is new in entity {change.entity_id}; 'type' is required")
+
+    def _apply_change(self, change: AttributeChange) -> Set[Dep]:
+        record = self.entities[change.entity_id]
+        attributes = self.attributes[change.entity_id]
+        position = next((i for i, attr in enumerate(attributes) if attr.key == change.key), None)
+        if position is None:
+            attributes.append(Attribute(key=change.key, value=change.value, type=change.type))
+        else:
+            current = attributes[position]
+            attributes[position] = Attribute(key=change.key, value=change.value, type=change.type or current.type)
+
+        old_refs = record.refs
+        updated = EntityRecord.from_attributes(record.id, record.entity_type, attributes)
+        record.values, record.refs = updated.values, updated.refs
+        self.index.update_references(record, old_refs, record.refs)
+
+        triggered: Set[Dep] = {('attr', record.id, change.key), ('refs', record.id)}
+        for value in set(old_refs) ^ set(record.refs):
+            triggered.update(('ref', value, etype) for etype in record.entity_type)
+        return triggered
+
+    def _propagate(self, triggered: Set[Dep]) -> Set[UnitKey]:
+        dirty = {k for dep in triggered for k in self.dependents.get(dep, ())}
+        changed: Set[UnitKey] = set()
+        for level in range(len(self.plan)):
+            step = self._run(sorted((k for k in dirty if self.nodes[k[1]].level == level), key=self._key_order))
+            # Saídas alteradas neste nível sujam as fórmulas derivadas dos seguintes
+            computed = {('computed', self._records_on(k)) for k in step}
+            dirty |= {k for dep in computed for k in self.dependents.get(dep, ())}
+            changed |= step
+        return changed
+
+    # ---- Avaliação -----------------------------------------------------
+
+    def _run(self, keys: List[UnitKey]) -> Set[UnitKey]:
+        """Recalcula as unidades (e os filhos que surgirem); devolve as que mudaram."""
+        changed: Set[UnitKey] = set()
+        queue = list(reversed(keys))
+        while queue:
+            key = queue.pop()
+            if key[0] == 'child' and not self.child_parents.get((key[1], key[-1])):
+                continue  # deixou de ser filho de algum pai nesta mesma rodada
+            unit = self.units.get(key)
+            if unit is None:
+                unit = self.units[key] = _Unit(key)
+            old_rows = unit.rows
+            deps = self._evaluate(unit, queue, changed)
+            self._set_deps(unit, deps)
+            if not _same_rows(unit.rows, old_rows):
+                changed.add(key)
+        return changed
+
+    def _set_deps(self, unit: _Unit, deps: Set[Dep]) -> None:
+        for dep in unit.deps - deps:
+            self.dependents[dep].discard(unit.key)
+        for dep in deps - unit.deps:
+            self.dependents.setdefault(dep, set()).add(unit.key)
+        unit.deps = deps
+
+    def _record(self, unit: _Unit, entity_id: str, formula: str, desc: Any, result: Any, result_type: Optional[str],
+                error: Optional[str] = None) -> None:
+        if unit.records_on is None and unit.key[0] != 'direct':
+            unit.records_on = entity_id
+            self.recorded.setdefault(entity_id, set()).add(unit.key)
+        unit.rows = [{
+            'entity_id': entity_id,
+            'formula': formula,
+            'resolved_formula': str(desc),
+            'result': float(result) if isinstance(result, (int, float)) else result,
+            'result_type': result_type,
+            'error': error,
+            'success': error is None
+        }]
+
+    def _evaluate(self, unit: _Unit, queue: List[UnitKey], changed: Set[UnitKey]) -> Set[Dep]:
+        kind, fi = unit.key[0], unit.key[1]
+        formula = self.formulas[fi]
+        entity_id = unit.key[-1] if kind != 'last' else None
+        # As dependências são registradas antes das leituras que podem falhar
+        deps: Set[Dep] = set()
+        try:
+            if kind == 'direct':
+                self._evaluate_direct(unit, deps, formula, unit.key[2], self.entities[entity_id])
+            elif kind == 'members':
+                self._evaluate_members(unit, deps, fi, formula, self.entities[entity_id], queue, changed)
+            elif kind == 'child':
+                self._evaluate_child(unit, deps, fi, formula, self.entities[entity_id])
+            elif kind == 'last':
+                self._evaluate_last(unit, deps, fi, formula)
+            elif kind == 'ref':
+                self._evaluate_ref(unit, deps, fi, formula, self.entities[entity_id])
+            else:
+                self._evaluate_derived(unit, deps, fi, unit.key[2], self.entities[entity_id])
+        except Exception as e:
+            target = entity_id or next(reversed(self.entities))
+            self._record(unit, target, formula, formula, None, None, error=str(e))
+            deps.add(('refs', target))
+        return deps
+
+    def _evaluate_direct(self, unit: _Unit, deps: Set[Dep], formula: str, entity_type: str, entity: EntityRecord) -> None:
+        plan = compile_formula(formula, entity_type)
+        deps.update(('attr', entity.id, attr) for attr in plan.attrs)
+        values = tuple(entity.get(attr) for attr in plan.attrs)
+        resolved = plan.render(values)
+        try:
+            res = plan.evaluate(values)
+        except Exception as e:
+            self._record(unit, entity.id, formula, resolved, None, None, error=str(e))
+            return
+        self._record(unit, entity.id, formula, resolved, res, type(res).__name__)
+
+    def _evaluate_members(self, unit: _Unit, deps: Set[Dep], fi: int, formula: str, parent: EntityRecord,
+                          queue: List[UnitKey], changed: Set[UnitKey]) -> None:
+        child_type = self.nodes[fi].aggregation.child_type
+        deps.add(('ref', parent.id, child_type))
+        children = [c.id for c in self.processor._get_related_by_value(parent.id, child_type)]
+        for child_id in set(unit.children) - set(children):
+            parents = self.child_parents[(fi, child_id)]
+            parents.discard(parent.id)
+            if not parents:
+                self._drop(('child', fi, child_id), changed)
+        for child_id in children:
+            parents = self.child_parents.setdefault((fi, child_id), set())
+            if not parents:
+                queue.append(('child', fi, child_id))
+            parents.add(parent.id)
+        unit.children = children
+
+    def _drop(self, key: UnitKey, changed: Set[UnitKey]) -> None:
+        unit = self.units.pop(key, None)
+        if unit is None:
+            return
+        self._set_deps(unit, set())
+        if unit.records_on is not None:
+            self.recorded[unit.records_on].discard(key)
+        changed.add(key)
+
+    def _evaluate_child(self, unit: _Unit, deps: Set[Dep], fi: int, formula: str, child: EntityRecord) -> None:
+        spec = self.nodes[fi].aggregation
+        deps.update((('attr', child.id, spec.left), ('ref', child.id, spec.grand_type)))
+        grandchildren = self.processor._get_related_by_value(child.id, spec.grand_type)
+        deps.update(('attr', gc.id, spec.right) for gc in grandchildren)
+        values = self.processor._iter_products(child, grandchildren, spec.left, spec.right)
+        desc = f"{spec.fn}({spec.left} * {spec.right})"
+        self._record(unit, child.id, formula, desc, reduce_group(spec.fn, values), 'float')
+
+    def _evaluate_last(self, unit: _Unit, deps: Set[Dep], fi: int, formula: str) -> None:
+        spec = self.nodes[fi].aggregation
+        parents = self.index.of_type(spec.parent_type)
+        if not parents:
+            unit.rows = []
+            return
+        parent = parents[-1]
+        deps.add(('ref', parent.id, spec.child_type))
+        products = []
+        for child in self.processor._get_related_by_value(parent.id, spec.child_type):
+            deps.add(('refs', child.id))
+            ref_entity = self.processor._find_ref_entity(child, spec.grand_type)
+            if ref_entity is not None:
+                deps.add(('attr', ref_entity.id, spec.right))
+            product = self.processor._pair_product(child, ref_entity, spec.left, spec.right)
+            if product is not None:
+                products.append(product)
+        # Mesmo comportamento de FormulaProcessor: registrado na última entidade
+        last_entity = next(reversed(self.entities))
+        desc = f"{spec.fn}({spec.child_type}.{spec.left} * {spec.grand_type}.{spec.right})"
+        self._record(unit, last_entity, formula, desc, reduce_group(spec.fn, products), 'float')
+
+    def _evaluate_ref(self, unit: _Unit, deps: Set[Dep], fi: int, formula: str, parent: EntityRecord) -> None:
+        spec = self.nodes[fi].aggregation
+        deps.add(('ref', parent.id, spec.child_type))
+        children = self.processor._get_related_by_value(parent.id, spec.child_type)
+        for child in children:
+            deps.update((('attr', child.id, spec.left), ('attr', child.id, spec.ref_attr)))
+            ref_entity = self.entities.get(child.values.get(spec.ref_attr))
+            if ref_entity is not None:
+                deps.add(('attr', ref_entity.id, spec.right))
+        values = self.processor._products_by_ref(children, spec.left, spec.ref_attr, spec.right)
+        desc = f"{spec.fn}({spec.child_type}.{spec.left} * @{spec.ref_attr}.{spec.right})"
+        self._record(unit, parent.id, formula, desc, reduce_group(spec.fn, values), 'float')
+
+    def _evaluate_derived(self, unit: _Unit, deps: Set[Dep], fi: int, entity_type: str, entity: EntityRecord) -> None:
+        node = self.nodes[fi]
+        plan = compile_formula(node.expression, entity_type, tuple(node.symbols))
+        deps.update(('attr', entity.id, attr) for attr in plan.attrs)
+        for member_type, _ in node.symbols.values():
+            if member_type is None:
+                deps.add(('computed', entity.id))
+                continue
+            deps.add(('ref', entity.id, member_type))
+            deps.update(('computed', m.id) for m in self.processor._get_related_by_value(entity.id, member_type))
+        desc, result, result_type, error = self.processor._derive(node, plan, entity, self._output)
+        self._record(unit, entity.id, node.formula, desc, result, result_type, error=error)
+
+    def _output(self, entity_id: str, name: str) -> Any:
+        """Primeiro valor da saída `name` registrado na entidade, como em FormulaProcessor.outputs."""
+        for key in sorted(self.recorded.get(entity_id, ()), key=self._key_order):
+            if name not in self.nodes[key[1]].provides:
+                continue
+            for row in self.units[key].rows:
+                if row['success']:
+                    return row['result']
+        return 0.0
+
+    # ---- Saída ---------------------------------------------------------
+
+    def _records_on(self, key: UnitKey) -> Optional[str]:
+        unit = self.units.get(key)
+        if unit is not None:
+            return unit.records_on
+        return key[-1] if key[0] in ('child', 'ref', 'derived') else None
+
+    def _key_order(self, key: UnitKey) -> Tuple[Any, ...]:
+        kind = key[0]
+        position: Tuple[int, ...] = (self.index.position.get(key[-1], -1),) if kind != 'last' else (-1,)
+        if kind == 'child':
+            # Como em FormulaProcessor: filhos na ordem em que o percurso dos
+            # pais os encontra, e um filho de vários pais na vez do primeiro
+            parents = self.child_parents.get((key[1], key[-1]))
+            if parents:
+                position = (min(self.index.position[p] for p in parents),) + position
+        # Fórmulas diretas e derivadas percorrem os tipos na ordem em que aparecem na fórmula
+        node = self.nodes[key[1]]
+        scope = node.scope.index(key[2]) if kind in ('direct', 'derived') else -1
+        return (node.level, key[1], _KIND_ORDER[kind], scope, position)
+
+    def _visits(self, key: UnitKey) -> int:
+        # FormulaProcessor registra o atributo do filho uma vez por pai que o percorre
+        if key[0] != 'child':
+            return 1
+        return max(len(self.child_parents.get((key[1], key[-1]), ())), 1)
+
+    def _sort_key(self, unit: _Unit) -> Tuple[Any, ...]:
+        return self._key_order(unit.key)
+
+    def _entity_outputs(self, entity_ids: Iterable[str]) -> List[EntityOutput]:
+        outputs = []
+        for entity_id in sorted(entity_ids, key=lambda i: self.index.position[i]):
+            computed = [
+                ComputedAttribute(key=row['resolved_formula'], value=row['result'], description=row['resolved_formula'])
+                for key in sorted(self.recorded.get(entity_id, ()), key=self._key_order)
+                for row in self.units[key].rows
+                if row['success']
+                for _ in range(self._visits(key))
+            ]
+            outputs.append(EntityOutput(id=entity_id, entity_type=self.entities[entity_id].entity_type, computed=computed))
+        return outputs
+
+
+class SessionManager:
+    """Sessões em memória do processo, com expiração por inatividade e limite de quantidade."""
+
+    def __init__(self, max_sessions: int = 64, ttl: float = 3600.0):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions: 'OrderedDict[str, CalculationSession]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, entities: List[EntityInput], formulas: List[str]) -> Tuple[str, CalculationSession]:
+        session = CalculationSession(entities, formulas)
+        session_id = uuid.uuid4().hex
+        with self._lock:
+            self._expire()
+            self._sessions[session_id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return session_id, session
+
+    def get(self, session_id: str) -> Optional[CalculationSession]:
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.last_used = time.monotonic()
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def _expire(self) -> None:
+        deadline = time.monotonic() - self.ttl
+        for session_id in [k for k, s in self._sessions.items() if s.last_used < deadline]:
+            del self._sessions[session_id]
+
+
+sessions = SessionManager(max_sessions=config.SESSION_MAX, ttl=config.SESSION_TTL)
@@ -0,0 +1,204 @@
+import hashlib
+import marshal
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from app import config
+from app.services.codec import dumps
+from app.services.entity_store import EntityRecord, EntityStore, InvalidNumber
+
+# Cabeçalho do arquivo: marca, versão do formato, versão do Python (o
+# formato do marshal pode mudar entre versões), entidades e atributos
+_HEADER = struct.Struct('<4sHHQQ')
+_MAGIC = b'AMFS'
+_VERSION = 1
+_PYTHON = sys.version_info[0] * 100 + sys.version_info[1]
+_REF = re.compile(r'^[0-9a-f]{64}$')
+
+
+class SnapshotNotFound(LookupError):
+    """Nenhum snapshot com este hash."""
+
+
+class SnapshotTooLarge(ValueError):
+    """O snapshot sozinho passa do limite de disco."""
+
+
+class SnapshotInfo:
+    """Metadados de um snapshot; é o que viaja até o executor no lugar das entidades."""
+    __slots__ = ('ref', 'entities', 'attributes', 'size')
+
+    def __init__(self, ref: str, entities: int, attributes: int, size: int):
+        self.ref = ref
+        self.entities = entities
+        self.attributes = attributes
+        self.size = size
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'entities_ref': self.ref, 'entity_count': self.entities, 'attribute_count': self.attributes, 'size': self.size
+        }
+
+
+def snapshot_ref(entities: List[Dict[str, Any]]) -> str:
+    """Hash do conteúdo das entidades, independente da ordem das chaves dos objetos."""
+    return hashlib.sha256(dumps(entities, sort_keys=True)).hexdigest()
+
+
+def _pack(record: EntityRecord) -> tuple:
+    # InvalidNumber não passa pelo marshal: vai como (raw, message) e a chave é anotada
+    values = record.values
+    invalid = tuple(k for k, v in values.items() if v.__class__ is InvalidNumber)
+    if invalid:
+        values = {k: (v.raw, v.message) if k in invalid else v for k, v in values.items()}
+    return record.id, record.entity_type, values, record.refs, invalid
+
+
+def _unpack(fields: tuple) -> EntityRecord:
+    entity_id, entity_type, values, refs, invalid = fields
+    for key in invalid:
+        values[key] = InvalidNumber(*values[key])
+    return EntityRecord(entity_id, entity_type, values, refs)
+
+
+def _touch(path: str) -> None:
+    # A data de modificação marca o último uso, para a remoção por limite de disco
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+class SnapshotStore:
+    """
+    Conjuntos de entidades enviados uma vez e referenciados pelo hash do
+    conteúdo. Cada snapshot é gravado em `directory` como os registros já
+    decodificados (marshal), e os mais usados ficam em memória com o índice
+    de relacionamentos pronto, num LRU de até `max_cached` snapshots.
+
+    Os arquivos somam no máximo `max_bytes`: ao gravar um novo, os usados há
+    mais tempo (pela data de modificação, renovada a cada uso) são apagados.
+    """
+
+    def __init__(self, directory: str = 'snapshots', max_cached: int = 8, max_bytes: int = 1024 ** 3):
+        self.directory = directory
+        self.max_cached = max_cached
+        self.max_bytes = max_bytes
+        self._cache: 'OrderedDict[str, EntityStore]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls) -> 'SnapshotStore':
+        return cls(
+            directory=config.SNAPSHOT_DIR, max_cached=config.SNAPSHOT_CACHE_ENTRIES, max_bytes=config.SNAPSHOT_MAX_BYTES
+        )
+
+    def _path(self, ref: str) -> Optional[str]:
+        # Só aceita o formato do hash, o que também impede caminhos fora do diretório
+        if not isinstance(ref, str) or not _REF.match(ref):
+            return None
+        return os.path.join(self.directory, ref + '.snap')
+
+    def put(self, records: List[EntityRecord], entities: List[Dict[str, Any]]) -> SnapshotInfo:
+        """Grava as entidades (registros e forma normalizada) e devolve o snapshot."""
+        ref = snapshot_ref(entities)
+        path = self._path(ref)
+        attributes = sum(len(record.refs) for record in records)
+        if os.path.exists(path):
+            _touch(path)
+        else:
+            data = marshal.dumps([_pack(record) for record in records])
+            if _HEADER.size + len(data) > self.max_bytes:
+                raise SnapshotTooLarge(
+                    f"Snapshot has {_HEADER.size + len(data)} bytes, more than the {self.max_bytes} bytes allowed"
+                )
+            os.makedirs(self.directory, exist_ok=True)
+            temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp, 'wb') as f:
+                f.write(_HEADER.pack(_MAGIC, _VERSION, _PYTHON, len(records), attributes))
+                f.write(data)
+            os.replace(temp, path)
+            self._evict(keep=path)
+        return SnapshotInfo(ref, len(records), attributes, os.path.getsize(path))
+
+    def _evict(self, keep: str) -> None:
+        """Apaga os snapshots usados há mais tempo até o total caber em max_bytes."""
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.snap'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue  # apagado por outro processo
+                files.append((stat.st_mtime, entry.path, stat.st_size))
+        total = sum(size for _, _, size in files)
+        for _, path, size in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            self.delete(os.path.basename(path)[:-len('.snap')])
+            total -= size
+
+    def info(self, ref: str) -> Optional[SnapshotInfo]:
+        """Metadados do snapshot, lidos só do cabeçalho; None se não existir."""
+        path = self._path(ref)
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(_HEADER.size)
+                size = os.fstat(f.fileno()).st_size
+        except (OSError, TypeError):
+            return None
+        if len(header) < _HEADER.size:
+            return None
+        magic, version, python, entities, attributes = _HEADER.unpack(header)
+        if magic != _MAGIC or version != _VERSION or python != _PYTHON:
+            return None
+        return SnapshotInfo(ref, entities, attributes, size)
+
+    def load(self, ref: str) -> Optional[EntityStore]:
+        """Entidades do snapshot com o índice montado; None se não existir."""
+        with self._lock:
+            store = self._cache.get(ref)
+            if store is not None:
+                self._cache.move_to_end(ref)
+        if store is not None:
+            _touch(self._path(ref))
+            return store
+        if self.info(ref) is None:
+            return None
+        try:
+            with open(self._path(ref), 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                with memoryview(data) as view, view[_HEADER.size:] as body:
+                    packed = marshal.loads(body)
+        except FileNotFoundError:
+            return None  # removido por outro processo depois de info()
+        _touch(self._path(ref))
+        store = EntityStore(_unpack(fields) for fields in packed)
+        with self._lock:
+            self._cache[ref] = store
+            self._cache.move_to_end(ref)
+            while len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+        return store
+
+    def delete(self, ref: str) -> bool:
+        path = self._path(ref)
+        with self._lock:
+            self._cache.pop(ref, None)
+        try:
+            os.remove(path)
+        except (OSError, TypeError):
+            return False
+        return True
+
+
+snapshots = SnapshotStore.from_config()
@@ -0,0 +1,133 @@
+import ast
+from typing import Any, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.services.expression import CompiledFormula
+
+# Abaixo disso o custo de montar as colunas não compensa
+VECTORIZE_MIN_ROWS = 256
+
+# Inteiros até 2**53 são representados exatamente em float64
+_EXACT_INT = float(2 ** 53)
+
+_BINARY_OPS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.divide,
+}
+
+
+class ColumnBatch:
+    """
+    Resultado da avaliação vetorizada de um plano.
+
+    `ok[i]` indica se a linha i pôde ser calculada com o mesmo resultado da
+    avaliação escalar; as demais devem ser reavaliadas uma a uma.
+    """
+    __slots__ = ('values', 'is_int', 'ok')
+
+    def __init__(self, values: np.ndarray, is_int: np.ndarray, ok: np.ndarray):
+        self.values = values
+        self.is_int = is_int
+        self.ok = ok
+
+
+def is_vectorizable(plan: CompiledFormula) -> bool:
+    """Só aritmética básica sobre atributos e constantes numéricas."""
+    if plan.error is not None or plan.tree is None:
+        return False
+    slots = {f"_v{i}" for i in range(len(plan.attrs))}
+    for node in ast.walk(plan.tree.body):
+        if isinstance(node, ast.BinOp):
+            if type(node.op) not in _BINARY_OPS:
+                return False
+        elif isinstance(node, ast.UnaryOp):
+            if not isinstance(node.op, (ast.USub, ast.UAdd)):
+                return False
+        elif isinstance(node, ast.Constant):
+            if type(node.value) is float:
+                continue
+            if type(node.value) is not int or abs(node.value) > _EXACT_INT:
+                return False
+        elif isinstance(node, ast.Name):
+            if node.id not in slots:
+                return False
+        elif not isinstance(node, (ast.Load, ast.operator, ast.unaryop)):
+            return False
+    return True
+
+
+def _column(values: Sequence[Any]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    n = len(values)
+    kinds = [type(v) for v in values]
+    is_int = np.fromiter((k is int for k in kinds), bool, n)
+    ok = np.fromiter(
+        (k is float or (k is int and abs(v) <= _EXACT_INT) for k, v in zip(kinds, values)),
+        bool, n
+    )
+    column = np.fromiter((v if good else 0.0 for v, good in zip(values, ok)), np.float64, n)
+    return column, is_int, ok
+
+
+class _Evaluator:
+    def __init__(self, columns: List[Tuple[np.ndarray, np.ndarray]], n: int):
+        self.columns = columns
+        self.n = n
+        self.ok = np.ones(n, dtype=bool)
+
+    def eval(self, node: ast.AST) -> Tuple[np.ndarray, np.ndarray]:
+        if isinstance(node, ast.Name):
+            return self.columns[int(node.id[2:])]
+        if isinstance(node, ast.Constant):
+            return (
+                np.full(self.n, float(node.value)),
+                np.full(self.n, type(node.value) is int)
+            )
+        if isinstance(node, ast.UnaryOp):
+            values, is_int = self.eval(node.operand)
+            if isinstance(node.op, ast.USub):
+                values = self._normalize(-values, is_int)
+            return values, is_int
+        left, left_int = self.eval(node.left)
+        right, right_int = self.eval(node.right)
+        if isinstance(node.op, ast.Div):
+            # ZeroDivisionError no modo escalar
+            self.ok &= right != 0
+            with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+                return np.divide(left, right), np.zeros(self.n, dtype=bool)
+        with np.errstate(over='ignore', invalid='ignore'):
+            values = _BINARY_OPS[type(node.op)](left, right)
+        is_int = left_int & right_int
+        # Inteiros fora da faixa exata do float64 ficam para o modo escalar
+        self.ok &= ~is_int | (np.abs(values) <= _EXACT_INT)
+        return self._normalize(values, is_int), is_int
+
+    @staticmethod
+    def _normalize(values: np.ndarray, is_int: np.ndarray) -> np.ndarray:
+        # Inteiros Python não têm -0
+        return np.where(is_int, values + 0.0, values)
+
+
+def evaluate_batch(plan: CompiledFormula, rows: Sequence[Tuple[Any, ...]]) -> Optional[ColumnBatch]:
+    """
+    Avalia o plano sobre todas as linhas de uma vez.
+
+    Retorna None quando o plano não é vetorizável; linhas com valores
+    ausentes, não numéricos ou que levariam a erro ficam com `ok=False`.
+    """
+    if not is_vectorizable(plan):
+        return None
+    n = len(rows)
+    columns = []
+    row_ok = np.ones(n, dtype=bool)
+    for i in range(len(plan.attrs)):
+        column, is_int, ok = _column([row[i] for row in rows])
+        columns.append((column, is_int))
+        row_ok &= ok
+    evaluator = _Evaluator(columns, n)
+    evaluator.ok &= row_ok
+    values, is_int = evaluator.eval(plan.tree.body)
+    ok = evaluator.ok & np.isfinite(values)
+    return ColumnBatch(values, is_int, ok)
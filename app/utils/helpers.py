@@ -1,5 +1,6 @@
-from typing import List, Union
+from typing import List, Optional, Union
 from app.models.schemas import EntityInput
+from app.services.entity_index import EntityIndex
 
 # helpers.py
 def get_attribute_value(entity: EntityInput, key: str) -> Union[float, int, str]:
@@ -19,9 +20,23 @@ def find_related_entities(
     target_type: str,
     reference_attr: str,
     all_entities: List[EntityInput],
-    target_reference_attr: str
+    target_reference_attr: str,
+    index: Optional[EntityIndex] = None
 ) -> List[EntityInput]:
     source_values = [attr.value for attr in source.attributes if attr.key == reference_attr]
+    if index is not None:
+        # Só visita as entidades que referenciam algum dos valores de origem
+        candidates = {}
+        for value in source_values:
+            for e in index.referencing(value, target_type):
+                candidates[id(e)] = e
+        return sorted(
+            (
+                e for e in candidates.values()
+                if any(attr.key == target_reference_attr and attr.value in source_values for attr in e.attributes)
+            ),
+            key=lambda e: index.position[e.id]
+        )
     return [
         e for e in all_entities
         if target_type in e.entity_type and
@@ -0,0 +1,100 @@
+import random
+from typing import Any, Dict, Iterator, List, Tuple
+
+from app.models.schemas import EntityInput
+
+# Fórmulas por fase, nos formatos que o motor reconhece
+PHASE_FORMULAS: Dict[str, List[str]] = {
+    'direct': [
+        "Contract.value * 2",
+        "Servico.Quantidade + 1",
+        "Medicao.Quantidade * Medicao.Preco",
+    ],
+    'aggregation': [
+        # AGG_PATTERN
+        "SUM(Contract.Servico.Quantidade * Contract.Servico.Medicao.Preco)",
+        "AVG(Contract.Servico.Quantidade * Contract.Servico.Medicao.Preco)",
+        # AGG_REF_PATTERN
+        "SUM(Contract.Servico.Quantidade * @itemId.Preco)",
+        "MAX(Contract.Servico.Quantidade * @itemId.Preco)",
+    ],
+    'tributo': [
+        "Contract.ISS * TotalDosServicos",
+    ],
+}
+
+
+def all_formulas() -> List[str]:
+    return [formula for formulas in PHASE_FORMULAS.values() for formula in formulas]
+
+
+def _attr(key: str, value: Any, type_: str) -> Dict[str, Any]:
+    return {'key': key, 'value': value, 'type': type_}
+
+
+def hierarchy_size(contracts: int, services: int, measurements: int, items: int) -> int:
+    return items + contracts * (1 + services * (1 + measurements))
+
+
+def contracts_for(total: int, services: int, measurements: int, items: int) -> int:
+    """Quantidade de contratos para chegar perto de `total` entidades com o fan-out dado."""
+    per_contract = 1 + services * (1 + measurements)
+    return max(1, (total - items) // per_contract)
+
+
+def iter_entities(
+    contracts: int, services: int, measurements: int, items: int = 100, seed: int = 0
+) -> Iterator[Dict[str, Any]]:
+    """
+    Hierarquia Contract -> Servico -> Medicao, mais um catálogo de Item
+    referenciado por `itemId`. Os atributos seguem o formato das requisições
+    reais: valores numéricos como string, `contractId`/`serviceId` como
+    referência e `id` repetido como atributo (usado pelo calculator_v1).
+    """
+    rnd = random.Random(seed)
+    item_ids = [f"item_{i}" for i in range(max(items, 1))]
+    for item_id in item_ids:
+        yield {'id': item_id, 'entity_type': ['Item'], 'attributes': [
+            _attr('Preco', f"{rnd.uniform(1, 500):.2f}", 'number'),
+        ]}
+    for c in range(contracts):
+        contract_id = f"contract_{c}"
+        yield {'id': contract_id, 'entity_type': ['Contract'], 'attributes': [
+            _attr('id', contract_id, 'string'),
+            _attr('value', str(rnd.randint(1000, 10 ** 6)), 'number'),
+            _attr('ISS', rnd.choice(['0.02', '0.03', '0.05']), 'number'),
+            _attr('nome', f"Contrato {c}", 'string'),
+        ]}
+        for s in range(services):
+            service_id = f"servico_{c}_{s}"
+            yield {'id': service_id, 'entity_type': ['Servico'], 'attributes': [
+                _attr('id', service_id, 'string'),
+                _attr('contractId', contract_id, 'string'),
+                _attr('Quantidade', str(rnd.randint(1, 100)), 'number'),
+                _attr('itemId', rnd.choice(item_ids), 'string'),
+                _attr('nome', f"Servico {s}", 'string'),
+            ]}
+            for m in range(measurements):
+                yield {'id': f"medicao_{c}_{s}_{m}", 'entity_type': ['Medicao'], 'attributes': [
+                    _attr('serviceId', service_id, 'string'),
+                    _attr('Quantidade', str(rnd.randint(0, 50)), 'number'),
+                    _attr('Preco', f"{rnd.uniform(0, 200):.3f}", 'number'),
+                ]}
+
+
+def generate_payload(
+    entities: int, services: int = 10, measurements: int = 5, items: int = 100, seed: int = 0
+) -> Dict[str, Any]:
+    """Corpo de /calculate com cerca de `entities` entidades."""
+    contracts = contracts_for(entities, services, measurements, items)
+    return {
+        'entities': list(iter_entities(contracts, services, measurements, items, seed)),
+        'formulas': all_formulas(),
+    }
+
+
+def generate_entities(
+    entities: int, services: int = 10, measurements: int = 5, items: int = 100, seed: int = 0
+) -> Tuple[List[EntityInput], List[str]]:
+    payload = generate_payload(entities, services, measurements, items, seed)
+    return [EntityInput(**e) for e in payload['entities']], payload['formulas']
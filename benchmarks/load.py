@@ -0,0 +1,457 @@
+"""
+Teste de carga do serviço.
+
+Dispara requisições concorrentes contra `app.main:app`, no mesmo processo
+(chamando a aplicação ASGI direto) ou num uvicorn local, com uma mistura de
+payloads pequenos e grandes. Mede vazão, latência (p50/p95/p99) por tamanho
+de payload, pico de RSS e, no modo em processo, o atraso do event loop, que
+denuncia cálculos rodando dentro dele:
+
+    python -m benchmarks.load --concurrency 16 --duration 30 --mix 100:8,5000:2,50000:1
+    python -m benchmarks.load --spawn --workers 4 --requests 500
+    python -m benchmarks.load --url http://127.0.0.1:8000 --concurrency 64
+
+Sem --cache, o cache de resultados é desligado no processo testado (em
+processo e com --spawn), já que os payloads se repetem.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from benchmarks.generators import generate_payload
+from benchmarks.run import _git_revision
+
+# (status, bytes da resposta)
+Reply = Tuple[int, int]
+Send = Callable[[str, bytes, Dict[str, str]], Any]
+
+
+def _parse_mix(value: str) -> List[Tuple[int, float]]:
+    """`100:8,5000:2` -> [(100, 8.0), (5000, 2.0)]: entidades e peso de cada tamanho."""
+    mix = []
+    for item in value.split(','):
+        size, _, weight = item.partition(':')
+        mix.append((int(size), float(weight or 1)))
+    return mix
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    ordered = sorted(values)
+    cuts = statistics.quantiles(ordered, n=100, method='inclusive') if len(ordered) > 1 else ordered * 99
+    return {
+        'p50': cuts[49], 'p95': cuts[94], 'p99': cuts[98],
+        'mean': statistics.fmean(ordered), 'max': ordered[-1],
+    }
+
+
+def _process_tree(pid: int) -> List[int]:
+    """`pid` e seus descendentes, pelo /proc (só Linux)."""
+    pids, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        pids.append(current)
+        try:
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return pids
+
+
+def _rss_kb(pid: int, field: str) -> int:
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+class RssSampler:
+    """
+    Pico de memória do processo testado somado ao dos seus filhos (pools de
+    processos). O pico de cada processo vem do VmHWM do kernel; a soma é
+    amostrada porque os filhos podem atingir o pico em momentos diferentes.
+    """
+
+    def __init__(self, pid: int, interval: float = 0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak_tree_kb = 0
+        self.peaks: Dict[int, int] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def sample(self) -> None:
+        total = 0
+        for pid in _process_tree(self.pid):
+            total += _rss_kb(pid, 'VmRSS')
+            self.peaks[pid] = max(self.peaks.get(pid, 0), _rss_kb(pid, 'VmHWM'))
+        self.peak_tree_kb = max(self.peak_tree_kb, total)
+
+    async def _run(self) -> None:
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> Dict[str, float]:
+        if self._task is not None:
+            self._task.cancel()
+        self.sample()
+        peak_kb = self.peaks.get(self.pid, 0)
+        if not peak_kb and self.pid == os.getpid():
+            peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # sem /proc
+        return {
+            'peak_rss_mb': peak_kb / 1024,
+            'peak_tree_rss_mb': max(self.peak_tree_kb, peak_kb) / 1024,
+            'processes': len(self.peaks) or 1,
+        }
+
+
+class LoopLag:
+    """Atraso do event loop: quanto um sleep de `interval` passa do previsto."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(time.perf_counter() - started - self.interval, 0.0))
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> Dict[str, float]:
+        if self._task is not None:
+            self._task.cancel()
+        return {k: v * 1000 for k, v in _percentiles(self.samples).items()}
+
+
+def asgi_sender(app: Any) -> Send:
+    """Envia requisições direto para a aplicação ASGI, sem rede."""
+
+    async def send_request(path: str, body: bytes, headers: Dict[str, str]) -> Reply:
+        path, _, query = path.partition('?')
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST',
+            'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': query.encode(),
+            'root_path': '', 'client': ('127.0.0.1', 0), 'server': ('127.0.0.1', 80),
+            'headers': [(k.lower().encode(), v.encode()) for k, v in headers.items()]
+                       + [(b'content-length', str(len(body)).encode())],
+        }
+        sent = False
+        disconnected = asyncio.Event()
+        reply = [0, 0]
+
+        async def receive() -> Dict[str, Any]:
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message: Dict[str, Any]) -> None:
+            if message['type'] == 'http.response.start':
+                reply[0] = message['status']
+            elif message['type'] == 'http.response.body':
+                reply[1] += len(message.get('body', b''))
+
+        try:
+            await app(scope, receive, send)
+        finally:
+            disconnected.set()
+        return reply[0], reply[1]
+
+    return send_request
+
+
+class HttpConnection:
+    """Conexão HTTP/1.1 keep-alive mínima (Content-Length ou chunked), sem dependências."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def _read_body(self, headers: Dict[str, str]) -> int:
+        if 'content-length' in headers:
+            length = int(headers['content-length'])
+            await self.reader.readexactly(length)
+            return length
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            total = 0
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                await self.reader.readexactly(size + 2)
+                total += size
+                if size == 0:
+                    return total
+        body = await self.reader.read()
+        await self.close()
+        return len(body)
+
+    async def request(self, path: str, body: bytes, headers: Dict[str, str]) -> Reply:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=2 ** 20)
+        head = [f"POST {path} HTTP/1.1", f"Host: {self.host}:{self.port}", f"Content-Length: {len(body)}"]
+        head.extend(f"{k}: {v}" for k, v in headers.items())
+        self.writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + body)
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        response_headers: Dict[str, str] = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            response_headers[key.strip().lower()] = value.strip()
+        size = await self._read_body(response_headers)
+        if response_headers.get('connection', '').lower() == 'close':
+            await self.close()
+        return status, size
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def spawn_uvicorn(port: int, workers: int, env: Dict[str, str]) -> subprocess.Popen:
+    command = [sys.executable, '-m', 'uvicorn', 'app.main:app', '--host', '127.0.0.1', '--port', str(port),
+               '--workers', str(workers), '--log-level', 'warning']
+    process = subprocess.Popen(command, env={**os.environ, **env})
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"uvicorn exited with code {process.returncode}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("uvicorn did not start listening in 60s")
+
+
+async def drive(
+    senders: List[Send],
+    payloads: List[Tuple[int, bytes]],
+    weights: List[float],
+    path: str,
+    headers: Dict[str, str],
+    requests: Optional[int],
+    duration: Optional[float],
+    warmup: int,
+    seed: int
+) -> Tuple[List[Tuple[int, float, int, int]], float]:
+    """
+    Carga em malha fechada: cada sender manda uma requisição por vez, com o
+    tamanho sorteado pelos pesos. Devolve (tamanho, latência, status, bytes)
+    de cada requisição medida e o tempo total da medição.
+    """
+    rnd = random.Random(seed)
+    for _ in range(warmup):
+        size, body = rnd.choices(payloads, weights)[0]
+        await senders[0](path, body, headers)
+
+    samples: List[Tuple[int, float, int, int]] = []
+    issued = 0
+    started = time.perf_counter()
+    deadline = started + duration if duration else None
+
+    async def worker(send: Send) -> None:
+        nonlocal issued
+        while (requests is None or issued < requests) and (deadline is None or time.perf_counter() < deadline):
+            issued += 1
+            size, body = rnd.choices(payloads, weights)[0]
+            sent = time.perf_counter()
+            try:
+                status, nbytes = await send(path, body, headers)
+            except Exception as e:
+                print(f"request failed: {e!r}", file=sys.stderr)
+                status, nbytes = 0, 0
+            samples.append((size, time.perf_counter() - sent, status, nbytes))
+
+    await asyncio.gather(*(worker(send) for send in senders))
+    return samples, time.perf_counter() - started
+
+
+def summarize(samples: List[Tuple[int, float, int, int]], elapsed: float) -> Dict[str, Any]:
+    def stats(rows: List[Tuple[int, float, int, int]]) -> Dict[str, Any]:
+        statuses: Dict[str, int] = {}
+        for _, _, status, _ in rows:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        return {
+            'requests': len(rows),
+            'throughput': len(rows) / elapsed if elapsed else 0.0,
+            'statuses': statuses,
+            'latency_ms': {k: v * 1000 for k, v in _percentiles([r[1] for r in rows]).items()},
+            'response_bytes': sum(r[3] for r in rows),
+        }
+
+    by_size = {}
+    for size in sorted({r[0] for r in samples}):
+        by_size[str(size)] = stats([r for r in samples if r[0] == size])
+    return {'elapsed': elapsed, 'total': stats(samples), 'by_size': by_size}
+
+
+def _print_report(report: Dict[str, Any]) -> None:
+    rows = [('all', report['total'])] + list(report['by_size'].items())
+    print(f"{'entities':>9} {'reqs':>6} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}  status",
+          file=sys.stderr)
+    for name, stats in rows:
+        latency = stats['latency_ms']
+        print(f"{name:>9} {stats['requests']:>6} {stats['throughput']:>8.1f} {latency.get('p50', 0):>9.1f} "
+              f"{latency.get('p95', 0):>9.1f} {latency.get('p99', 0):>9.1f} {latency.get('max', 0):>9.1f}  "
+              f"{stats['statuses']}", file=sys.stderr)
+    memory = report['memory']
+    print(f"peak RSS {memory['peak_rss_mb']:.0f} MB (with {memory['processes'] - 1} child processes: "
+          f"{memory['peak_tree_rss_mb']:.0f} MB)", file=sys.stderr)
+    if report.get('loop_lag_ms'):
+        lag = report['loop_lag_ms']
+        print(f"event loop lag p99 {lag['p99']:.1f} ms, max {lag['max']:.1f} ms", file=sys.stderr)
+
+
+async def _run(args: argparse.Namespace, payloads: List[Tuple[int, bytes]], weights: List[float]) -> Dict[str, Any]:
+    headers = {'Content-Type': 'application/json'}
+    if args.gzip:
+        headers['Accept-Encoding'] = 'gzip'
+    path = args.path + (f"?{args.query}" if args.query else '')
+    process = None
+    lag = None
+    connections: List[HttpConnection] = []
+    env = {} if args.cache else {'CACHE_ENABLED': 'false'}
+
+    if args.url or args.spawn:
+        if args.spawn:
+            port = _free_port()
+            process = spawn_uvicorn(port, args.workers, env)
+            host, pid = '127.0.0.1', process.pid
+        else:
+            url = urlsplit(args.url)
+            host, port, pid = url.hostname, url.port or 80, None
+        connections = [HttpConnection(host, port) for _ in range(args.concurrency)]
+        senders: List[Send] = [c.request for c in connections]
+        lifespan = None
+    else:
+        from app.main import app
+        from app.services.cache import result_cache
+        result_cache.enabled = args.cache
+        sender = asgi_sender(app)
+        senders = [sender] * args.concurrency
+        pid = os.getpid()
+        lifespan = app.router.lifespan_context(app)
+        await lifespan.__aenter__()
+        lag = LoopLag()
+
+    sampler = RssSampler(pid) if pid is not None else None
+    try:
+        if sampler is not None:
+            sampler.start()
+        if lag is not None:
+            lag.start()
+        samples, elapsed = await drive(
+            senders, payloads, weights, path, headers, args.requests, args.duration, args.warmup, args.seed
+        )
+        report = summarize(samples, elapsed)
+        report['loop_lag_ms'] = lag.stop() if lag is not None else None
+        report['memory'] = await sampler.stop() if sampler is not None else {
+            'peak_rss_mb': 0.0, 'peak_tree_rss_mb': 0.0, 'processes': 0
+        }
+    finally:
+        for connection in connections:
+            await connection.close()
+        if lifespan is not None:
+            await lifespan.__aexit__(None, None, None)
+        if process is not None:
+            process.terminate()
+            process.wait()
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Teste de carga do serviço de fórmulas")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--url', help="servidor já em execução, ex.: http://127.0.0.1:8000")
+    target.add_argument('--spawn', action='store_true', help="sobe um uvicorn local para o teste")
+    parser.add_argument('--workers', type=int, default=1, help="workers do uvicorn com --spawn")
+    parser.add_argument('--concurrency', type=int, default=8, help="requisições simultâneas")
+    parser.add_argument('--requests', type=int, help="total de requisições medidas")
+    parser.add_argument('--duration', type=float, help="segundos de medição (padrão: 10, sem --requests)")
+    parser.add_argument('--warmup', type=int, default=3, help="requisições antes da medição")
+    parser.add_argument('--mix', default='100:8,5000:2,50000:1',
+                        help="entidades:peso de cada tamanho de payload, separados por vírgula")
+    parser.add_argument('--fanout', default='10x5', help="servicos por contrato x medicoes por servico")
+    parser.add_argument('--path', default='/api/v1/calculate')
+    parser.add_argument('--query', default='', help="query string, ex.: format=columnar")
+    parser.add_argument('--gzip', action='store_true', help="envia Accept-Encoding: gzip")
+    parser.add_argument('--cache', action='store_true', help="mantém o cache de resultados ligado")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='load_output.json')
+    args = parser.parse_args(argv)
+    if args.requests is None and args.duration is None:
+        args.duration = 10.0
+    args.concurrency = max(args.concurrency, 1)
+
+    from app.services.codec import dumps
+    services, measurements = (int(n) for n in args.fanout.split('x'))
+    mix = _parse_mix(args.mix)
+    payloads = [
+        (size, dumps(generate_payload(size, services, measurements, seed=args.seed)))
+        for size, _ in mix
+    ]
+    report = asyncio.run(_run(args, payloads, [weight for _, weight in mix]))
+    report['meta'] = {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'target': args.url or ('uvicorn' if args.spawn else 'in-process'),
+        'workers': args.workers if args.spawn else None,
+        'concurrency': args.concurrency,
+        'mix': {str(size): weight for size, weight in mix},
+        'payload_bytes': {str(size): len(body) for size, body in payloads},
+        'path': args.path,
+        'query': args.query,
+        'gzip': args.gzip,
+        'cache': args.cache,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    _print_report(report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,226 @@
+"""
+Benchmark do motor de fórmulas.
+
+Gera hierarquias Contract -> Servico -> Medicao de vários tamanhos e mede
+cada fase (ingestão, fórmulas diretas, agregações, tributo e montagem da
+saída) no FormulaProcessor atual e no calculator_v1. O resultado é gravado
+em JSON para comparar uma execução com outra:
+
+    python -m benchmarks.run --sizes 1000,10000,100000 --fanout 10x5,50x20
+    python -m benchmarks.run --baseline bench_output.json --output novo.json
+"""
+import argparse
+import datetime
+import gc
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app import config
+from app.services.calculator import FormulaProcessor
+from app.services.planner import plan_formulas
+from benchmarks.generators import PHASE_FORMULAS, generate_entities
+
+PHASES = ('ingest', 'direct', 'aggregation', 'tributo', 'output')
+PHASE_OF = {formula: phase for phase, formulas in PHASE_FORMULAS.items() for formula in formulas}
+
+Timings = Dict[str, float]
+
+
+def run_current(entities: List[Any], formulas: List[str]) -> Tuple[Timings, int]:
+    timings = dict.fromkeys(PHASES, 0.0)
+    start = time.perf_counter()
+    processor = FormulaProcessor(entities)
+    timings['ingest'] = time.perf_counter() - start
+
+    # _run avança uma fórmula por vez, na ordem do plano
+    order = [node.formula for level in plan_formulas(formulas) for node in level]
+    start = time.perf_counter()
+    for formula, _ in zip(order, processor._run(formulas)):
+        now = time.perf_counter()
+        timings[PHASE_OF.get(formula, 'direct')] += now - start
+        start = now
+
+    # Monta os dicts de cada linha, como calculator_v1 faz em direct_results
+    start = time.perf_counter()
+    rows = list(processor.summarize())
+    processor.aggregated_entities()
+    timings['output'] = time.perf_counter() - start
+    return timings, len(rows)
+
+
+def run_v1(entities: List[Any], formulas: List[str]) -> Tuple[Timings, int]:
+    from app.services import calculator_v1
+
+    timings = dict.fromkeys(PHASES, 0.0)
+    start = time.perf_counter()
+    processor = calculator_v1.FormulaProcessor(entities)
+    processor._preprocess_entities()
+    timings['ingest'] = time.perf_counter() - start
+
+    # Mesmas etapas de calculator_v1.FormulaProcessor.process
+    start = time.perf_counter()
+    processor._process_direct_formulas(formulas)
+    timings['direct'] = time.perf_counter() - start
+    start = time.perf_counter()
+    for formula in formulas:
+        if formula.startswith("SUM("):
+            processor._process_sum_aggregation(formula)
+    timings['aggregation'] = time.perf_counter() - start
+    start = time.perf_counter()
+    for formula in formulas:
+        if "TotalDosServicos" in formula:
+            processor._process_tributo_calculation()
+    timings['tributo'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    processor._get_aggregated_entities()
+    timings['output'] = time.perf_counter() - start
+    return timings, len(processor.direct_results)
+
+
+ENGINES: Dict[str, Callable[[List[Any], List[str]], Tuple[Timings, int]]] = {
+    'current': run_current,
+    'v1': run_v1,
+}
+
+
+def measure(engine: str, entities: List[Any], formulas: List[str], repeat: int) -> Dict[str, Any]:
+    runs: List[Timings] = []
+    rows = 0
+    for _ in range(repeat):
+        gc.collect()
+        timings, rows = ENGINES[engine](entities, formulas)
+        timings['total'] = sum(timings.values())
+        runs.append(timings)
+    return {
+        'rows': rows,
+        'phases': {
+            phase: {
+                'min': min(r[phase] for r in runs),
+                'median': statistics.median(r[phase] for r in runs),
+                'runs': [r[phase] for r in runs],
+            }
+            for phase in (*PHASES, 'total')
+        },
+    }
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _case_key(result: Dict[str, Any]) -> Tuple[Any, ...]:
+    return (result['engine'], result['target_entities'], result['services'], result['measurements'])
+
+
+def compare(results: List[Dict[str, Any]], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Fases mais lentas que `threshold` vezes o tempo mínimo registrado em `baseline`."""
+    previous = {_case_key(r): r for r in baseline.get('results', [])}
+    regressions = []
+    for result in results:
+        before = previous.get(_case_key(result))
+        if before is None:
+            continue
+        for phase, stats in result['phases'].items():
+            old = before['phases'].get(phase, {}).get('min')
+            if not old:
+                continue
+            ratio = stats['min'] / old
+            line = (f"{result['engine']:>8} {result['target_entities']:>8} "
+                    f"{result['services']}x{result['measurements']:<4} {phase:<12} "
+                    f"{old:9.4f}s -> {stats['min']:9.4f}s  x{ratio:.2f}")
+            print(line)
+            if ratio > threshold:
+                regressions.append(line)
+    return regressions
+
+
+def _parse_fanout(value: str) -> List[Tuple[int, int]]:
+    return [tuple(int(n) for n in item.split('x')) for item in value.split(',')]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark do motor de fórmulas")
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help="quantidades aproximadas de entidades, separadas por vírgula")
+    parser.add_argument('--fanout', default='10x5',
+                        help="servicos por contrato x medicoes por servico, ex.: 10x5,50x20")
+    parser.add_argument('--items', type=int, default=100, help="itens referenciados por itemId")
+    parser.add_argument('--engines', default='current,v1', help="current e/ou v1")
+    parser.add_argument('--v1-max-entities', type=int, default=20000,
+                        help="acima deste tamanho o calculator_v1 não é medido")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--baseline', help="JSON de uma execução anterior para comparar")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="razão de tempo acima da qual uma fase conta como regressão")
+    args = parser.parse_args(argv)
+
+    engines = [e for e in args.engines.split(',') if e]
+    for engine in engines:
+        if engine not in ENGINES:
+            parser.error(f"unknown engine '{engine}'")
+    formulas = [formula for phase in PHASE_FORMULAS.values() for formula in phase]
+
+    results = []
+    for size in (int(s) for s in args.sizes.split(',')):
+        for services, measurements in _parse_fanout(args.fanout):
+            entities, _ = generate_entities(size, services, measurements, args.items, args.seed)
+            for engine in engines:
+                if engine == 'v1' and len(entities) > args.v1_max_entities:
+                    continue
+                result = {
+                    'engine': engine,
+                    'target_entities': size,
+                    'entities': len(entities),
+                    'services': services,
+                    'measurements': measurements,
+                    **measure(engine, entities, formulas, args.repeat),
+                }
+                results.append(result)
+                phases = '  '.join(f"{p}={result['phases'][p]['min']:.4f}s" for p in (*PHASES, 'total'))
+                print(f"{engine:>8} {len(entities):>8} {services}x{measurements:<4} {phases}", file=sys.stderr)
+            del entities
+
+    report = {
+        'meta': {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'formula_workers': config.FORMULA_WORKERS,
+            'repeat': args.repeat,
+            'formulas': PHASE_FORMULAS,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"{len(regressions)} phase(s) slower than x{args.threshold}:", file=sys.stderr)
+            for line in regressions:
+                print("  " + line, file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
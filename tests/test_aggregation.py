@@ -0,0 +1,100 @@
+import math
+import random
+
+import pytest
+
+from app.services.aggregation import Accumulator, GroupReduction, reduce_group
+
+
+def reference(fn, values):
+    # Semântica da agregação sobre a lista completa
+    if fn == 'COUNT':
+        return float(len(values))
+    if fn == 'SUM':
+        total = 0.0
+        for value in values:
+            total += value
+        return total
+    if not values:
+        return 0.0
+    if fn == 'AVG':
+        return reference('SUM', values) / len(values)
+    return float(max(values) if fn == 'MAX' else min(values))
+
+
+@pytest.mark.parametrize('fn', ['SUM', 'AVG', 'COUNT', 'MAX', 'MIN'])
+def test_reducers_match_the_list_semantics(fn):
+    rnd = random.Random(fn)
+    for size in [0, 1, 2, 7, 100]:
+        values = [rnd.choice([rnd.uniform(-1e6, 1e6), 0.1, -0.0, 3.0]) for _ in range(size)]
+        # Consome um gerador, sem montar a lista
+        assert repr(reduce_group(fn, (v for v in values))) == repr(reference(fn, values))
+
+
+def test_unknown_function_and_empty_groups_are_zero():
+    assert reduce_group('MEDIAN', iter([1.0, 2.0])) == 0.0
+    assert [reduce_group(fn, iter(())) for fn in ('SUM', 'AVG', 'COUNT', 'MAX', 'MIN')] == [0.0] * 5
+
+
+def test_max_and_min_keep_builtin_nan_handling():
+    values = [math.nan, 1.0, 2.0]
+    assert math.isnan(reduce_group('MAX', iter(values)))
+    assert reduce_group('MIN', iter([1.0, math.nan, 0.5])) == 0.5
+
+
+def random_values(rnd, size):
+    choices = [0.1, -0.0, 0.0, 3.0, 1e300, -1e300, 5e-324, math.nan, math.inf, -math.inf]
+    return [rnd.uniform(-1e6, 1e6) if rnd.random() < 0.6 else rnd.choice(choices) for _ in range(size)]
+
+
+def split(rnd, values):
+    cuts = sorted(rnd.sample(range(len(values) + 1), rnd.randint(0, min(4, len(values) + 1))))
+    return [values[start:end] for start, end in zip([0] + cuts, cuts + [len(values)])]
+
+
+@pytest.mark.parametrize('fn', ['SUM', 'AVG', 'COUNT', 'MAX', 'MIN'])
+def test_merged_chunks_match_a_single_pass(fn):
+    rnd = random.Random(fn)
+    for _ in range(300):
+        values = random_values(rnd, rnd.randint(0, 30))
+        single = Accumulator(fn).consume(values).result()
+        chunks = [Accumulator(fn).consume(chunk) for chunk in split(rnd, values)]
+        # Juntados em sequência e em árvore, sempre na ordem dos pedaços
+        merged = Accumulator(fn)
+        for state in chunks:
+            merged.merge(state)
+        assert repr(merged.result()) == repr(single), values
+        while len(chunks) > 1:
+            chunks = [a.merge(b) for a, b in zip(chunks[::2], chunks[1::2])] + chunks[len(chunks) // 2 * 2:]
+        if chunks:
+            assert repr(chunks[0].result()) == repr(single), values
+
+
+@pytest.mark.parametrize('fn', ['COUNT', 'MAX', 'MIN'])
+def test_accumulator_matches_the_reducers(fn):
+    rnd = random.Random(fn)
+    for size in [0, 1, 2, 7, 100]:
+        values = random_values(rnd, size)
+        assert repr(Accumulator(fn).consume(values).result()) == repr(reduce_group(fn, iter(values)))
+
+
+def test_accumulator_sum_is_exact():
+    rnd = random.Random(0)
+    for _ in range(200):
+        values = [rnd.choice([rnd.uniform(-1e6, 1e6), 1e300, -1e300, 0.1, 5e-324]) for _ in range(rnd.randint(1, 30))]
+        assert Accumulator('SUM').consume(values).result() == math.fsum(values)
+        assert Accumulator('AVG').consume(values).result() == math.fsum(values) / len(values)
+    assert Accumulator('SUM').consume([1e308, 1e308]).result() == math.inf
+    assert math.isnan(Accumulator('SUM').consume([math.inf, 1.0, -math.inf]).result())
+
+
+@pytest.mark.parametrize('fn', ['SUM', 'AVG', 'COUNT', 'MAX', 'MIN'])
+@pytest.mark.parametrize('columnar_min_rows', [0, 1, 5])
+def test_columnar_groups_match_the_streaming_reducers(fn, columnar_min_rows):
+    rnd = random.Random(fn)
+    groups = [random_values(rnd, rnd.randint(0, 12)) for _ in range(60)]
+    reduction = GroupReduction(fn, columnar_min_rows)
+    for values in groups:
+        reduction.add((v for v in values), len(values))
+    expected = [reduce_group(fn, iter(values)) for values in groups]
+    assert list(map(repr, reduction.results())) == list(map(repr, expected))
@@ -0,0 +1,93 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.models.schemas import ColumnarOutputData, ProjectedOutputData
+
+
+def attribute(key, value, type_='number'):
+    return {'key': key, 'value': value, 'type': type_}
+
+
+ENTITIES = [
+    {'id': 'c1', 'entity_type': ['Contract'], 'attributes': [
+        attribute('value', 10), attribute('nome', 'abc', 'string'), attribute('ISS', 0.05)
+    ]},
+    {'id': 's1', 'entity_type': ['Servico'], 'attributes': [
+        attribute('contractId', 'c1', 'string'), attribute('Q', 2), attribute('itemId', 'i1', 'string')
+    ]},
+    {'id': 'i1', 'entity_type': ['Item'], 'attributes': [attribute('Preco', 3)]},
+]
+
+
+@pytest.fixture(scope='module')
+def client():
+    with TestClient(app, raise_server_exceptions=False) as c:
+        yield c
+
+
+def results_by_formula(body):
+    return {row['formula']: row for row in body['direct_results']}
+
+
+@pytest.mark.parametrize('path', ['/api/v1/calculate', '/api/v1/calculate/stream', '/api/v1/sessions'])
+def test_formula_cycle_is_a_validation_error(client, path):
+    r = client.post(path, json={'entities': ENTITIES, 'formulas': ['A = B + 1', 'B = A + 1']})
+    assert r.status_code == 422
+    assert r.json()['detail'] == "Circular dependency between formulas: 'A = B + 1', 'B = A + 1'"
+
+
+def test_named_formula_is_evaluated_like_a_direct_formula(client):
+    formulas = ['A = Contract.value * 2', 'Contract.value * 2', 'N = Contract.nome + "x"', 'B = A + 1']
+    r = client.post('/api/v1/calculate', json={'entities': ENTITIES, 'formulas': formulas})
+    assert r.status_code == 200
+    rows = results_by_formula(r.json())
+    named, direct = rows['A = Contract.value * 2'], rows['Contract.value * 2']
+    assert (named['resolved_formula'], named['result'], named['result_type']) == ('10 * 2', 20.0, 'int')
+    assert (direct['resolved_formula'], direct['result'], direct['result_type']) == ('10 * 2', 20.0, 'int')
+    assert (rows['N = Contract.nome + "x"']['result'], rows['N = Contract.nome + "x"']['result_type']) == ('abcx', 'str')
+    assert rows['B = A + 1']['resolved_formula'] == '20.0 + 1'
+    assert rows['B = A + 1']['result'] == 21.0
+
+
+def test_totals_formula_keeps_the_tributo_description(client):
+    formulas = ['SUM(Contract.Servico.Q * @itemId.Preco)', 'Tributo = Contract.ISS * TotalDosServicos']
+    r = client.post('/api/v1/calculate', json={'entities': ENTITIES, 'formulas': formulas})
+    assert r.status_code == 200
+    row = results_by_formula(r.json())['Tributo = Contract.ISS * TotalDosServicos']
+    assert row['result_type'] == 'float'
+    assert row['resolved_formula'].startswith('ISS (0.05) * TotalDosServicos (')
+
+
+def test_session_matches_calculate_for_named_formulas(client):
+    payload = {'entities': ENTITIES, 'formulas': ['A = Contract.value * 2', 'N = Contract.nome + "x"', 'B = A + 1']}
+    calculated = client.post('/api/v1/calculate', json=payload).json()
+    session = client.post('/api/v1/sessions', json=payload).json()
+    assert session['direct_results'] == calculated['direct_results']
+    assert session['aggregated_entities'] == calculated['aggregated_entities']
+
+
+def test_failing_ref_aggregation_does_not_drop_its_group(client):
+    formulas = ['SUM(Contract.Servico.Q * @itemId.Preco)', 'MAX(Contract.Servico.Missing * @itemId.Preco)']
+    r = client.post('/api/v1/calculate/stream', json={'entities': ENTITIES, 'formulas': formulas})
+    lines = [json.loads(line) for line in r.text.splitlines()]
+    assert [line.get('formula') for line in lines[:-1]] == ['SUM(Contract.Servico.Q * @itemId.Preco)']
+    assert lines[0]['result'] == 6.0
+    assert lines[-1] == {'error': "Attribute 'Missing' not found in entity s1"}
+
+
+def test_openapi_documents_projected_and_columnar_responses():
+    schema = app.openapi()['paths']['/api/v1/calculate']['post']['responses']['200']['content']['application/json']
+    assert [ref['$ref'].rsplit('/', 1)[1] for ref in schema['schema']['anyOf']] == [
+        'OutputData', 'ProjectedOutputData', 'ColumnarOutputData'
+    ]
+
+
+def test_columnar_response_matches_its_schema(client):
+    payload = {'entities': ENTITIES, 'formulas': ['Contract.value * 2', 'Servico.Q / 0']}
+    columnar = client.post('/api/v1/calculate?format=columnar&fields=entity_id,result,error', json=payload)
+    ColumnarOutputData.model_validate(columnar.json())
+    projected = client.post('/api/v1/calculate?fields=entity_id,error&failed_only=true', json=payload)
+    assert ProjectedOutputData.model_validate(projected.json()).direct_results[0].error == 'division by zero'
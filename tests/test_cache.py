@@ -0,0 +1,246 @@
+import asyncio
+import time
+
+import pytest
+
+from app.services.cache import LocalCache, RedisCache, ResultCache
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_local_cache_expires_entries_after_ttl():
+    cache = LocalCache(ttl=0.05)
+    run(cache.set('a', b'1'))
+    assert run(cache.get('a')) == b'1'
+    time.sleep(0.06)
+    assert run(cache.get('a')) is None
+    assert cache.size == 0
+
+
+def test_local_cache_evicts_least_recently_used_by_count():
+    cache = LocalCache(max_entries=2)
+    run(cache.set('a', b'1'))
+    run(cache.set('b', b'2'))
+    run(cache.get('a'))
+    run(cache.set('c', b'3'))
+    assert run(cache.get('b')) is None
+    assert run(cache.get('a')) == b'1'
+    assert run(cache.get('c')) == b'3'
+
+
+def test_local_cache_evicts_by_total_size():
+    cache = LocalCache(max_bytes=40)
+    for key in 'abcd':
+        run(cache.set(key, b'x' * 10))
+    run(cache.set('e', b'x' * 10))
+    assert run(cache.get('a')) is None
+    assert [run(cache.get(key)) is not None for key in 'bcde'] == [True] * 4
+    assert cache.size == 40
+    # Substituir um valor desconta o tamanho do anterior
+    run(cache.set('e', b'x'))
+    assert cache.size == 31
+
+
+def test_local_cache_skips_oversized_values():
+    cache = LocalCache(max_bytes=40)
+    run(cache.set('small', b'x' * 10))
+    run(cache.set('big', b'x' * 11))
+    assert run(cache.get('big')) is None
+    assert run(cache.get('small')) == b'x' * 10
+    assert cache.size == 10
+
+
+class FlakyClient:
+    """Cliente que falha enquanto `down` e conta as chamadas recebidas."""
+
+    def __init__(self):
+        self.down = True
+        self.calls = 0
+        self.data = {}
+
+    async def get(self, key):
+        self.calls += 1
+        if self.down:
+            raise ConnectionError('connection refused')
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.calls += 1
+        if self.down:
+            raise ConnectionError('connection refused')
+        self.data[key] = value
+
+
+def test_redis_cache_falls_back_and_backs_off(caplog):
+    client = FlakyClient()
+    cache = RedisCache(client, LocalCache(), retry_after=0.05)
+
+    async def scenario():
+        await cache.set('a', b'1')
+        # Durante o intervalo o Redis nem é tentado: tudo vai ao cache local
+        assert await cache.get('a') == b'1'
+        await cache.set('b', b'2')
+        assert await cache.get('b') == b'2'
+        assert client.calls == 1
+        await asyncio.sleep(0.06)
+        await cache.get('a')
+        assert client.calls == 2
+        # Nova falha dobra o intervalo
+        assert cache._backoff == pytest.approx(0.1)
+        await asyncio.sleep(0.11)
+        client.down = False
+        await cache.set('c', b'3')
+        assert client.data == {'c': b'3'}
+        assert await cache.get('c') == b'3'
+        assert cache._backoff == 0.0
+
+    run(scenario())
+    assert [r.getMessage() for r in caplog.records if r.levelname == 'WARNING'] == [
+        'Redis unavailable, using in-process cache: connection refused'
+    ]
+
+
+def test_redis_cache_with_fakeredis():
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.FakeServer()
+    client = fakeredis.FakeAsyncRedis(server=server)
+    cache = RedisCache(client, LocalCache(), ttl=60, retry_after=60)
+
+    async def scenario():
+        await cache.set('a', b'1')
+        assert await client.get('a') == b'1'
+        assert 0 < await client.ttl('a') <= 60
+        server.connected = False
+        await cache.set('b', b'2')
+        assert await cache.get('b') == b'2'
+        assert await cache.get('a') is None
+
+    run(scenario())
+
+
+def test_redis_cache_skips_oversized_values():
+    client = FlakyClient()
+    client.down = False
+    cache = RedisCache(client, LocalCache(max_bytes=40))
+    run(cache.set('big', b'x' * 11))
+    assert client.calls == 0
+
+
+def test_result_cache_coalesces_identical_requests():
+    cache = ResultCache(LocalCache())
+    calls = []
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def compute():
+            calls.append(1)
+            await release.wait()
+            return b'result'
+
+        tasks = [asyncio.ensure_future(cache.get_or_compute('k', compute)) for _ in range(5)]
+        await asyncio.sleep(0)
+        release.set()
+        assert await asyncio.gather(*tasks) == [b'result'] * 5
+        # Depois de pronto o valor vem do cache, sem calcular de novo
+        assert await cache.get_or_compute('k', compute) == b'result'
+
+    run(scenario())
+    assert len(calls) == 1
+
+
+def test_result_cache_shares_errors_without_caching_them():
+    cache = ResultCache(LocalCache())
+    calls = []
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def failing():
+            calls.append(1)
+            await release.wait()
+            raise RuntimeError('boom')
+
+        tasks = [asyncio.ensure_future(cache.get_or_compute('k', failing)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        assert [str(r) for r in results] == ['boom'] * 3
+
+        async def compute():
+            calls.append(1)
+            return b'ok'
+
+        assert await cache.get_or_compute('k', compute) == b'ok'
+
+    run(scenario())
+    assert len(calls) == 2
+
+
+def test_result_cache_followers_take_over_when_the_leader_is_cancelled():
+    cache = ResultCache(LocalCache())
+    calls = []
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def compute():
+            calls.append(1)
+            await release.wait()
+            return b'result'
+
+        leader = asyncio.ensure_future(cache.get_or_compute('k', compute))
+        await asyncio.sleep(0)
+        followers = [asyncio.ensure_future(cache.get_or_compute('k', compute)) for _ in range(3)]
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert await asyncio.gather(*followers) == [b'result'] * 3
+        assert leader.cancelled()
+
+    run(scenario())
+    # Um dos seguidores assume o cálculo; os outros esperam por ele
+    assert len(calls) == 2
+
+
+def test_result_cache_cancelled_follower_does_not_retry():
+    cache = ResultCache(LocalCache())
+    calls = []
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def compute():
+            calls.append(1)
+            await release.wait()
+            return b'result'
+
+        leader = asyncio.ensure_future(cache.get_or_compute('k', compute))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(cache.get_or_compute('k', compute))
+        await asyncio.sleep(0)
+        follower.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert await leader == b'result'
+        assert follower.cancelled()
+
+    run(scenario())
+    assert len(calls) == 1
+
+
+def test_disabled_result_cache_always_computes():
+    cache = ResultCache(LocalCache(), enabled=False)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        return b'ok'
+
+    run(cache.get_or_compute('k', compute))
+    run(cache.get_or_compute('k', compute))
+    assert len(calls) == 2
+    assert run(cache.backend.get('k')) is None
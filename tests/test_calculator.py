@@ -0,0 +1,59 @@
+from app import config
+from app.models.schemas import EntityInput
+from app.services.calculator import FormulaProcessor
+from app.services.codec import decode_input, dumps
+from benchmarks.generators import generate_payload
+
+
+def attribute(key, value, type_='number'):
+    return {'key': key, 'value': value, 'type': type_}
+
+
+def entities(contracts=3):
+    result = [EntityInput(id='i1', entity_type=['Item'], attributes=[attribute('Preco', 2.5)])]
+    for c in range(contracts):
+        result.append(EntityInput(id=f'c{c}', entity_type=['Contract'], attributes=[
+            attribute('value', 100 + c), attribute('ISS', 0.05)
+        ]))
+        for s in range(2):
+            result.append(EntityInput(id=f's{c}{s}', entity_type=['Servico'], attributes=[
+                attribute('contractId', f'c{c}', 'string'), attribute('Q', s + 1), attribute('itemId', 'i1', 'string')
+            ]))
+    return result
+
+
+FORMULAS = [
+    'Contract.value * 2',
+    'SUM(Contract.Servico.Q * @itemId.Preco)',
+    'Tributo = Contract.ISS * TotalDosServicos',
+    'Servico.Q / 0',
+    'Contract.value * 2',
+    'SUM(Contract.Servico.Q * @itemId.Preco)',
+]
+
+
+def test_streaming_matches_summarize_and_releases_rows():
+    full = FormulaProcessor(entities())
+    full.process(FORMULAS)
+    streamed = FormulaProcessor(entities())
+    assert list(streamed.iter_results(FORMULAS)) == list(full.summarize())
+    assert streamed.aggregated_entities() == full.aggregated_entities()
+    # Só os atributos calculados continuam guardados depois do stream
+    store = streamed.results
+    assert store.entity_ids == [] and store._keys == {}
+    refs = {ref for refs in streamed.aggregated.values() for ref in refs if isinstance(ref, int)}
+    assert set(store._released) == refs
+
+
+def test_columnar_aggregation_matches_streaming(monkeypatch):
+    payload = generate_payload(300, services=4, measurements=6, items=5, seed=1)
+    payload['formulas'] += [f"{fn}(Contract.Servico.Quantidade * @itemId.Preco)" for fn in ('AVG', 'COUNT', 'MIN')] + [
+        f"{fn}(Contract.Servico.Quantidade * Contract.Servico.Medicao.Preco)" for fn in ('COUNT', 'MAX', 'MIN')
+    ]
+    outputs = []
+    for columnar_min_rows in (0, 1, 4):
+        monkeypatch.setattr(config, 'AGGREGATION_COLUMNAR_MIN_ROWS', columnar_min_rows)
+        processor = FormulaProcessor(decode_input(dumps(payload)).entities)
+        processor.process(payload['formulas'])
+        outputs.append((repr(list(processor.summarize())), repr(processor.aggregated_entities())))
+    assert outputs[1] == outputs[0] and outputs[2] == outputs[0]
@@ -0,0 +1,86 @@
+import gc
+import re
+import weakref
+
+import pytest
+
+from app.services.calculator import FormulaProcessor
+from app.services.expression import compile_formula
+from app.services.entity_store import EntityRecord
+
+
+@pytest.mark.parametrize('formula, message', [
+    ("Contract.__class__", "Unsupported attribute access: __class__"),
+    ("Contract.value.__class__", "Unsupported attribute access: __class__"),
+    ("max.__self__", "Unsupported attribute access: __self__"),
+    ("__import__('os')", "Only calls to built-in formula functions are allowed"),
+    ("__builtins__", "Unsupported name: __builtins__"),
+    ("max(**{'a': 1})", "Unsupported expression: **kwargs"),
+    ("open('x')", "Only calls to built-in formula functions are allowed"),
+    ("eval('1')", "Only calls to built-in formula functions are allowed"),
+    ("Contract.value()", "Only calls to built-in formula functions are allowed"),
+    ("[x for x in (1, 2)]", "Unsupported expression: ListComp"),
+    ("lambda: 1", "Unsupported expression: Lambda"),
+    ("Contract.value ** 10 ** 9", "Unsupported expression: exponent must be a constant up to 64"),
+    ("Contract.value ** Contract.value", "Unsupported expression: exponent must be a constant up to 64"),
+    ("2 ** 65", "Unsupported expression: exponent must be a constant up to 64"),
+])
+def test_rejects_expressions_outside_the_whitelist(formula, message):
+    plan = compile_formula(formula, 'Contract')
+    with pytest.raises(ValueError, match=re.escape(message)):
+        plan.evaluate((1,) * len(plan.attrs))
+
+
+@pytest.mark.parametrize('formula, values, message', [
+    ("((Contract.value ** 64) ** 64) ** 64", (7,), "Integer result too large"),
+    ("pow(Contract.value, 10 ** 9)", (7,), "Integer result too large"),
+    ("Contract.value * Contract.value", (1 << 40000,), "Integer result too large"),
+    ("1 << Contract.value", (10 ** 9,), "Integer result too large"),
+    ("Contract.value * 10 ** 9", ('ab',), "Sequence result too large"),
+    ("[0] * Contract.value", (10 ** 9,), "Sequence result too large"),
+])
+def test_rejects_oversized_results(formula, values, message):
+    with pytest.raises(ValueError, match=re.escape(message)):
+        compile_formula(formula, 'Contract').evaluate(values)
+
+
+def test_small_powers_and_products_are_unchanged():
+    plan = compile_formula("Contract.a ** 2 + Contract.a ** -1 + Contract.a ** 0.5 + pow(Contract.a, 3, 5)", 'Contract')
+    assert plan.evaluate((4,)) == 16 + 0.25 + 2.0 + 4
+    assert compile_formula("Contract.a * 3", 'Contract').evaluate(('ab',)) == 'ababab'
+    assert compile_formula("Contract.a * Contract.b", 'Contract').evaluate((2 ** 60, 3)) == 3 * 2 ** 60
+
+
+def test_allows_whitelisted_functions():
+    plan = compile_formula("round(max(Contract.a, Contract.b) * 1.5, 1)", 'Contract')
+    assert plan.evaluate((2, 3)) == 4.5
+
+
+def test_compile_error_is_raised_fresh_on_each_evaluation():
+    plan = compile_formula("Contract.value = 3", 'Contract')
+    errors = []
+    for _ in range(50):
+        with pytest.raises(SyntaxError) as info:
+            plan.evaluate((1,))
+        errors.append(info.value)
+    assert errors[0] is not errors[-1]
+    assert str(errors[0]) == str(errors[-1])
+    # O traceback não cresce a cada avaliação
+    frames = 0
+    tb = errors[-1].__traceback__
+    while tb is not None:
+        frames += 1
+        tb = tb.tb_next
+    assert frames <= 3
+
+
+def test_processor_with_invalid_formula_is_released():
+    entities = [EntityRecord('c1', ['Contract'], {'value': 10}, (10,))]
+    processor = FormulaProcessor(entities)
+    processor.process(["Contract.value = 3"])
+    rows = list(processor.summarize())
+    assert rows[0]['success'] is False
+    ref = weakref.ref(processor)
+    del processor, rows
+    gc.collect()
+    assert ref() is None
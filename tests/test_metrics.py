@@ -0,0 +1,24 @@
+from app.services.metrics import MetricsRegistry
+
+
+def samples(text):
+    return dict(line.rsplit(' ', 1) for line in text.splitlines() if not line.startswith('#'))
+
+
+def test_render_keeps_every_digit():
+    registry = MetricsRegistry(prefix='t')
+    registry.inc('lookups_total', 2469134, "Lookups")
+    registry.inc('phase_seconds_total', 0.1, "Time", phase='direct')
+    registry.inc('phase_seconds_total', 0.2, "Time", phase='direct')
+    for seconds in (0.003, 0.2, 1234.5678912):
+        registry.observe('request_duration_seconds', seconds, "Duration")
+    rendered = samples(registry.render([('sessions', 1e-7, "Sessions"), ('size', float('inf'), "Size")]))
+    assert rendered['t_lookups_total'] == '2469134'
+    assert rendered['t_phase_seconds_total{phase="direct"}'] == repr(0.1 + 0.2)
+    assert rendered['t_request_duration_seconds_bucket{le="0.005"}'] == '1'
+    assert rendered['t_request_duration_seconds_bucket{le="0.25"}'] == '2'
+    assert rendered['t_request_duration_seconds_bucket{le="+Inf"}'] == '3'
+    assert rendered['t_request_duration_seconds_count'] == '3'
+    assert rendered['t_request_duration_seconds_sum'] == repr(0.0 + 0.003 + 0.2 + 1234.5678912)
+    assert rendered['t_sessions'] == '1e-07'
+    assert rendered['t_size'] == '+Inf'
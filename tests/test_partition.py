@@ -0,0 +1,61 @@
+import random
+
+import pytest
+
+from app.services.codec import OutputOptions, decode_input, dumps
+from app.services.executor import run_calculation
+from app.services.partition import partitions
+from benchmarks.generators import generate_payload
+
+EXTRA_FORMULAS = [
+    'Trib = Contract.ISS * TotalDosServicos', 'Liq = TotalDosServicos - Trib', 'Servico.Quantidade * 3',
+    'Dobro = Servico.Quantidade * 2', 'Dobro + 1', 'Medicao.Quantidade / Servico.Quantidade',
+]
+
+OUTPUTS = {
+    'rows': OutputOptions(),
+    'columnar': OutputOptions(columnar=True),
+    'fields': OutputOptions(['entity_id', 'result', 'error'], failed_only=False),
+    'failed_only': OutputOptions(['entity_id', 'error'], failed_only=True),
+    'columnar_fields': OutputOptions(['entity_id', 'resolved_formula', 'result'], columnar=True),
+}
+
+
+def shuffled_payload(seed):
+    rnd = random.Random(seed)
+    payload = generate_payload(rnd.randint(150, 600), services=rnd.randint(2, 6), measurements=rnd.randint(0, 4),
+                               items=rnd.randint(3, 20), seed=seed)
+    rnd.shuffle(payload['entities'])
+    payload['formulas'] += rnd.sample(EXTRA_FORMULAS, rnd.randint(0, len(EXTRA_FORMULAS)))
+    rnd.shuffle(payload['formulas'])
+    return payload
+
+
+@pytest.fixture
+def partitioned(monkeypatch):
+    monkeypatch.setattr(partitions, 'workers', 3)
+    monkeypatch.setattr(partitions, 'min_entities', 0)
+    yield partitions
+    partitions.shutdown()
+
+
+def calculate(payload, options, workers):
+    partitions.workers = workers
+    try:
+        return run_calculation(decode_input(dumps(payload)).entities, payload['formulas'], options)
+    except Exception as e:
+        return repr(e), None
+
+
+@pytest.mark.parametrize('output', OUTPUTS)
+def test_partitioned_calculation_matches_sequential(partitioned, output):
+    options = OUTPUTS[output]
+    used = 0
+    for seed in range(6):
+        payload = shuffled_payload(seed)
+        sequential, _ = calculate(payload, options, workers=1)
+        content, stats = calculate(payload, options, workers=3)
+        assert content == sequential, f"seed {seed}"
+        used += stats is not None and 'partition' in stats.phases
+    # A maioria dos payloads precisa mesmo ter sido dividida
+    assert used >= 4
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+from app.services.codec import decode_entities, dumps
+from app.services.snapshots import SnapshotStore, SnapshotTooLarge
+
+
+def entities(n, tag):
+    payload = {'entities': [
+        {'id': f'{tag}{i}', 'entity_type': ['Contract'], 'attributes': [{'key': 'value', 'value': i, 'type': 'number'}]}
+        for i in range(n)
+    ]}
+    decoded = decode_entities(dumps(payload))
+    return decoded.entities, decoded.payload['entities']
+
+
+def put(store, n, tag, when):
+    info = store.put(*entities(n, tag))
+    os.utime(os.path.join(store.directory, info.ref + '.snap'), (when, when))
+    return info
+
+
+def test_put_evicts_least_recently_used_snapshots(tmp_path):
+    size = SnapshotStore(str(tmp_path / 'probe')).put(*entities(50, 'x')).size
+    store = SnapshotStore(str(tmp_path / 'snapshots'), max_bytes=size * 3)
+    a = put(store, 50, 'a', 1000)
+    b = put(store, 50, 'b', 2000)
+    c = put(store, 50, 'c', 3000)
+    # Usar `a` renova a data dele; o próximo a sair é `b`
+    assert store.load(a.ref) is not None
+    d = store.put(*entities(50, 'd'))
+    assert store.info(b.ref) is None and store.load(b.ref) is None
+    assert all(store.info(info.ref) is not None for info in (a, c, d))
+    assert sum(f.stat().st_size for f in (tmp_path / 'snapshots').iterdir()) <= store.max_bytes
+
+
+def test_put_rejects_a_snapshot_larger_than_the_limit(tmp_path):
+    store = SnapshotStore(str(tmp_path), max_bytes=200)
+    with pytest.raises(SnapshotTooLarge):
+        store.put(*entities(50, 'a'))
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,61 @@
+import itertools
+import random
+
+import pytest
+
+from app.services.expression import compile_formula
+from app.services.vectorized import VECTORIZE_MIN_ROWS, evaluate_batch
+
+PLANS = [
+    'Contract.a + Contract.b', 'Contract.a - Contract.b', 'Contract.a * Contract.b', 'Contract.a / Contract.b',
+    '-Contract.a', '-(Contract.a - Contract.b) * 2', 'Contract.a * 2 + 1.5', '(Contract.a + 1) / (Contract.b - 1)',
+]
+
+VALUES = [0, 1, -3, 7, 2 ** 52, 2 ** 53 + 1, 2 ** 60, 0.0, -0.0, 2.5, -1e308, 1e308, 'x', None, True]
+
+
+def scalar(plan, row):
+    # Como FormulaProcessor._process_direct avalia uma linha sem o lote
+    try:
+        res = plan.evaluate(row)
+    except Exception as e:
+        return 'error', str(e)
+    return repr(float(res) if isinstance(res, (int, float)) else res), type(res).__name__
+
+
+def rows():
+    pairs = list(itertools.product(VALUES, repeat=2))
+    result = pairs * (VECTORIZE_MIN_ROWS // len(pairs) + 1)
+    random.Random(0).shuffle(result)
+    return result
+
+
+@pytest.mark.parametrize('formula', PLANS)
+def test_batch_matches_scalar_evaluation(formula):
+    plan = compile_formula(formula, 'Contract')
+    data = [row[:len(plan.attrs)] for row in rows()]
+    assert len(data) >= VECTORIZE_MIN_ROWS
+    batch = evaluate_batch(plan, data)
+    assert batch is not None
+    values, is_int, ok = batch.values.tolist(), batch.is_int.tolist(), batch.ok.tolist()
+    assert any(ok) and not all(ok)
+    for i, row in enumerate(data):
+        if ok[i]:
+            assert (repr(values[i]), 'int' if is_int[i] else 'float') == scalar(plan, row), row
+
+
+def test_batch_leaves_unexact_rows_to_the_scalar_path():
+    data = [(0, -3), (-0.0, 1), (1, 0), (1, 0.0), (2 ** 60, 1), (2 ** 52, 2 ** 52), ('x', 1), (1.5, 'x'), (True, 1)]
+    data *= VECTORIZE_MIN_ROWS // len(data) + 1
+    ok = {}
+    for formula in ('Contract.a * Contract.b', 'Contract.a / Contract.b', 'Contract.a + Contract.b'):
+        batch = evaluate_batch(compile_formula(formula, 'Contract'), data)
+        ok[formula] = dict(zip(data, batch.ok.tolist()))
+    # Divisão por zero, inteiros fora da faixa exata e valores não numéricos
+    assert not ok['Contract.a / Contract.b'][(1, 0)] and not ok['Contract.a / Contract.b'][(1, 0.0)]
+    assert not ok['Contract.a + Contract.b'][(2 ** 60, 1)]
+    assert not ok['Contract.a * Contract.b'][(2 ** 52, 2 ** 52)]
+    assert ok['Contract.a + Contract.b'][(2 ** 52, 2 ** 52)]
+    assert not any(ok[f][row] for f in ok for row in [('x', 1), (1.5, 'x'), (True, 1)])
+    # 0 * -3 é o inteiro 0, sem sinal; -0.0 * 1 continua -0.0
+    assert ok['Contract.a * Contract.b'][(0, -3)] and ok['Contract.a * Contract.b'][(-0.0, 1)]